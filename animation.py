@@ -0,0 +1,202 @@
+import numpy as np
+from PIL import Image
+
+
+# animations that can be applied to an image
+ANIMATIONS = ['zoom-in', 'zoom-out', 'pan-right', 'pan-left']
+
+# zoom speed, in scale factor per second
+ZOOM_RATE = 0.02
+
+
+def crop_box(w, h, aspect_ratio, allow_slight_stretching=False, max_stretch=1.2):
+    """
+    Get the box to crop an image to so that, once scaled, it has the desired
+    aspect ratio. Same as Video.crop_to_aspect(), but as a box in the
+    original image, so the crop and any stretching can be done in one resize.
+
+    Parameters
+    ----------
+    w : int
+        width of the image.
+    h : int
+        height of the image.
+    aspect_ratio : float
+        the desired aspect ratio.
+    allow_slight_stretching : bool
+        if True, stretch towards the desired aspect ratio (up to max_stretch)
+        before cropping.
+    max_stretch : float
+        the max factor one dimension can be stretched by.
+
+    Returns
+    -------
+    box : tuple
+        (x1, y1, x2, y2) in the original image's pixels.
+    """
+
+    # stretch factors
+    sx, sy = 1.0, 1.0
+    if allow_slight_stretching:
+        if w / h > aspect_ratio * max_stretch:  # very wide image
+            sy = max_stretch
+        elif w / h < aspect_ratio / max_stretch:  # very tall image
+            sx = max_stretch
+        elif w / h >= aspect_ratio:  # slightly wide image
+            sy = w / aspect_ratio / h
+        else:  # slightly tall image
+            sx = h * aspect_ratio / w
+
+    # crop the stretched image, then map the crop back to the original image
+    new_w, new_h = w * sx, h * sy
+    crop_w = min(new_w, int(new_h * aspect_ratio))
+    crop_h = min(new_h, int(new_w / aspect_ratio))
+    x1 = (new_w - crop_w) / 2
+    y1 = (new_h - crop_h) / 2
+    return (x1 / sx, y1 / sy, (x1 + crop_w) / sx, (y1 + crop_h) / sy)
+
+
+def prepare_source(image, animation, w, h, scroll_dist=0.2):
+    """
+    Crop and scale an image, once, into the source that an animation's frames
+    are sampled from: a w x h image for zooms, or an extra wide
+    w / (1 - scroll_dist) x h image for pans. The image is cropped to the
+    source's aspect ratio.
+
+    Parameters
+    ----------
+    image : PIL.Image.Image or str
+        the image, or a path to it.
+    animation : str
+        one of ANIMATIONS.
+    w : int
+        width of the video.
+    h : int
+        height of the video.
+    scroll_dist : float
+        the pan distance (relative to the video width) for pan animations.
+
+    Returns
+    -------
+    source : numpy.ndarray
+        uint8 array of shape (height, width, 3).
+    """
+
+    if isinstance(image, str):
+        image = Image.open(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if animation.startswith('pan'):
+        aspect_corr = 1 / (1 - scroll_dist)  # aspect ratio correction factor for pan animation
+        size = (int(round(aspect_corr * w)), h)
+        box = crop_box(*image.size, aspect_corr * w / h, allow_slight_stretching=True)
+    else:
+        size = (w, h)
+        box = crop_box(*image.size, w / h, allow_slight_stretching=True)
+    return np.asarray(image.resize(size, Image.LANCZOS, box=box))
+
+
+class KenBurns():
+    """
+    Render the frames of an animated (zooming or panning) image by sampling
+    just the window each frame shows from one pre-scaled source image, with a
+    single bilinear crop-and-scale per frame, instead of resizing the whole
+    image every frame.
+
+    Each frame is the source sampled over a window that moves with time:
+        zoom-in     the top left w x h of the source scaled by 1 + 0.02 t
+        zoom-out    the same, scaled by 1 + 0.02 (dur - t) (and 1 at t = 0)
+        pan-right   a (1 - scroll_dist) w wide window moving right at
+                    scroll_dist * w / dur pixels per second, stretched to w
+        pan-left    the same window moving left from the right edge
+    """
+
+    def __init__(self, source, animation, w, h, dur, scroll_dist=0.2):
+        """
+        Parameters
+        ----------
+        source : numpy.ndarray
+            the source image, from prepare_source().
+        animation : str
+            one of ANIMATIONS.
+        w : int
+            width of the frames.
+        h : int
+            height of the frames.
+        dur : float
+            duration of the animation, in seconds.
+        scroll_dist : float
+            the pan distance (relative to the frame width) for pan animations.
+        """
+
+        assert animation in ANIMATIONS, f"animation must be in {ANIMATIONS}, not {animation}"
+        self.source = source
+        self.image = Image.fromarray(source)
+        self.animation = animation
+        self.w, self.h = w, h
+        self.dur = dur
+        self.scroll_dist = scroll_dist
+        self.window_w = int((1 - scroll_dist) * w)  # width of the pan window in the source
+
+    def window(self, t):
+        """
+        Get the part of the source that the frame at time t shows.
+
+        Returns
+        -------
+        x : float
+            left edge of the window in the source.
+        y : float
+            top edge of the window in the source.
+        x_step : float
+            source pixels per frame pixel, horizontally.
+        y_step : float
+            source pixels per frame pixel, vertically.
+        """
+
+        s = self.scroll_dist
+        src_w = self.image.width
+        if self.animation == 'zoom-in':
+            scale = 1 + ZOOM_RATE * t
+            return 0.0, 0.0, 1 / scale, 1 / scale
+        if self.animation == 'zoom-out':
+            scale = 1 if t == 0 else 1 + ZOOM_RATE * (self.dur - t)
+            return 0.0, 0.0, 1 / scale, 1 / scale
+        x_max = src_w - self.window_w - 1
+        x = max(0, min(x_max, round(s * self.w / self.dur * t)))
+        if self.animation == 'pan-left':
+            x = src_w - self.window_w - x
+        return float(x), 0.0, self.window_w / self.w, 1.0
+
+    def frame(self, t):
+        """
+        Render the frame at time t.
+
+        Parameters
+        ----------
+        t : float
+            time, in seconds, from the start of the animation.
+
+        Returns
+        -------
+        frame : numpy.ndarray
+            uint8 array of shape (h, w, 3).
+        """
+
+        x, y, x_step, y_step = self.window(t)
+        box = (x, y, x + self.w * x_step, y + self.h * y_step)
+        return np.asarray(self.image.resize((self.w, self.h), Image.BILINEAR, box=box))
+
+    def trajectory(self, fps):
+        """
+        Get the window (see window()) of every frame at a frame rate, e.g. to
+        check or plot an animation without rendering it.
+
+        Returns
+        -------
+        windows : numpy.ndarray
+            array of shape (number of frames, 4).
+        """
+
+        n = int(round(self.dur * fps))
+        return np.array([self.window(i / fps) for i in range(n)])
@@ -0,0 +1,188 @@
+import os
+import numpy as np
+from PIL import Image
+from cache import make_key
+from animation import prepare_source
+
+
+def crop_thumbnail(image, w, h):
+    """
+    Crop an image to 16:9 (from the center) and scale it to a thumbnail's
+    size.
+
+    Parameters
+    ----------
+    image : PIL.Image.Image
+        the image.
+    w : int
+        width of the thumbnail.
+    h : int
+        height of the thumbnail.
+
+    Returns
+    -------
+    thumbnail : PIL.Image.Image
+    """
+
+    img_w, img_h = image.size
+    new_w = min(img_w, int(img_h * 16 / 9))
+    new_h = min(img_h, int(img_w * 9 / 16))
+    x1 = int((img_w - new_w) / 2)
+    x2 = img_w - x1
+    y1 = int((img_h - new_h) / 2)
+    y2 = img_h - y1
+    return image.crop((x1, y1, x2, y2)).resize((w, h))
+
+
+def video_target(animation, w, h, scroll_dist=0.2):
+    """
+    Get the asset target of a video clip's source image (see
+    animation.prepare_source()). Zoom animations share a source, and so do
+    pans.
+    """
+
+    kind = 'pan' if animation.startswith('pan') else 'zoom'
+    return ('video', kind, w, h, scroll_dist)
+
+
+def thumbnail_target(w, h):
+    """Get the asset target of a thumbnail's background image (see crop_thumbnail())."""
+
+    return ('thumbnail', w, h)
+
+
+def make_asset(image, target):
+    """
+    Crop and scale a decoded image for a target.
+
+    Parameters
+    ----------
+    image : PIL.Image.Image
+        the decoded RGB image.
+    target : tuple
+        from video_target() or thumbnail_target().
+
+    Returns
+    -------
+    asset : numpy.ndarray
+        uint8 array of shape (height, width, 3).
+    """
+
+    if target[0] == 'video':
+        _, kind, w, h, scroll_dist = target
+        return prepare_source(image, 'pan-right' if kind == 'pan' else 'zoom-in', w, h,
+                              scroll_dist=scroll_dist)
+    if target[0] == 'thumbnail':
+        _, w, h = target
+        return np.asarray(crop_thumbnail(image, w, h))
+    raise ValueError(f"unknown asset target {target}")
+
+
+class AssetCache():
+    """
+    Images cropped and scaled for the video (clip sources) and thumbnails,
+    stored as .npy arrays in an ArtifactCache and read back memory-mapped, so
+    each source image is decoded once for every target, and later reads
+    don't decode (or copy) anything. Assets are keyed by the source image's
+    path, mtime, and size, and the target's parameters.
+
+    Safe to use from several threads and processes at once.
+    """
+
+    def __init__(self, cache):
+        """
+        Parameters
+        ----------
+        cache : ArtifactCache
+            cache to store the assets in. Best kept apart from the cache of
+            other stage outputs, since assets are big (uncompressed) and
+            cheap to remake, so they'd evict outputs that are costly to
+            remake (e.g. enhanced images and videos).
+        """
+
+        self.cache = cache
+
+    def key(self, path, target):
+        """Get the cache key of an image's asset for a target."""
+
+        stat = os.stat(path)
+        return make_key('asset', os.path.abspath(path), stat.st_mtime, stat.st_size, *target)
+
+    def load(self, path, target):
+        """
+        Get a cached asset.
+
+        Returns
+        -------
+        asset : numpy.memmap or None
+            read-only array of the asset, or None if it isn't cached.
+        """
+
+        cached_path, _ = self.cache.get(self.key(path, target))
+        if cached_path is None:
+            return None
+        return np.load(cached_path, mmap_mode='r')
+
+    def prepare(self, path, targets, image=None):
+        """
+        Make and cache an image's assets for several targets, decoding the
+        image (at most) once.
+
+        Parameters
+        ----------
+        path : str
+            path to the source image.
+        targets : list
+            targets (from video_target() or thumbnail_target()) to prepare.
+            Targets already cached are skipped.
+        image : PIL.Image.Image
+            the decoded image, or None to decode it from path if needed.
+
+        Returns
+        -------
+        assets : dict
+            the asset of each target prepared, by target.
+        """
+
+        assets = {}
+        for target in targets:
+            key = self.key(path, target)
+            if self.cache.get(key)[0] is not None:
+                continue
+            if image is None:
+                image = Image.open(path)
+                image = image if image.mode == 'RGB' else image.convert('RGB')
+            assets[target] = make_asset(image, target)
+            tmp_path = os.path.join(self.cache.cache_dir, f"{key}.{os.getpid()}.npy")
+            np.save(tmp_path, assets[target])
+            try:
+                self.cache.store(key, tmp_path)
+            finally:
+                os.remove(tmp_path)
+        return assets
+
+    def get(self, path, target, image=None):
+        """
+        Get an image's asset for a target, preparing it if it isn't cached.
+
+        Parameters
+        ----------
+        path : str
+            path to the source image.
+        target : tuple
+            from video_target() or thumbnail_target().
+        image : PIL.Image.Image
+            the decoded image, or None to decode it from path if needed.
+
+        Returns
+        -------
+        asset : numpy.ndarray
+            uint8 array of shape (height, width, 3), memory-mapped if cached.
+        """
+
+        asset = self.load(path, target)
+        if asset is None:
+            asset = self.prepare(path, [target], image).get(target)
+            if asset is None:  # prepared by another process in the meantime
+                asset = self.load(path, target)
+        return asset
@@ -0,0 +1,92 @@
+"""
+Micro-benchmark of extracting attractions from trip advisor pages: the old
+approach of one regex search per rank vs TripAdvisorScrape's single-pass
+extractor.
+
+Usage:
+    python bench_scrape.py [page.html ...]
+
+Pages are saved trip advisor attraction list pages (e.g. bodies recorded with
+run.py's http_mode = 'record'). If none are given, a synthetic multi-megabyte
+page is generated.
+"""
+
+import re
+import sys
+import html
+import time
+import random
+from scrape import TripAdvisorScrape
+
+
+def synthetic_page(n=30, filler_bytes=100_000, seed=0):
+    """
+    Generate a page shaped like trip advisor's attractions list.
+
+    Parameters
+    ----------
+    n : int
+        number of ranked attractions on the page.
+    filler_bytes : int
+        bytes of unrelated markup around each attraction's card.
+    seed : int
+        seed for random number generator.
+    """
+
+    rng = random.Random(seed)
+    filler = ''.join(f'<div class="f{rng.randint(0, 9)}"><span>x</span></div>'
+                     for _ in range(filler_bytes // 36))
+    cards = []
+    for i in range(1, n + 1):
+        reviews = rng.randint(10, 100_000)
+        cards.append(
+            f'<a href="/Attraction_Review-g1-d{i}-Reviews-Place_{i}-City.html">'
+            f'<div class="title"><span>{i}.</span> <!-- -->Place {i} &amp; Co</div></a>'
+            f'<svg aria-label="4.5 of 5 bubbles. {reviews:,} reviews"></svg>'
+            f'<div class="cat">Parks</div>{filler}')
+    return '<html><body>' + filler + ''.join(cards) + '</body></html>'
+
+
+def legacy_extract(html_str, n=30):
+    """The old extractor: one search of the whole page per rank."""
+
+    attractions = []
+    for i in range(1, n + 1):
+        s = re.search(rf'>{i}\.</span> <!-- -->.*?</div>', html_str).group(0)
+        s = s.replace(f'>{i}.</span> <!-- -->', '').replace('</div>', '')
+        attractions.append({'Rank': i, 'Attraction': html.unescape(s)})
+    return attractions
+
+
+def bench(func, repeat=5):
+    """Get the best of several timings of func(), in seconds."""
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1:
+        pages = {}
+        for path in sys.argv[1:]:
+            with open(path, encoding='utf8') as f:
+                pages[path] = f.read()
+    else:
+        pages = {'synthetic': synthetic_page()}
+
+    scraper = TripAdvisorScrape()
+    for name, page in pages.items():
+        found = scraper.extract_attractions(page)
+        n = len(found)
+        assert [d['Attraction'] for d in found] == \
+            [d['Attraction'] for d in legacy_extract(page, n)], "extractors disagree"
+        legacy = bench(lambda: legacy_extract(page, n))
+        single = bench(lambda: scraper.extract_attractions(page))
+        print(f"{name}: {len(page) / 2**20:.1f} MB, {n} attractions")
+        print(f"    per-rank search: {legacy * 1000:8.1f} ms")
+        print(f"    single pass:     {single * 1000:8.1f} ms ({legacy / single:.1f}x faster)")
@@ -1,10 +1,12 @@
 import os
 import urllib.request
 import urllib
-import imghdr
 import posixpath
 import re
-import time
+import math
+from transport import ConnectionPool
+from ratelimit import RateLimiter
+from image_probe import image_size
 
 """
 Python api to download image form Bing.
@@ -13,11 +15,20 @@ Modified by: Steve Hobbs (github.com/sthobbs)
 """
 
 
+# image size shown under each search result, e.g. '1920 x 1080 · jpeg'
+SIZE_PATTERN = re.compile(r'>\s*(\d+)\s*[x×]\s*(\d+)\s*(?:·|&#183;|&middot;)')
+
+# minimum (width, height) of Bing's small, medium, and large size tiers, where
+# an image is in a tier if either dimension is large enough
+SIZE_TIERS = [(0, 0), (200, 200), (500, 500)]
+
+
 class Bing:
     """Bing image downloader class."""
 
     def __init__(self, query, limit, output_dir, adult, timeout, filters='',
-                 query_folder=True, extra_query=''):
+                 query_folder=True, extra_query='', transport=None, min_size=None,
+                 max_aspect_error=None, max_bytes=50 * 2**20):
         """
         Parameters
         ----------
@@ -38,6 +49,22 @@ class Bing:
         extra_query : str
             extra query to append to the search that don't impact
             the output file name.
+        transport : ConnectionPool
+            the HTTP client to make requests with. Share one between Bing
+            objects to reuse connections and apply one politeness budget
+            across all downloads. If None, a new one is made that allows one
+            request per second per host, backing off if a host pushes back.
+        min_size : tuple
+            (width, height) an image must be at least as large as in both
+            dimensions. Smaller images are rejected from their header, before
+            the rest is downloaded. None for no minimum.
+        max_aspect_error : float
+            maximum absolute log-ratio between an image's aspect ratio and
+            16:9 (e.g. log(2) allows 8:9 to 32:9). Images further from 16:9
+            are rejected from their header. None for no limit.
+        max_bytes : int
+            maximum size of an image file, in bytes. Larger downloads are
+            aborted.
         """
 
         self.query = query
@@ -55,6 +82,15 @@ class Bing:
         self.download_count = 0
         self.headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:87.0) Gecko/20100101 Firefox/87.0'}
         self.page_counter = 1
+        if transport is None:
+            rate_limiter = RateLimiter(default_rate=1.0, default_burst=1)
+            transport = ConnectionPool(max_per_host=1, rate_limiter=rate_limiter)
+        self.transport = transport
+        self.min_size = min_size
+        self.max_aspect_error = max_aspect_error
+        self.max_bytes = max_bytes
+        self.chunk_size = 2**16
+        self.probe_bytes = 2**18  # give up finding the dimensions after this many bytes
 
         assert not (not query_folder and limit != 1), \
             "if query_folder==False, then limit must be 1"
@@ -73,13 +109,63 @@ class Bing:
             the path to save the image to
         """
 
-        request = urllib.request.Request(link, None, self.headers)
-        image = urllib.request.urlopen(request, timeout=self.timeout).read()
-        if not imghdr.what(None, image):
-            print(f'[Error]Invalid image, not saving {link}\n')
-            raise
-        with open(file_path, 'wb') as f:
-            f.write(image)
+        with self.transport.open(link, headers=self.headers, timeout=self.timeout) as response:
+
+            # reject files that are too large before downloading them
+            length = response.headers.get('Content-Length')
+            if length is not None and length.isdigit() and int(length) > self.max_bytes:
+                raise Exception(f"image is too large ({length} bytes)")
+
+            # read just enough of the file to find the image's format and size
+            data = b''
+            size = None
+            while size is None:
+                chunk = response.read(self.chunk_size)
+                data += chunk
+                try:
+                    size = image_size(data)
+                except ValueError as e:
+                    raise Exception(f"invalid image ({e})")
+                if size is None and (not chunk or len(data) >= self.probe_bytes):
+                    raise Exception("invalid image (no dimensions found)")
+            self.check_size(*size)
+
+            # stream the rest of the image to disk
+            total = len(data)
+            tmp_path = f"{file_path}.part"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                    for chunk in iter(lambda: response.read(self.chunk_size), b''):
+                        total += len(chunk)
+                        if total > self.max_bytes:
+                            raise Exception(f"image is too large (over {self.max_bytes} bytes)")
+                        f.write(chunk)
+                os.replace(tmp_path, file_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def check_size(self, w, h):
+        """
+        Check that an image's dimensions are acceptable, raising an exception
+        if not.
+
+        Parameters
+        ----------
+        w : int
+            the image's width.
+        h : int
+            the image's height.
+        """
+
+        if w <= 0 or h <= 0:
+            raise Exception(f"invalid image dimensions ({w} x {h})")
+        if self.min_size is not None and (w < self.min_size[0] or h < self.min_size[1]):
+            raise Exception(f"image is too small ({w} x {h})")
+        if self.max_aspect_error is not None and \
+                abs(math.log((w / h) / (16 / 9))) > self.max_aspect_error:
+            raise Exception(f"image aspect ratio is too far from 16:9 ({w} x {h})")
 
     def download_image(self, link):
         """
@@ -118,26 +204,145 @@ class Bing:
             self.download_count -= 1
             print(f"[!] Issue getting: {link}\n[!] Error:: {e}")
 
+    def search_url(self, page, count=None):
+        """
+        Get the URL of a page of Bing image search results for the query.
+
+        Parameters
+        ----------
+        page : int
+            the page number of the results.
+        count : int
+            the number of results to ask for, or None for limit.
+        """
+
+        return 'https://www.bing.com/images/search?q=' \
+               + urllib.parse.quote_plus(self.query + self.extra_query) \
+               + '&form=IRFLTR' \
+               + '&first=' + str(page) \
+               + '&count=' + str(self.limit if count is None else count) \
+               + '&adlt=' + self.adult \
+               + '&qft=' + self.filters  # + '&tsc=ImageBasicHover'
+
+    def search(self, page=1, count=None):
+        """
+        Search Bing for the query and parse the image results, including each
+        image's size where Bing shows it.
+
+        Parameters
+        ----------
+        page : int
+            the page number of the results.
+        count : int
+            the number of results to ask for, or None for limit.
+
+        Returns
+        -------
+        candidates : list
+            list of dicts with 'link', 'width', and 'height' keys, in Bing's
+            ranking order. 'width' and 'height' are None if Bing didn't show
+            the image's size.
+        """
+
+        request_url = self.search_url(page, count)
+        print('Request URL: ' + request_url)
+        response = self.transport.request(request_url, headers=self.headers,
+                                          timeout=self.timeout)
+        html = response.read().decode('utf8')
+
+        # each result's image link is followed by its size (e.g.
+        # '1920 x 1080 · jpeg') before the next result starts
+        matches = list(re.finditer('murl&quot;:&quot;(.*?)&quot;', html))
+        candidates = []
+        for i, m in enumerate(matches):
+            end = matches[i + 1].start() if i + 1 < len(matches) else len(html)
+            size = SIZE_PATTERN.search(html, m.end(), end)
+            width, height = (int(size.group(1)), int(size.group(2))) if size else (None, None)
+            candidates.append({'link': m.group(1), 'width': width, 'height': height})
+        return candidates
+
+    def rank_candidates(self, candidates, target_size=(1920, 1080), aspect_ratio=16/9):
+        """
+        Order candidate images from best to worst. Images are first ranked by
+        Bing's size tier (wallpaper, large, medium, then small, where
+        'wallpaper' means at least target_size), then by how close they are
+        to aspect_ratio, then by resolution, then by Bing's ranking. Images
+        of unknown size come last, in Bing's ranking order.
+
+        Parameters
+        ----------
+        candidates : list
+            list of candidate dicts, from search().
+        target_size : tuple
+            (width, height) an image must be to be in the wallpaper tier.
+        aspect_ratio : float
+            the desired aspect ratio (width / height).
+
+        Returns
+        -------
+        candidates : list
+            the candidates, best first.
+        """
+
+        def key(item):
+            rank, c = item
+            w, h = c['width'], c['height']
+            if not w or not h:
+                return (-1, 0, 0, -rank)
+            if w >= target_size[0] and h >= target_size[1]:
+                tier = 3  # wallpaper
+            else:
+                tier = max(i for i, (min_w, min_h) in enumerate(SIZE_TIERS)
+                           if w >= min_w or h >= min_h)
+            aspect_error = round(abs(math.log((w / h) / aspect_ratio)), 1)
+            return (tier, -aspect_error, w * h, -rank)
+
+        ranked = sorted(enumerate(candidates), key=key, reverse=True)
+        return [c for _, c in ranked]
+
+    def run_best(self, target_size=(1920, 1080), max_tries=5, count=35):
+        """
+        Download the single best image for the query, from one search across
+        all size tiers (see rank_candidates()). If the best image can't be
+        downloaded, the next best is tried.
+
+        Parameters
+        ----------
+        target_size : tuple
+            (width, height) an image must be to be in the top size tier.
+        max_tries : int
+            maximum number of candidates to try downloading.
+        count : int
+            the number of search results to pick from (independent of
+            limit, which is the number of images to download).
+        """
+
+        print(f'\n\n[!!]Indexing page: {self.page_counter}\n')
+        candidates = self.search(self.page_counter, count)
+        print(f"[%] Indexed {len(candidates)} Images on Page {self.page_counter}.")
+        print("\n===============================================\n")
+        # skip candidates that Bing's shown size already rules out
+        ranked = []
+        for c in self.rank_candidates(candidates, target_size):
+            if c['width'] and c['height']:
+                try:
+                    self.check_size(c['width'], c['height'])
+                except Exception:
+                    continue
+            ranked.append(c)
+        for c in ranked[:max_tries]:
+            self.download_image(c['link'])
+            if self.download_count >= 1:
+                break
+
     def run(self):
         """Runs the Bing image downloader."""
 
         while self.download_count < self.limit and self.page_counter < 2:
-            time.sleep(1)  # Sleep for 1 second
             print(f'\n\n[!!]Indexing page: {self.page_counter}\n')
             # Parse the page source and download pics
-            request_url = 'https://www.bing.com/images/search?q=' \
-                          + urllib.parse.quote_plus(self.query + self.extra_query) \
-                          + '&form=IRFLTR' \
-                          + '&first=' + str(self.page_counter) \
-                          + '&count=' + str(self.limit) \
-                          + '&adlt=' + self.adult \
-                          + '&qft=' + self.filters  # + '&tsc=ImageBasicHover'
             print(self.filters)
-            print('Request URL: ' + request_url)
-            request = urllib.request.Request(request_url, None, headers=self.headers)
-            response = urllib.request.urlopen(request)
-            html = response.read().decode('utf8')
-            links = re.findall('murl&quot;:&quot;(.*?)&quot;', html)
+            links = [c['link'] for c in self.search(self.page_counter)]
 
             print(f"[%] Indexed {len(links)} Images on Page {self.page_counter}.")
             print("\n===============================================\n")
@@ -149,5 +354,4 @@ class Bing:
                     print(f"\n\n[%] Done. Downloaded {self.download_count} images.")
                     print("\n===============================================\n")
                     break
-                time.sleep(1)  # Sleep for 1 second
             self.page_counter += 1
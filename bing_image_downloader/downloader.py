@@ -1,6 +1,9 @@
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
+from transport import ConnectionPool
+from ratelimit import RateLimiter
 try:
     from bing import Bing
 except ImportError:  # Python 3
@@ -9,7 +12,7 @@ except ImportError:  # Python 3
 
 def download(query, limit=100, output_dir='dataset', adult_filter_off=True,
              force_replace=False, timeout=60, filters='', query_folder=True,
-             extra_query=''):
+             extra_query='', transport=None):
     """
     Download images from Bing.
 
@@ -34,6 +37,9 @@ def download(query, limit=100, output_dir='dataset', adult_filter_off=True,
     extra_query : str
         extra query to append to the search that don't impact
         the output file name.
+    transport : ConnectionPool
+        the HTTP client to make requests with. If None, requests are made
+        one at a time, at most one per second per host.
     """
 
     adult = 'off' if adult_filter_off else 'on'
@@ -62,9 +68,107 @@ def download(query, limit=100, output_dir='dataset', adult_filter_off=True,
         os.makedirs(path)
 
     bing = Bing(query, limit, output_dir, adult, timeout, filters,
-                query_folder, extra_query)
+                query_folder, extra_query, transport)
     bing.run()
 
 
+def download_best(query, output_dir='dataset', adult_filter_off=True, timeout=60,
+                  filters='', extra_query='', target_size=(1920, 1080), transport=None,
+                  min_size=None, max_aspect_error=None, max_bytes=50 * 2**20):
+    """
+    Download the single best image for a query, picked from one search
+    across all of Bing's size tiers by size and aspect ratio. The image is
+    saved as output_dir/query.ext.
+
+    Parameters
+    ----------
+    query : str
+        the query to search for.
+    output_dir : str
+        the directory to save the image to.
+    adult_filter_off : bool
+        whether to turn off the adult filter.
+    timeout : int
+        the timeout for the request.
+    filters : str
+        the filters to apply to the search. Shouldn't include an image size
+        filter, so that candidates come from every size tier.
+    extra_query : str
+        extra query to append to the search that don't impact
+        the output file name.
+    target_size : tuple
+        (width, height) an image must be to be in the top size tier.
+    transport : ConnectionPool
+        the HTTP client to make requests with. If None, requests are made
+        one at a time, at most one per second per host.
+    min_size : tuple
+        (width, height) an image must be at least as large as. Smaller
+        candidates are rejected from their header. None for no minimum.
+    max_aspect_error : float
+        maximum absolute log-ratio between a candidate's aspect ratio and
+        16:9. None for no limit.
+    max_bytes : int
+        maximum size of an image file, in bytes.
+    """
+
+    adult = 'off' if adult_filter_off else 'on'
+    path = f"{os.getcwd()}\\{output_dir}\\"
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+
+    bing = Bing(query, 1, output_dir, adult, timeout, filters,
+                query_folder=False, extra_query=extra_query, transport=transport,
+                min_size=min_size, max_aspect_error=max_aspect_error, max_bytes=max_bytes)
+    bing.run_best(target_size)
+    if bing.download_count < 1:
+        raise Exception(f"no image downloaded for {query}")
+
+
+def download_many(jobs, workers=8, transport=None, func=None):
+    """
+    Run several downloads in parallel, sharing one HTTP client so that
+    connections are kept alive and reused, and every download counts towards
+    the same per-host politeness budget.
+
+    Parameters
+    ----------
+    jobs : list
+        list of dicts of keyword arguments to pass to func. Each dict's
+        'transport' is set to the shared HTTP client.
+    workers : int
+        maximum number of downloads to run at once.
+    transport : ConnectionPool
+        the HTTP client to share between downloads. If None, a new one is
+        made that allows 4 requests in flight per host, rate limited to 2
+        requests per second to Bing and 4 per second to each image host
+        (backing off if a host pushes back).
+    func : callable
+        the download function to call with each job's arguments, download()
+        or download_best(). Defaults to download().
+
+    Returns
+    -------
+    errors : list
+        the exception raised by each job, or None if it succeeded, in the
+        same order as jobs.
+    """
+
+    if transport is None:
+        rate_limiter = RateLimiter({'www.bing.com': (2.0, 2)}, default_rate=4.0, default_burst=8)
+        transport = ConnectionPool(max_per_host=4, rate_limiter=rate_limiter)
+    if func is None:
+        func = download
+
+    def run(kwargs):
+        try:
+            func(**dict(kwargs, transport=transport))
+        except Exception as e:
+            return e
+        return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run, jobs))
+
+
 if __name__ == '__main__':
     download('cars', limit=10, timeout='1')
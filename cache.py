@@ -0,0 +1,291 @@
+import os
+import time
+import shutil
+import sqlite3
+import hashlib
+import threading
+
+
+def hash_file(path, chunk_size=2**20):
+    """
+    Get the SHA-256 hash of a file's contents.
+
+    Parameters
+    ----------
+    path : str
+        path to the file.
+    chunk_size : int
+        number of bytes to read at a time.
+    """
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_key(*parts):
+    """
+    Make a cache key by hashing a stage's inputs and parameters.
+
+    Parameters
+    ----------
+    *parts : str, bytes, int, float, bool, None, tuple, or list
+        the inputs and parameters that determine the stage's output (e.g. a
+        stage name, file hashes, and settings). Order matters.
+
+    Returns
+    -------
+    key : str
+        hex SHA-256 digest identifying the inputs.
+    """
+
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, bytes):
+            data = part
+        elif isinstance(part, (tuple, list)):
+            data = make_key(*part).encode()
+        else:
+            data = repr(part).encode('utf8')
+        # length-prefix each part so that e.g. ('ab', 'c') != ('a', 'bc')
+        h.update(len(data).to_bytes(8, 'big'))
+        h.update(data)
+    return h.hexdigest()
+
+
+def link_or_copy(src, dst):
+    """
+    Put a file at dst with the same contents as src, as a hard link if
+    possible (no extra disk space or I/O), or else as a copy (e.g. across
+    filesystems). Any existing file at dst is replaced rather than written
+    over, so files linked to it are left untouched.
+
+    Parameters
+    ----------
+    src : str
+        path to the existing file.
+    dst : str
+        path to put the file at.
+
+    Returns
+    -------
+    linked : bool
+        True if dst is a hard link, False if it's a copy.
+    """
+
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return True  # already linked (and renaming onto it would be a no-op)
+    tmp_path = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(src, tmp_path)
+        linked = True
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+        linked = False
+    os.replace(tmp_path, dst)
+    return linked
+
+
+class ArtifactCache():
+    """
+    Content-addressed on-disk cache of stage outputs (e.g. attraction csvs,
+    images, enhanced images, and videos). Each output is stored under a key
+    made from the hash of the inputs and parameters that produced it, so a
+    stage only needs to run when its key is missing. The cache is bounded in
+    size, evicting the least recently used outputs first.
+
+    Safe to use from several threads and processes at once.
+    """
+
+    def __init__(self, cache_dir='cache', max_size=50 * 2**30):
+        """
+        Parameters
+        ----------
+        cache_dir : str
+            directory to store cached outputs and the cache index in.
+        max_size : int
+            maximum total size of cached outputs, in bytes.
+        """
+
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.index_path = os.path.join(cache_dir, 'index.db')
+        self.max_size = max_size
+        os.makedirs(self.objects_dir, exist_ok=True)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS objects (
+                        key TEXT PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        last_access REAL NOT NULL
+                    )""")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.index_path, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _object_path(self, key):
+        return os.path.join(self.objects_dir, key[:2], key)
+
+    def get(self, key, max_age=None):
+        """
+        Look up a cached output, marking it as recently used.
+
+        Parameters
+        ----------
+        key : str
+            the cache key (from make_key()).
+        max_age : float
+            maximum time since the output was stored, in seconds, or None
+            for no limit. Older outputs count as missing (e.g. for outputs
+            of stages whose inputs change over time, like scraped pages).
+
+        Returns
+        -------
+        path : str or None
+            path to the cached output, or None if the key is missing.
+        name : str or None
+            file name of the output when it was cached.
+        """
+
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute("SELECT name FROM objects WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None, None
+                path = self._object_path(key)
+                if not os.path.exists(path):  # removed from disk by hand
+                    conn.execute("DELETE FROM objects WHERE key = ?", (key,))
+                    return None, None
+                if max_age is not None and time.time() - os.path.getmtime(path) > max_age:
+                    return None, None
+                conn.execute("UPDATE objects SET last_access = ? WHERE key = ?",
+                             (time.time(), key))
+            return path, row[0]
+        finally:
+            conn.close()
+
+    def restore(self, key, output_path=None, output_dir=None, max_age=None):
+        """
+        Copy a cached output to where the stage would have written it.
+
+        Parameters
+        ----------
+        key : str
+            the cache key (from make_key()).
+        output_path : str
+            path to copy the output to.
+        output_dir : str
+            directory to copy the output to, under the file name it was cached
+            with. Only used if output_path is None.
+        max_age : float
+            maximum time since the output was stored, in seconds (see get()).
+
+        Returns
+        -------
+        output_path : str or None
+            path the output was copied to, or None if the key is missing.
+        """
+
+        assert output_path is not None or output_dir is not None, \
+            "must provide output_path or output_dir"
+        path, name = self.get(key, max_age=max_age)
+        if path is None:
+            return None
+        if output_path is None:
+            output_path = os.path.join(output_dir, name)
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, output_path)  # don't write through a hard link at output_path
+        return output_path
+
+    def store(self, key, path):
+        """
+        Add a stage output to the cache, then evict the least recently used
+        outputs until the cache fits in max_size.
+
+        Parameters
+        ----------
+        key : str
+            the cache key (from make_key()).
+        path : str
+            path to the stage output to cache.
+        """
+
+        object_path = self._object_path(key)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        tmp_path = f"{object_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(path, tmp_path)
+        try:
+            os.replace(tmp_path, object_path)  # atomic, so readers never see partial files
+        except PermissionError:
+            # another thread or process is storing (or reading) the same key
+            # (e.g. on Windows); the outputs of the same key are the same
+            os.remove(tmp_path)
+            if not os.path.exists(object_path):
+                raise
+        size = os.path.getsize(object_path)
+        name = os.path.basename(path.replace('\\', '/'))
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO objects (key, name, size, last_access) "
+                    "VALUES (?, ?, ?, ?)", (key, name, size, time.time()))
+            self.evict(conn)
+        finally:
+            conn.close()
+
+    def evict(self, conn=None):
+        """
+        Remove least recently used outputs until the cache fits in max_size.
+
+        Parameters
+        ----------
+        conn : sqlite3.Connection
+            open connection to the cache index. A new one is opened if None.
+        """
+
+        close = conn is None
+        if close:
+            conn = self._connect()
+        try:
+            with conn:
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+                if total <= self.max_size:
+                    return
+                rows = conn.execute(
+                    "SELECT key, size FROM objects ORDER BY last_access").fetchall()
+                for key, size in rows:
+                    if total <= self.max_size:
+                        break
+                    try:
+                        os.remove(self._object_path(key))
+                    except FileNotFoundError:
+                        pass
+                    except PermissionError:  # in use (e.g. memory-mapped on Windows)
+                        continue
+                    conn.execute("DELETE FROM objects WHERE key = ?", (key,))
+                    total -= size
+        finally:
+            if close:
+                conn.close()
+
+    def size(self):
+        """Get the total size of cached outputs, in bytes."""
+
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+        finally:
+            conn.close()
@@ -0,0 +1,216 @@
+import time
+import contextlib
+import subprocess
+import numpy as np
+from tqdm import tqdm
+from moviepy.config import get_setting
+
+
+# encoder settings by name: ffmpeg codec, preset (speed vs size), CRF
+# (constant quality, lower is better), and pixel format
+PROFILES = {
+    'mpeg4': {'codec': 'mpeg4', 'preset': None, 'crf': None, 'pix_fmt': 'yuv420p'},
+    'x264': {'codec': 'libx264', 'preset': 'medium', 'crf': 20, 'pix_fmt': 'yuv420p'},
+    'x264-fast': {'codec': 'libx264', 'preset': 'veryfast', 'crf': 22, 'pix_fmt': 'yuv420p'},
+    'draft': {'codec': 'libx264', 'preset': 'ultrafast', 'crf': 30, 'pix_fmt': 'yuv420p'},
+    'x265': {'codec': 'libx265', 'preset': 'medium', 'crf': 24, 'pix_fmt': 'yuv420p'},
+    'x265-small': {'codec': 'libx265', 'preset': 'slow', 'crf': 26, 'pix_fmt': 'yuv420p'},
+}
+
+
+def get_profile(profile):
+    """
+    Get encoder settings.
+
+    Parameters
+    ----------
+    profile : str or dict
+        a name in PROFILES, or a dict of settings (any of 'codec', 'preset',
+        'crf', and 'pix_fmt'; the rest default to the 'x264' profile's).
+
+    Returns
+    -------
+    profile : dict
+    """
+
+    if isinstance(profile, str):
+        assert profile in PROFILES, f"profile must be in {list(PROFILES)}, not {profile}"
+        return dict(PROFILES[profile])
+    return {**PROFILES['x264'], **profile}
+
+
+class FFmpegWriter():
+    """
+    Encode raw RGB frames by streaming them straight into an ffmpeg process's
+    stdin. Frames are written from their own buffers (no per-frame copies),
+    so the encoder works on one frame while the next is rendered.
+
+    Use as a context manager, or call close() when done.
+    """
+
+    def __init__(self, output_path, w, h, fps, profile='x264', audio_path=None, threads=None):
+        """
+        Parameters
+        ----------
+        output_path : str
+            path to save the video to.
+        w : int
+            width of the frames.
+        h : int
+            height of the frames.
+        fps : int
+            frames per second.
+        profile : str or dict
+            encoder settings (see get_profile()).
+        audio_path : str
+            path to an audio file to add to the video (copied as is), or None
+            for no audio.
+        threads : int
+            threads for the encoder, or None for ffmpeg's default.
+        """
+
+        self.output_path = output_path
+        self.w, self.h = w, h
+        self.fps = fps
+        self.profile = get_profile(profile)
+        cmd = [get_setting("FFMPEG_BINARY"), '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f"{w}x{h}", '-r', str(fps), '-i', '-']
+        if audio_path is not None:
+            cmd += ['-i', audio_path, '-map', '0:v', '-map', '1:a', '-c:a', 'copy']
+        cmd += ['-c:v', self.profile['codec'], '-pix_fmt', self.profile['pix_fmt']]
+        if self.profile['preset'] is not None:
+            cmd += ['-preset', self.profile['preset']]
+        if self.profile['crf'] is not None:
+            cmd += ['-crf', str(self.profile['crf'])]
+        if threads is not None:
+            cmd += ['-threads', str(threads)]
+        cmd.append(output_path)
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.PIPE)
+        self.frames = 0
+        self.start = time.time()
+        self.elapsed = None
+
+    def write(self, frame):
+        """
+        Encode a frame.
+
+        Parameters
+        ----------
+        frame : numpy.ndarray
+            uint8 array of shape (h, w, 3).
+        """
+
+        assert frame.shape == (self.h, self.w, 3), \
+            f"frame must be {self.w} x {self.h} RGB, not shape {frame.shape}"
+        if frame.dtype != np.uint8:
+            frame = frame.astype(np.uint8)
+        try:
+            self.proc.stdin.write(np.ascontiguousarray(frame).data)
+        except BrokenPipeError:
+            self.close()  # raises with ffmpeg's error
+            raise
+        self.frames += 1
+
+    def close(self):
+        """
+        Finish encoding and report the encoding speed.
+
+        Raises
+        ------
+        Exception
+            if ffmpeg failed.
+        """
+
+        if self.elapsed is not None:
+            return
+        self.proc.stdin.close()
+        error = self.proc.stderr.read().decode(errors='replace')
+        self.proc.stderr.close()
+        code = self.proc.wait()
+        self.elapsed = time.time() - self.start
+        if code != 0:
+            raise Exception(f"ffmpeg failed encoding {self.output_path}: {error.strip()}")
+        print(f"encoded {self.frames} frames of {self.output_path} in {self.elapsed:.1f}s "
+              f"({self.frames / max(self.elapsed, 1e-9):.1f} fps, {self.profile['codec']})")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:  # don't leave a half-written video behind an ffmpeg that's still waiting
+            self.proc.kill()
+            self.proc.wait()
+
+
+def encode_clips(clips, output_paths, fps, profiles, audio_path=None, threads=None,
+                 progress=True, frame_step=1):
+    """
+    Render several moviepy clips (e.g. the same video at different sizes) in
+    one pass over time, each into its own FFmpegWriter, so the encoders run
+    in parallel. Frames are taken at the same times VideoClip.write_videofile()
+    would, and a clip shared by several outputs (e.g. with different codecs or
+    frame rates) renders each frame once.
+
+    Parameters
+    ----------
+    clips : list
+        the VideoClip of each output.
+    output_paths : list
+        path to save each output to.
+    fps : list
+        frames per second of each output.
+    profiles : list
+        encoder settings of each output (see get_profile()).
+    audio_path : str
+        path to an audio file to add to every output, or None for no audio.
+    threads : int
+        threads for each encoder, or None for ffmpeg's default.
+    progress : bool
+        whether to show a progress bar.
+    frame_step : int
+        render only every frame_step-th frame of each output, and write it
+        again in place of the frames skipped (e.g. for quick drafts).
+
+    Returns
+    -------
+    writers : list
+        the closed FFmpegWriter of each output.
+    """
+
+    # frame times of every output, merged so frames at the same time are rendered together
+    times = {}
+    for i, (clip, clip_fps) in enumerate(zip(clips, fps)):
+        clip_times = np.arange(0, clip.duration, 1.0 / clip_fps)
+        for j in range(len(clip_times)):
+            t = clip_times[j - j % frame_step]
+            times.setdefault(round(t, 6), []).append((i, t))
+
+    with contextlib.ExitStack() as stack:
+        writers = [stack.enter_context(FFmpegWriter(path, clip.w, clip.h, clip_fps, profile=profile,
+                                                    audio_path=audio_path, threads=threads))
+                   for clip, path, clip_fps, profile in zip(clips, output_paths, fps, profiles)]
+        for key in tqdm(sorted(times), disable=not progress):
+            frames = {}  # by clip, for outputs sharing a clip
+            for i, t in times[key]:
+                if id(clips[i]) not in frames:
+                    frames[id(clips[i])] = clips[i].get_frame(t)
+                writers[i].write(frames[id(clips[i])])
+    return writers
+
+
+def encode_clip(clip, output_path, fps, profile='x264', audio_path=None, threads=None,
+                progress=True):
+    """
+    Render a moviepy clip into an FFmpegWriter. See encode_clips().
+
+    Returns
+    -------
+    FFmpegWriter
+        the closed writer, with the number of frames and seconds taken.
+    """
+
+    return encode_clips([clip], [output_path], [fps], [profile], audio_path=audio_path,
+                        threads=threads, progress=progress)[0]
@@ -16,26 +16,289 @@
 
 import os
 import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from PIL import Image
 import numpy as np
 import tensorflow as tf
-import tensorflow_hub as hub
-import matplotlib.pyplot as plt
 from pathlib import Path
+from cache import make_key, hash_file, link_or_copy
+from image_probe import image_format
 
 os.environ["TFHUB_DOWNLOAD_PROGRESS"] = "True"
 
-SAVED_MODEL_PATH = "https://tfhub.dev/captain-pool/esrgan-tf2/1"
-model = hub.load(SAVED_MODEL_PATH)
+# ESRGAN model to use, either a TF Hub URL or a local SavedModel directory
+# (e.g. a downloaded copy of the TF Hub model, to avoid fetching it)
+SAVED_MODEL_PATH = os.environ.get("ESRGAN_MODEL_PATH", "https://tfhub.dev/captain-pool/esrgan-tf2/1")
+
+# models loaded so far in this process, by path, shared by all Enhance objects
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_model(model_path=None):
+    """ Loads the ESRGAN model the first time it's needed, then reuses it for the rest of the process
+        Args:
+            model_path: TF Hub URL or local SavedModel directory of the model. Defaults to SAVED_MODEL_PATH.
+    """
+    if model_path is None:
+        model_path = SAVED_MODEL_PATH
+    with _models_lock:
+        if model_path not in _models:
+            if os.path.isdir(model_path):  # local SavedModel, no need for TF Hub
+                _models[model_path] = tf.saved_model.load(model_path)
+            else:
+                import tensorflow_hub as hub
+                _models[model_path] = hub.load(model_path)
+        return _models[model_path]
+
+
+class StageStats():
+    """ Thread-safe running totals of the time spent and items handled by each stage of a pipeline
+    """
+
+    def __init__(self):
+        self.busy = collections.OrderedDict()
+        self.items = collections.defaultdict(int)
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def time(self, stage, items=1):
+        """ Times a block of work for a stage.
+            Args:
+                stage: Name of the stage.
+                items: Number of images the block handles.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.busy[stage] = self.busy.get(stage, 0.0) + elapsed
+                self.items[stage] += items
+
+    def report(self):
+        """ Prints each stage's busy time and throughput, and the total wall time
+        """
+        wall = time.perf_counter() - self.start
+        for stage, busy in self.busy.items():
+            n = self.items[stage]
+            rate = n / busy if busy > 0 else float('inf')
+            print(f"{stage:>8}: {n:4d} images, {busy:7.2f}s busy, {rate:6.2f} images/s")
+        print(f"{'total':>8}: {wall:7.2f}s")
+
+
+class RowResizer():
+    """ Lanczos resizes an image that's made a strip of rows at a time, from top to bottom, holding
+        only the rows the next output rows depend on (and the output). The same, to within rounding,
+        as resizing the whole image with PIL, which also resizes horizontally, then vertically.
+    """
+
+    def __init__(self, src_size, size=None):
+        """
+        Args:
+            src_size: (width, height) of the image.
+            size: (width, height) to resize it to, or None to keep its size.
+        """
+        self.src_w, self.src_h = src_size
+        self.w, self.h = src_size if size is None else size
+        self.scale = self.src_h / self.h  # source rows per output row
+        self.support = 3 * max(self.scale, 1)  # source rows on each side that an output row depends on
+        self.rows = np.empty((0, self.w, 3), np.uint8)  # horizontally resized source rows still needed
+        self.start = 0  # source row of rows[0]
+        self.out = np.empty((self.h, self.w, 3), np.uint8)
+        self.done = 0  # output rows resized so far
+
+    def add(self, strip):
+        """ Adds the next strip of rows, resizing every output row that they finish
+            Args:
+                strip: uint8 array of shape (rows, src_w, 3).
+        """
+        if self.src_w != self.w:
+            strip = np.asarray(Image.fromarray(strip).resize((self.w, len(strip)), Image.LANCZOS))
+        self.rows = np.concatenate([self.rows, strip])
+        end = self.start + len(self.rows)
+        if end >= self.src_h:
+            n = self.h
+        else:  # output rows whose source rows are all in
+            n = min(self.h, max(self.done, int(np.floor((end - self.support - 1) / self.scale - 0.5)) + 1))
+        if n == self.done:
+            return
+        if self.scale == 1:
+            self.out[self.done:n] = self.rows[self.done - self.start:n - self.start]
+        else:
+            box = (0, self.done * self.scale - self.start, self.w, n * self.scale - self.start)
+            self.out[self.done:n] = np.asarray(Image.fromarray(self.rows).resize(
+                (self.w, n - self.done), Image.LANCZOS, box=box))
+        self.done = n
+        # drop the rows that the output rows left don't depend on
+        first = max(0, int((self.done + 0.5) * self.scale - self.support) - 1)
+        if first > self.start:
+            self.rows = self.rows[first - self.start:]
+            self.start = first
+
+    def image(self):
+        """ The resized image, once every row is added
+        """
+        assert self.done == self.h, "not all rows were added"
+        return Image.fromarray(self.out)
+
+
+def enhance_many(enhancers, batch_size=None, prefetch=None, io_workers=None):
+    """ Enhances the images of several Enhance objects (e.g. several jobs sent to an enhancement
+        worker) in one streaming pipeline: images are decoded ahead of the model on a thread pool,
+        same-sized images are enhanced in batches (across Enhance objects that use the same model),
+        and enhanced images are encoded and written on a thread pool while the model works on the
+        next ones. Prints the throughput of each stage at the end.
+        Args:
+            enhancers: List of Enhance objects.
+            batch_size: Maximum number of same-sized images to pass to the model at once.
+                Defaults to the first Enhance object's batch_size, as do prefetch and io_workers.
+            prefetch: Number of images to decode ahead of the model.
+            io_workers: Number of threads decoding images, and writing enhanced ones.
+    """
+    if not enhancers:
+        return
+    batch_size = enhancers[0].batch_size if batch_size is None else batch_size
+    prefetch = enhancers[0].prefetch if prefetch is None else prefetch
+    io_workers = enhancers[0].io_workers if io_workers is None else io_workers
+    stats = StageStats()
+    todo = []  # (Enhance object, image_path, cache key) of images for the model
+    with ThreadPoolExecutor(io_workers) as decode_pool, ThreadPoolExecutor(io_workers) as write_pool:
+        writes = collections.deque()
+
+        def write(enhancer, image_path, key, enhanced):
+            # wait for old writes if they're falling behind, so enhanced images don't pile up in memory
+            while len(writes) >= prefetch + io_workers:
+                writes.popleft().result()
+            writes.append(write_pool.submit(enhancer.write, stats, image_path, key, enhanced))
+
+        for enhancer in enhancers:
+            for image_path in enhancer.image_paths:
+                key = enhancer.cache_key(image_path) if enhancer.cache is not None else None
+                if enhancer.restore(image_path, key):
+                    continue
+                if enhancer.should_enhance(image_path):
+                    todo.append((enhancer, image_path, key))
+                else:
+                    write(enhancer, image_path, key, None)
+
+        # group same-sized images for the same model together so they can be batched
+        todo.sort(key=lambda item: (item[0].model_path, item[0].model_shape(item[1])))
+
+        def decode(enhancer, image_path):
+            with stats.time('decode'):
+                return enhancer.preprocess_image(image_path)
+
+        def flush(batch):
+            if not batch:
+                return
+            with stats.time('infer', len(batch)):
+                images = [image for _, _, _, image in batch]
+                model = get_model(batch[0][0].model_path)
+                enhanced = model(tf.cast(tf.concat(images, 0) if len(images) > 1 else images[0], tf.float32))
+                enhanced = [enhanced[i] for i in range(len(batch))]
+            for (enhancer, image_path, key, _), image in zip(batch, enhanced):
+                write(enhancer, image_path, key, image)
+            batch.clear()
+
+        # decode up to `prefetch` images ahead of the model
+        pending = collections.deque()
+        queue = iter(todo)
+
+        def fill():
+            while len(pending) < prefetch:
+                item = next(queue, None)
+                if item is None:
+                    return
+                pending.append((*item, decode_pool.submit(decode, item[0], item[1])))
+
+        fill()
+        batch = []
+        while pending:
+            enhancer, image_path, key, future = pending.popleft()
+            fill()
+            image = future.result()
+            if enhancer.is_tiled(image):
+                flush(batch)
+                with stats.time('infer'):
+                    enhanced = enhancer.enhance_tiled(image, size=enhancer.output_size(image_path))
+                write(enhancer, image_path, key, enhanced)
+                continue
+            if batch and (batch[0][0].model_path != enhancer.model_path
+                          or batch[0][3].shape != image.shape or len(batch) >= batch_size):
+                flush(batch)
+            batch.append((enhancer, image_path, key, image))
+        flush(batch)
+
+        while writes:
+            writes.popleft().result()
+    stats.report()
+
 
 class Enhance():
 
-    def __init__(self, input_dir, output_dir, max_size_to_enhance=None):
+    def __init__(self, input_dir, output_dir, max_size_to_enhance=None, cache=None, model_path=None,
+                 tile_size=512, tile_overlap=32, batch_size=4, prefetch=4, io_workers=2,
+                 target_size=None, lanczos_max_scale=2.0, passthrough=True, passthrough_min_scale=0.5,
+                 index=None):
+        """
+        Args:
+            input_dir: Directory of images to enhance.
+            output_dir: Directory to save enhanced images to.
+            max_size_to_enhance: (width, height) of the largest image to enhance,
+                larger images are copied to output_dir. None to enhance all images.
+            cache: ArtifactCache to reuse enhanced images from, or None.
+            model_path: TF Hub URL or local SavedModel directory of the ESRGAN model.
+                Defaults to SAVED_MODEL_PATH. The model is loaded when it's first used.
+            tile_size: Largest height and width (in input pixels) to pass to the model at once.
+                Larger images are enhanced in overlapping tiles that are blended together
+                and streamed into the resize to the output size, so the model's memory use
+                doesn't grow with the image's size. None to always enhance the whole image at once.
+            tile_overlap: Number of input pixels that neighbouring tiles overlap by.
+            batch_size: Maximum number of same-sized images to pass to the model at once.
+            prefetch: Number of images to decode ahead of the model.
+            io_workers: Number of threads decoding images, and writing enhanced ones.
+            target_size: (width, height) that images will be shown at (e.g. the video resolution),
+                or None. If given, each image is scaled so its centre crop to the target's aspect
+                ratio is exactly target_size, and max_size_to_enhance is ignored: images already
+                big enough are downscaled once, images that need at most lanczos_max_scale times
+                more pixels per side are upscaled with Lanczos, and only smaller images go through
+                ESRGAN (then are resized to fit).
+            lanczos_max_scale: Largest upscale done with Lanczos rather than ESRGAN.
+            passthrough: Whether to hard link (or copy) RGB JPEGs that don't need enhancing or
+                resizing into output_dir as they are, rather than re-encoding them. With a
+                target_size, images up to 1 / passthrough_min_scale times bigger than the
+                target are passed through, and only bigger ones are downscaled.
+            passthrough_min_scale: Smallest target scale (see target_scale()) of passed through images.
+            index: ImageIndex to reuse enhanced versions of the same picture from (e.g. made for
+                another location), and to record enhanced images in, or None.
+        """
         self.image_paths = [f"{input_dir}\\{file}" for file in os.listdir(input_dir) if os.path.isfile(f"{input_dir}\\{file}")]
         self.output_dir = output_dir
         if not os.path.exists(output_dir):
             os.makedirs(output_dir) 
         self.max_size_to_enhance = max_size_to_enhance
+        self.cache = cache
+        self.model_path = SAVED_MODEL_PATH if model_path is None else model_path
+        if tile_size is not None:
+            assert tile_size % 4 == 0 and tile_overlap % 4 == 0, "tile_size and tile_overlap must be multiples of 4"
+            assert 0 <= tile_overlap < tile_size // 2, "tile_overlap must be less than half of tile_size"
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        assert batch_size >= 1 and prefetch >= 1 and io_workers >= 1
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.io_workers = io_workers
+        self.target_size = target_size
+        self.lanczos_max_scale = lanczos_max_scale
+        self.passthrough = passthrough
+        self.passthrough_min_scale = passthrough_min_scale
+        self.index = index
 
 
     def preprocess_image(self, image_path):
@@ -50,19 +313,21 @@ class Enhance():
             hr_image = hr_image[...,:-1]
         hr_size = (tf.convert_to_tensor(hr_image.shape[:-1]) // 4) * 4
         hr_image = tf.image.crop_to_bounding_box(hr_image, 0, 0, hr_size[0], hr_size[1])
-        hr_image = tf.cast(hr_image, tf.float32)
-        return tf.expand_dims(hr_image, 0)
+        return tf.expand_dims(hr_image, 0)  # uint8, cast to float for the model a batch or tile at a time
 
-    def save_image(self, image, file_name):
+    def save_image(self, image, file_name, size=None):
         """
         Saves unscaled Tensor Images.
         Args:
             image: 3D image tensor. [height, width, channels]
             file_name: Name of the file to save to.
+            size: (width, height) to resize the image to before saving, or None.
         """
         if not isinstance(image, Image.Image):
             image = tf.clip_by_value(image, 0, 255)
             image = Image.fromarray(tf.cast(image, tf.uint8).numpy())
+        if size is not None and image.size != size:
+            image = image.resize(size, Image.LANCZOS)
         image.save(f"{self.output_dir}\\{file_name}.jpg")
         print(f"Saved enhanced image as {file_name}.jpg")
 
@@ -73,6 +338,7 @@ class Enhance():
             image: 3D image tensor. [height, width, channels].
             title: Title to display in the plot.
         """
+        import matplotlib.pyplot as plt
         image = np.asarray(image)
         image = tf.clip_by_value(image, 0, 255)
         image = Image.fromarray(tf.cast(image, tf.uint8).numpy())
@@ -81,34 +347,281 @@ class Enhance():
         plt.title(title)
 
     def enhance_images(self):
-        for image_path in self.image_paths:
-            self.enhance_if_small(image_path)
+        """ Enhances every image in input_dir in a streaming pipeline: images are decoded ahead of
+            the model on a thread pool, same-sized images are enhanced in batches, and enhanced
+            images are encoded and written on a thread pool while the model works on the next ones.
+            Prints the throughput of each stage at the end.
+        """
+        enhance_many([self])
+
+    def remove_output(self, image_path):
+        """ Removes an image's old output before writing a new one, in case it's a hard link to another file
+        """
+        if os.path.exists(self.output_path(image_path)):
+            os.remove(self.output_path(image_path))
+
+    def output_path(self, image_path):
+        """ Path that an image's enhanced (or copied) version is saved to
+        """
+        file_name =  '.'.join(Path(image_path).name.split('.')[:-1]) # file name after removing the .jpg or other extension
+        return f"{self.output_dir}\\{file_name}.jpg"
+
+    def model_shape(self, image_path):
+        """ (height, width) of an image after it's cropped for the model, read from its header
+        """
+        with Image.open(image_path) as img:
+            w, h = img.size
+        return (h // 4 * 4, w // 4 * 4)
+
+    def is_tiled(self, image):
+        """ Whether a preprocessed image is too big to pass to the model at once
+        """
+        _, h, w, _ = image.shape
+        return self.tile_size is not None and (h > self.tile_size or w > self.tile_size)
+
+    def target_scale(self, w, h):
+        """ Factor to scale a w x h image by so its centre crop to target_size's aspect ratio is target_size
+        """
+        target_w, target_h = self.target_size
+        crop_w = min(w, h * target_w / target_h)
+        return target_w / crop_w
+
+    def output_size(self, image_path):
+        """ (width, height) to save an image's enhanced version at, or None to keep the model's output size
+        """
+        if self.target_size is None:
+            return None
+        with Image.open(image_path) as img:
+            w, h = img.size
+        scale = self.target_scale(w, h)
+        return (max(1, round(w * scale)), max(1, round(h * scale)))
+
+    def should_enhance(self, image_path):
+        """ Whether an image is small enough to enhance with ESRGAN, rather than copy or resample
+        """
+        with Image.open(image_path) as img:
+            w, h = img.size
+        if self.target_size is not None:
+            return self.target_scale(w, h) > self.lanczos_max_scale
+        if self.max_size_to_enhance is None: # enhance if no size restriction on enhancement
+            return True
+        max_w, max_h = self.max_size_to_enhance
+        return w <= max_w or h <= max_h
+
+    def can_pass_through(self, image_path):
+        """ Whether an image that isn't enhanced with ESRGAN can be used as it is, without re-encoding
+        """
+        if not self.passthrough:
+            return False
+        with open(image_path, 'rb') as f:
+            if image_format(f.read(12)) != 'jpeg':
+                return False
+        with Image.open(image_path) as img:  # only reads the header
+            mode, size = img.mode, img.size
+        if mode != 'RGB':
+            return False
+        if self.target_size is None:
+            return True
+        return self.passthrough_min_scale <= self.target_scale(*size) <= 1
+
+    def copy_image(self, image_path):
+        """ Saves an image that isn't enhanced with ESRGAN, passing it through as it is if possible,
+            otherwise re-encoding it as a JPEG (resampled to output_size() if there's a target size)
+        """
+        file_name = Path(self.output_path(image_path)).stem
+        if self.can_pass_through(image_path):
+            linked = link_or_copy(image_path, self.output_path(image_path))
+            print(f"{'Linked' if linked else 'Copied'} as {file_name}.jpg")
+            return
+        self.remove_output(image_path)
+        size = self.output_size(image_path)
+        with Image.open(image_path) as img:
+            if size is not None:
+                if img.mode != 'RGB':
+                    img = img.convert('RGB')
+                if img.size != size:
+                    img = img.resize(size, Image.LANCZOS)
+            img.save(self.output_path(image_path), "jpeg")
+        print(f"Saved as {file_name}.jpg")
+
+    def write(self, stats, image_path, key, enhanced):
+        """ Saves an enhanced image, or copies an image that's too big to enhance, then caches and indexes it
+            Args:
+                stats: StageStats to time the write with.
+                image_path: Path of the original image.
+                key: Cache key to store the saved image under, or None.
+                enhanced: 3D enhanced image tensor or PIL Image, or None to copy (or resample) the original image.
+        """
+        with stats.time('write'):
+            if enhanced is None:
+                self.copy_image(image_path)
+            else:
+                file_name = Path(self.output_path(image_path)).stem
+                self.remove_output(image_path)
+                self.save_image(enhanced, file_name=file_name, size=self.output_size(image_path))
+            self.record(image_path, key)
+
+    def settings(self):
+        """ The enhance settings that affect enhanced images
+        """
+        return (self.max_size_to_enhance, self.model_path, self.tile_size, self.tile_overlap,
+                self.target_size, self.lanczos_max_scale, self.passthrough, self.passthrough_min_scale)
+
+    def settings_key(self):
+        """ Key for the enhance settings, to find enhanced images made with the same settings in the index
+        """
+        return make_key('enhance', *self.settings())
+
+    def cache_key(self, image_path):
+        """ Cache key for an image's enhanced output, from the image's bytes and the enhance settings
+        """
+        return make_key('enhance', hash_file(image_path), *self.settings())
+
+    def restore(self, image_path, key=None):
+        """ Restores an image's enhanced output from the cache, or links to an enhanced version of
+            the same picture in the index
+            Args:
+                image_path: Path of the original image.
+                key: The image's cache key, or None if there's no cache.
+            Returns:
+                Whether the output was restored.
+        """
+        output_path = self.output_path(image_path)
+        if key is not None and self.cache.restore(key, output_path) is not None:
+            print(f"Restored {Path(output_path).name} from cache")
+            return True
+        if self.index is not None:
+            enhanced_path = self.index.find_enhanced(image_path, self.settings_key())
+            if enhanced_path is not None:
+                link_or_copy(enhanced_path, output_path)
+                print(f"Reused {Path(output_path).name} from {enhanced_path}")
+                self.record(image_path, None)
+                return True
+        return False
+
+    def record(self, image_path, key=None):
+        """ Stores an image's enhanced output in the cache (if there's a key) and the index
+        """
+        output_path = self.output_path(image_path)
+        if key is not None:
+            self.cache.store(key, output_path)
+        if self.index is not None:
+            self.index.add_enhanced(image_path, self.settings_key(), output_path)
 
     def enhance_if_small(self, image_path):
         """ Enhances image if it's small enough to enhance, otherwise just write the image to ourput_dir
         """
-        if self.max_size_to_enhance is None: # enhance if no size restriction on enhancement
-            self.enhance_image(image_path)
+        key = self.cache_key(image_path) if self.cache is not None else None
+        if self.restore(image_path, key):
+            return
+        self._enhance_if_small(image_path)
+        self.record(image_path, key)
 
-        else:
-            # open image
-            img = Image.open(image_path)
-            w, h = img.size
-            max_w, max_h = self.max_size_to_enhance
-            if w <= max_w or h <= max_h: # enahnce if image is small enough
-                self.enhance_image(image_path)
-            else: # save existing image to new location
-                file_name =  '.'.join(Path(image_path).name.split('.')[:-1]) # file name after removing the .jpg or other extension
-                output_path = f"{self.output_dir}\\{file_name}.jpg"
-                img.save(output_path, "jpeg")
-                print(f"Saved as {file_name}.jpg")
+    def _enhance_if_small(self, image_path):
+        if self.should_enhance(image_path): # enahnce if image is small enough
+            self.enhance_image(image_path)
+        else: # save existing image to new location
+            self.copy_image(image_path)
 
     def enhance_image(self, image_path):
         file_name =  '.'.join(Path(image_path).name.split('.')[:-1]) # file name after removing the .jpg or other extension
+        self.remove_output(image_path)
         image = self.preprocess_image(image_path)
-        enhanced_image = model(image)
-        enhanced_image = tf.squeeze(enhanced_image)
-        self.save_image(enhanced_image, file_name=file_name)
+        if not self.is_tiled(image):
+            enhanced_image = get_model(self.model_path)(tf.cast(image, tf.float32))
+            enhanced_image = tf.squeeze(enhanced_image)
+        else:
+            enhanced_image = self.enhance_tiled(image, size=self.output_size(image_path))
+        self.save_image(enhanced_image, file_name=file_name, size=self.output_size(image_path))
+
+    @staticmethod
+    def tile_starts(length, tile_size, overlap):
+        """ Start positions of overlapping tiles covering a length, with the last tile flush with the end
+        """
+        if length <= tile_size:
+            return [0]
+        starts = list(range(0, length - tile_size, tile_size - overlap))
+        return starts + [length - tile_size]
+
+    @staticmethod
+    def blend_ramp(length, overlap, lead, trail):
+        """ 1D blending weights for a tile, ramping up over its leading overlap and down over its trailing overlap
+            Args:
+                length: Length of the tile.
+                overlap: Length of the ramps.
+                lead: Whether the tile overlaps the previous tile.
+                trail: Whether the tile overlaps the next tile.
+        """
+        ramp = np.ones(length, np.float32)
+        if overlap > 0:
+            edge = (np.arange(overlap, dtype=np.float32) + 0.5) / overlap
+            if lead:
+                ramp[:overlap] = np.minimum(ramp[:overlap], edge)
+            if trail:
+                ramp[-overlap:] = np.minimum(ramp[-overlap:], edge[::-1])
+        return ramp
+
+    def enhance_tiled(self, image, size=None):
+        """ Enhances an image in overlapping tiles, blending the seams between them
+            Each tile's leading ramps start where the previous tile's trailing ramps do, so the
+            weights at every pixel sum to 1 and each pixel is finished as soon as the tiles over it
+            are. Tiles are blended one at a time, and finished rows are streamed into the resize to
+            size, so the floats held are one tile plus the overlaps carried to the next tile and the
+            next row of tiles, and the whole output is only held at its final size.
+            Args:
+                image: 4D uint8 image tensor. [1, height, width, channels]
+                size: (width, height) to resize the enhanced image to, or None to keep the model's output size.
+            Returns:
+                The enhanced image as a PIL Image.
+        """
+        model = get_model(self.model_path)
+        _, h, w, _ = image.shape
+        tile, overlap = self.tile_size, self.tile_overlap
+        ys = self.tile_starts(h, tile, overlap)
+        xs = self.tile_starts(w, tile, overlap)
 
+        resizer = None
+        top = 0  # rows above top are finished
+        carry = None  # weighted rows [top, top + overlap) from the last row of tiles
+        for yi, y0 in enumerate(ys):
+            last_row = yi == len(ys) - 1
+            th = min(tile, h - y0)
+            y1 = h if last_row else y0 + th - overlap  # rows [top, y1) are finished by this row of tiles
+            left = 0  # columns left of left are finished
+            window = None  # weighted columns [left, end of the last tile) of this row of tiles
+            for xi, x0 in enumerate(xs):
+                last_col = xi == len(xs) - 1
+                tw = min(tile, w - x0)
+                x1 = w if last_col else x0 + tw - overlap
+                enhanced = model(tf.cast(image[:, y0:y0 + th, x0:x0 + tw, :], tf.float32))
+                enhanced = np.clip(tf.squeeze(enhanced, 0).numpy(), 0, 255)
+                if resizer is None:  # model's output scale is known after the first tile
+                    s = enhanced.shape[0] // th
+                    resizer = RowResizer((w * s, h * s), size)
+                    strip = None
+                if xi == 0:
+                    strip = np.empty(((y1 - top) * s, w * s, 3), np.uint8)
+                    next_carry = None if last_row else np.empty((overlap * s, w * s, 3), np.float32)
 
+                # the part of the tile that isn't finished yet, weighted
+                part = enhanced[(top - y0) * s:, (left - x0) * s:]
+                wy = self.blend_ramp(part.shape[0], overlap * s, yi > 0, not last_row)
+                wx = self.blend_ramp(part.shape[1], overlap * s, xi > 0, not last_col)
+                part = part * (wy[:, None, None] * wx[None, :, None])
+                if window is not None:
+                    part[:, :window.shape[1]] += window
+                if carry is not None:
+                    new = window.shape[1] if window is not None else 0
+                    part[:overlap * s, new:] += carry[:, (left * s + new):(x0 + tw) * s]
 
+                # write out the finished columns, and keep the rest for the next tile
+                done = (x1 - left) * s
+                strip[:, left * s:x1 * s] = np.round(part[:(y1 - top) * s, :done])
+                if next_carry is not None:
+                    next_carry[:, left * s:x1 * s] = part[(y1 - top) * s:, :done]
+                window = part[:, done:]
+                left = x1
+            resizer.add(strip)
+            carry = next_carry
+            top = y1
+        return resizer.image()
@@ -0,0 +1,367 @@
+"""
+A long-lived enhancement worker that keeps the ESRGAN model loaded and
+enhances images for any number of pipeline processes, so they share one copy
+of the model (and the CPU cores) instead of each loading their own.
+
+Processes talk to the worker through a queue directory:
+    jobs/      clients write one <id>.json file per Enhance job here
+    running/   the worker moves jobs here while it works on them
+    done/      the worker writes each job's result here, as <id>.json
+    worker.json  heartbeat, rewritten every few seconds while the worker is up
+
+Usage:
+    python enhance_worker.py <queue_dir> [intra_op_threads] [inter_op_threads]
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+from cache import ArtifactCache
+from image_index import ImageIndex
+
+
+# Enhance arguments that are (width, height) tuples, which JSON turns into lists
+SIZE_ARGS = ('max_size_to_enhance', 'target_size')
+
+
+def write_json(path, data):
+    """Write a JSON file atomically, so readers never see a partial file."""
+
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    """Read a JSON file, or get None if it doesn't exist."""
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def default_thread_counts():
+    """
+    Get TensorFlow thread counts suited to this machine: one intra-op thread
+    per core for the big convolutions in each model call, and a couple of
+    inter-op threads since the model runs one call at a time.
+
+    Returns
+    -------
+    intra_op_threads : int
+    inter_op_threads : int
+    """
+
+    cores = os.cpu_count() or 1
+    return cores, min(2, cores)
+
+
+class EnhanceClient():
+    """
+    Send Enhance jobs to an EnhanceWorker through its queue directory.
+    """
+
+    def __init__(self, queue_dir, poll_interval=0.5, heartbeat_timeout=60, timeout=None):
+        """
+        Parameters
+        ----------
+        queue_dir : str
+            the worker's queue directory.
+        poll_interval : float
+            seconds between checks for a job's result.
+        heartbeat_timeout : float
+            seconds without a heartbeat from the worker before it's
+            considered down.
+        timeout : float
+            maximum seconds to wait for a job, or None to wait as long as
+            the worker is up.
+        """
+
+        self.queue_dir = queue_dir
+        self.poll_interval = poll_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.timeout = timeout
+        for sub_dir in ('jobs', 'running', 'done'):
+            os.makedirs(os.path.join(queue_dir, sub_dir), exist_ok=True)
+
+    def worker_alive(self):
+        """Whether the worker has sent a heartbeat recently."""
+
+        heartbeat = read_json(os.path.join(self.queue_dir, 'worker.json'))
+        return heartbeat is not None and time.time() - heartbeat['time'] < self.heartbeat_timeout
+
+    def submit(self, input_dir, output_dir, cache=None, index=None, **kwargs):
+        """
+        Queue an Enhance job.
+
+        Parameters
+        ----------
+        input_dir : str
+            directory of images to enhance.
+        output_dir : str
+            directory to save enhanced images to.
+        cache : ArtifactCache
+            cache for the worker to reuse enhanced images from, or None.
+        index : ImageIndex
+            image index for the worker to reuse enhanced images from, or None.
+        **kwargs
+            other arguments for Enhance (e.g. target_size, tile_size).
+
+        Returns
+        -------
+        job_id : str
+            the job's id, to wait for it with.
+        """
+
+        assert 'model_path' not in kwargs, "the worker's model is set when it's started"
+        if not self.worker_alive():
+            raise Exception(f"no enhance worker running for {self.queue_dir}")
+        job_id = uuid.uuid4().hex
+        job = {
+            'id': job_id,
+            'input_dir': os.path.abspath(input_dir),
+            'output_dir': os.path.abspath(output_dir),
+            'cache': None if cache is None else {'cache_dir': os.path.abspath(cache.cache_dir),
+                                                 'max_size': cache.max_size},
+            'index': None if index is None else os.path.abspath(index.db_path),
+            'kwargs': kwargs,
+            'submitted': time.time(),
+        }
+        write_json(os.path.join(self.queue_dir, 'jobs', f"{job_id}.json"), job)
+        return job_id
+
+    def wait(self, job_id):
+        """
+        Wait for a job to finish.
+
+        Parameters
+        ----------
+        job_id : str
+            the id from submit().
+
+        Raises
+        ------
+        Exception
+            if the job failed, the worker went down, or the timeout passed.
+        """
+
+        done_path = os.path.join(self.queue_dir, 'done', f"{job_id}.json")
+        start = time.time()
+        while True:
+            result = read_json(done_path)
+            if result is not None:
+                os.remove(done_path)
+                if result['error'] is not None:
+                    raise Exception(f"enhance worker failed job {job_id}: {result['error']}")
+                return
+            if not self.worker_alive():
+                raise Exception(f"no enhance worker running for {self.queue_dir}")
+            if self.timeout is not None and time.time() - start > self.timeout:
+                raise Exception(f"timed out waiting for enhance job {job_id}")
+            time.sleep(self.poll_interval)
+
+    def enhance(self, input_dir, output_dir, cache=None, index=None, **kwargs):
+        """Queue an Enhance job and wait for it. See submit()."""
+
+        self.wait(self.submit(input_dir, output_dir, cache=cache, index=index, **kwargs))
+
+
+class EnhanceWorker():
+    """
+    Keep the ESRGAN model warm and run Enhance jobs queued by EnhanceClients.
+    Jobs that arrive close together (e.g. from several pipeline processes)
+    are enhanced in one pipeline, so their images share model batches.
+
+    Run one worker per queue directory: on start up, jobs left running by a
+    previous worker are queued again.
+    """
+
+    def __init__(self, queue_dir, model_path=None, intra_op_threads=None, inter_op_threads=None,
+                 poll_interval=0.5, batch_window=1.0, max_jobs=16, heartbeat_interval=5):
+        """
+        Parameters
+        ----------
+        queue_dir : str
+            directory to take jobs from.
+        model_path : str
+            TF Hub URL or local SavedModel directory of the ESRGAN model.
+            Defaults to enhance_image.SAVED_MODEL_PATH.
+        intra_op_threads : int
+            threads TensorFlow uses within each op. Defaults to one per core.
+        inter_op_threads : int
+            threads TensorFlow runs independent ops on. Defaults to 2.
+        poll_interval : float
+            seconds between checks for new jobs.
+        batch_window : float
+            seconds to wait for more jobs after one arrives, so jobs from
+            several processes can be batched together.
+        max_jobs : int
+            maximum number of jobs to run in one pipeline.
+        heartbeat_interval : float
+            seconds between heartbeats.
+        """
+
+        default_intra, default_inter = default_thread_counts()
+        self.queue_dir = queue_dir
+        self.model_path = model_path
+        self.intra_op_threads = default_intra if intra_op_threads is None else intra_op_threads
+        self.inter_op_threads = default_inter if inter_op_threads is None else inter_op_threads
+        self.poll_interval = poll_interval
+        self.batch_window = batch_window
+        self.max_jobs = max_jobs
+        self.heartbeat_interval = heartbeat_interval
+        self.jobs_dir = os.path.join(queue_dir, 'jobs')
+        self.running_dir = os.path.join(queue_dir, 'running')
+        self.done_dir = os.path.join(queue_dir, 'done')
+        for sub_dir in (self.jobs_dir, self.running_dir, self.done_dir):
+            os.makedirs(sub_dir, exist_ok=True)
+        self.caches = {}  # ArtifactCache by cache_dir
+        self.stopped = threading.Event()
+
+    def heartbeat(self, status):
+        """Let clients know the worker is up."""
+
+        write_json(os.path.join(self.queue_dir, 'worker.json'),
+                   {'pid': os.getpid(), 'time': time.time(), 'status': status})
+
+    def _heartbeats(self):
+        while not self.stopped.wait(self.heartbeat_interval):
+            self.heartbeat('running')
+
+    def configure_threads(self):
+        """Set TensorFlow's thread pools. Must be called before the model is loaded."""
+
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(self.intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(self.inter_op_threads)
+        print(f"tensorflow threads: {self.intra_op_threads} intra-op, {self.inter_op_threads} inter-op")
+
+    def claim(self):
+        """
+        Move queued jobs to running/, oldest first, so no other worker takes
+        them.
+
+        Returns
+        -------
+        jobs : list
+            the claimed jobs' dicts.
+        """
+
+        paths = [os.path.join(self.jobs_dir, f) for f in os.listdir(self.jobs_dir) if f.endswith('.json')]
+        paths.sort(key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0)
+        jobs = []
+        for path in paths[:self.max_jobs]:
+            running_path = os.path.join(self.running_dir, os.path.basename(path))
+            try:
+                os.replace(path, running_path)
+            except OSError:  # taken by another worker
+                continue
+            jobs.append(read_json(running_path))
+        return jobs
+
+    def get_cache(self, spec):
+        if spec is None:
+            return None
+        if spec['cache_dir'] not in self.caches:
+            self.caches[spec['cache_dir']] = ArtifactCache(spec['cache_dir'], spec['max_size'])
+        return self.caches[spec['cache_dir']]
+
+    def make_enhancer(self, job):
+        """Make the Enhance object for a job."""
+
+        from enhance_image import Enhance
+        kwargs = dict(job['kwargs'])
+        for arg in SIZE_ARGS:
+            if kwargs.get(arg) is not None:
+                kwargs[arg] = tuple(kwargs[arg])
+        index = None if job.get('index') is None else ImageIndex(job['index'])
+        return Enhance(job['input_dir'], job['output_dir'], cache=self.get_cache(job['cache']),
+                       index=index, model_path=self.model_path, **kwargs)
+
+    def finish(self, job, error=None):
+        """Write a job's result for its client."""
+
+        write_json(os.path.join(self.done_dir, f"{job['id']}.json"),
+                   {'id': job['id'], 'error': error, 'finished': time.time()})
+        os.remove(os.path.join(self.running_dir, f"{job['id']}.json"))
+
+    def run_jobs(self, jobs):
+        """
+        Enhance the images of several jobs in one pipeline. If that fails,
+        the jobs are rerun one at a time, so one bad job doesn't fail the
+        others.
+        """
+
+        from enhance_image import enhance_many
+        print(f"running {len(jobs)} enhance job(s)")
+        enhancers = {}
+        for job in jobs:
+            try:
+                enhancers[job['id']] = self.make_enhancer(job)
+            except Exception as e:
+                self.finish(job, repr(e))
+        jobs = [job for job in jobs if job['id'] in enhancers]
+        try:
+            enhance_many(list(enhancers.values()))
+        except Exception as e:
+            if len(jobs) == 1:
+                self.finish(jobs[0], repr(e))
+                return
+            for job in jobs:
+                try:
+                    enhance_many([enhancers[job['id']]])
+                except Exception as e:
+                    self.finish(job, repr(e))
+                else:
+                    self.finish(job)
+            return
+        for job in jobs:
+            self.finish(job)
+
+    def serve_forever(self):
+        """Load the model, then run jobs as they arrive until stop() is called."""
+
+        from enhance_image import get_model
+        self.heartbeat('loading')
+        threading.Thread(target=self._heartbeats, daemon=True).start()
+        self.configure_threads()
+        get_model(self.model_path)
+        print(f"enhance worker ready, watching {self.queue_dir}")
+
+        # jobs left in running/ by a worker that died are queued again
+        for f in os.listdir(self.running_dir):
+            if f.endswith('.json'):
+                os.replace(os.path.join(self.running_dir, f), os.path.join(self.jobs_dir, f))
+
+        while not self.stopped.is_set():
+            if not any(f.endswith('.json') for f in os.listdir(self.jobs_dir)):
+                self.stopped.wait(self.poll_interval)
+                continue
+            self.stopped.wait(self.batch_window)  # give other processes a moment to queue their jobs
+            jobs = self.claim()
+            if jobs:
+                self.run_jobs(jobs)
+
+    def stop(self):
+        """Stop serving after the current jobs."""
+
+        self.stopped.set()
+
+
+if __name__ == '__main__':
+    # run a worker for a queue directory, e.g.
+    # python enhance_worker.py enhance_queue
+    worker = EnhanceWorker(sys.argv[1],
+                           model_path=os.environ.get("ESRGAN_MODEL_PATH"),
+                           intra_op_threads=int(sys.argv[2]) if len(sys.argv) > 2 else None,
+                           inter_op_threads=int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    try:
+        worker.serve_forever()
+    finally:
+        worker.stop()
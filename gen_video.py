@@ -1,17 +1,30 @@
 import moviepy.editor as mpy
+import numpy as np
+from moviepy.config import get_setting
 import random
 import os
+import copy
+import shutil
 import hashlib
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from PIL import Image, ImageFont, ImageDraw
+from PIL import Image
 from tqdm import tqdm
+from cache import make_key, hash_file
+from animation import KenBurns, prepare_source
+from overlay import TextOverlay, caption_sprite
+from encoder import encode_clips, get_profile
+from asset_cache import thumbnail_target, video_target
+from thumbnails import render_thumbnails
 
 
 class Video():
     """Generate a video from a list of images."""
 
     def __init__(self, image_paths, output_dir, audio_dir, resolution='4K',
-                 fps=60, dur=6, delay=1, location=None, seed=None):
+                 fps=60, dur=6, delay=1, location=None, seed=None, cache=None,
+                 encoder='x264', outputs=None, assets=None, index=None):
         """
         Parameters
         ----------
@@ -41,6 +54,27 @@ class Video():
             the location of the images (e.g. 'New York City')
         seed : int
             seed for random number generator.
+        cache : ArtifactCache
+            cache to reuse a previously rendered video from, if one was
+            rendered from the same images and parameters. None to always
+            render.
+        encoder : str or dict
+            encoder settings: a profile name in encoder.PROFILES (e.g.
+            'x264', 'x265', or 'mpeg4'), or a dict of codec, preset, crf, and
+            pix_fmt.
+        outputs : list
+            videos to render from the same clips, in one pass, as dicts with
+            a 'name' (appended to the file name, or None for none) and
+            optionally a 'resolution' (e.g. (1080, 1920) for a vertical
+            short; each aspect ratio gets its own crops), 'fps', and
+            'encoder', which default to the arguments above. None for one
+            video with the arguments above.
+        assets : AssetCache
+            cache of images cropped and scaled for the clips and thumbnails
+            (see prepare_assets()), or None to prepare them every time.
+        index : ImageIndex
+            index to read image dimensions from (see image_sizes()), or None
+            to read them from the images' headers every time.
         """
 
         self.image_paths = image_paths
@@ -56,22 +90,75 @@ class Video():
             self.location = location
         self.possible_animations = ['zoom-in', 'zoom-out', 'pan-right', 'pan-left']
         self.thumbnails_dir = 'thumbnails'
+        self.subscribe_path = 'subscribe.mp4'
+        self.cache = cache
+        self.assets = assets
+        self.encoder = get_profile(encoder)
+        self.index = index
+        self.sizes = {}  # image dimensions, by path (see image_sizes())
 
         # set video resolution
         self.resolution = resolution
         self.w, self.h = self.get_resolution(resolution)
         print(f"resolution - {resolution}: {self.w} x {self.h}")
 
+        # set outputs
+        if outputs is None:
+            outputs = [{'name': None}]
+        self.outputs = []
+        for output in outputs:
+            w, h = self.get_resolution(output.get('resolution', resolution))
+            self.outputs.append({'name': output['name'], 'w': w, 'h': h,
+                                 'fps': output.get('fps', fps),
+                                 'encoder': get_profile(output.get('encoder', encoder))})
+        self.images = {}  # decoded images, shared by the clips of every output
+        self.draft = False  # decode images at reduced size (see gen_preview())
+
         # set seed based on location for reproducibility
         if seed is None:
             seed = hashlib.sha512(self.location.encode('cp1252')).hexdigest()
             seed = int(seed, 16) % (10**6)
+        self.seed = seed
         random.seed(seed)
 
         # create output directory if it doesn't exist
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
+    def image_sizes(self, paths=None):
+        """
+        Get the dimensions of images without decoding them, from the image
+        index if there is one (which only re-reads images that changed), or
+        else from their headers. Remembered for the life of the Video.
+
+        Parameters
+        ----------
+        paths : list
+            paths to the images, or None for all the video's images.
+
+        Returns
+        -------
+        sizes : list
+            (width, height) of each image.
+        """
+
+        if paths is None:
+            paths = self.image_paths
+        missing = [p for p in dict.fromkeys(paths) if p not in self.sizes]
+        if missing and self.index is not None:
+            for path, info in zip(missing, self.index.info(missing)):
+                self.sizes[path] = (info['width'], info['height'])
+        elif missing:
+            for path in missing:
+                with Image.open(path) as img:  # only reads the header
+                    self.sizes[path] = img.size
+        return [self.sizes[p] for p in paths]
+
+    def image_size(self, path):
+        """Get the (width, height) of an image (see image_sizes())."""
+
+        return self.image_sizes([path])[0]
+
     def get_resolution(self, resolution=None):
         """
         Set ouput video resolution.
@@ -101,16 +188,18 @@ class Video():
 
         # shrink to minimum image size, adjusted to 16:9 ratio
         if resolution == 'min':
-            w_ = min([mpy.ImageClip(p).w for p in self.image_paths])  # minimum width
-            h_ = min([mpy.ImageClip(p).h for p in self.image_paths])  # minimum Height
+            sizes = self.image_sizes()
+            w_ = min([w for w, h in sizes])  # minimum width
+            h_ = min([h for w, h in sizes])  # minimum Height
             # shrink to 16:9 ratio, images will conform to this width and height
             w = min(w_, int(h_ * 16 / 9))
             h = min(h_, int(w_ * 9 / 16))
 
         # expand to maximum image size, adjusted to 16:9 ratio
         elif resolution == 'max':
-            w_ = max([mpy.ImageClip(p).w for p in self.image_paths])  # maximum width
-            h_ = max([mpy.ImageClip(p).h for p in self.image_paths])  # maximum Height
+            sizes = self.image_sizes()
+            w_ = max([w for w, h in sizes])  # maximum width
+            h_ = max([h for w, h in sizes])  # maximum Height
             # expand to 16:9 ratio, images will conform to this width and height
             w = max(w_, int(h_ * 16 / 9))
             h = max(h_, int(w_ * 9 / 16))
@@ -130,12 +219,13 @@ class Video():
             w, h = 3840, 2160
         return w, h
 
-    def get_audio(self):
+    def get_audio(self, rng=random):
         """
-        Gets path of random audio file from the self.audio_dir directory.
+        Gets path of random audio file from the self.audio_dir directory,
+        picked with rng (a random.Random, or the random module).
         """
         audio_paths = [f"{self.audio_dir}\\{f}" for f in os.listdir(f"{self.audio_dir}")]
-        path = random.choice(audio_paths)
+        path = rng.choice(audio_paths)
         return path
 
     def slide_left(self, t, h, w, h_pos=0.03, v_pos=0.87, h_speed=1.0,
@@ -173,7 +263,7 @@ class Video():
 
         v_time : float
             Time until text starts moving down, in seconds, from the start of
-            the TextClip.
+            the caption.
 
         relative : bool
             ``True`` (default) if you want h_pos, v_pos, h_speed, and v_speed
@@ -275,7 +365,7 @@ class Video():
         image_clip = image_clip.crop(x1=x1, x2=x2, y1=y1, y2=y2)
         return image_clip
 
-    def pick_animation(self, w, h):
+    def pick_animation(self, w, h, rng=random):
         """
         Picks appropriate animation based on aspect ratio. Images wider than
         16 x 9 get a horizontal pan animation, otherwise a zoom animation is
@@ -287,26 +377,33 @@ class Video():
             width of the image.
         h : float
             height of the image.
+        rng : random.Random
+            random number generator to pick with (the random module by
+            default).
         """
 
         if w / h > 16 / 9:  # wide image
-            animation = random.choice(['pan-right', 'pan-left'])
+            animation = rng.choice(['pan-right', 'pan-left'])
         else:
-            animation = random.choice(['zoom-in', 'zoom-out'])
+            animation = rng.choice(['zoom-in', 'zoom-out'])
         return animation
 
-    def add_animation(self, image_clip, animation='random', scroll_dist=0.2):
+    def add_animation(self, image, animation='random', scroll_dist=0.2, dur=None):
         """
-        Applies one of the following animations to an ImageClip:
+        Makes an animated clip from an image with one of the following
+        animations:
             1. Zoom in
             2. Zoom out
             3. Pan right
             4. Pan left
 
+        The image is cropped and scaled once, then each frame is sampled from
+        it by a KenBurns engine (see animation.py).
+
         Parameters
         -----------
-        image_clip : ImageClip
-            An ImageClip object.
+        image : str, PIL.Image.Image, or ImageClip
+            the image (or a path to it) to animate.
         animation : str
             A string representing the animation to apply. Valid values include
             'zoom-in', 'zoom-out', 'pan-right', 'pan-left', or 'random'. If
@@ -314,10 +411,22 @@ class Video():
         scroll_dist : float
             The scroll/pan distance (relative to the image width) for panning
             animations.
+        dur : float
+            duration of the clip in seconds. Defaults to the ImageClip's
+            duration if image is an ImageClip, otherwise self.dur.
+
+        Returns
+        -------
+        VideoClip
+            a w x h clip of the animated image.
         """
 
-        w, h, dur = self.w, self.h, self.dur
-        s = scroll_dist
+        w, h = self.w, self.h
+        path = image if isinstance(image, str) else None
+        if isinstance(image, mpy.ImageClip):
+            dur = image.duration if dur is None else dur
+            image = Image.fromarray(image.img)
+        dur = self.dur if dur is None else dur
 
         # pick an animation randomly
         if animation == 'random':
@@ -327,54 +436,71 @@ class Video():
         assert animation in self.possible_animations, \
             f"animation must be in {self.possible_animations}, not {animation}"
 
-        # resize image to prep for horizontal pan animation on wide images
-        if animation[:3] == 'pan':
+        # crop and scale the image once (extra wide for pans), or read it from
+        # the asset cache, then animate it
+        if path is not None and self.assets is not None and not self.draft:
+            source = self.assets.get(path, video_target(animation, w, h, scroll_dist))
+        else:
+            if path is not None:
+                image = self.load_image(path)
+            source = prepare_source(image, animation, w, h, scroll_dist=scroll_dist)
+        engine = KenBurns(source, animation, w, h, dur, scroll_dist=scroll_dist)
+        return mpy.VideoClip(make_frame=engine.frame, duration=dur)
 
-            # crop image to modified aspect ratio
-            aspect_corr = 1 / (1 - s)  # aspect ratio correction factor for pan animation
-            image_clip = self.crop_to_aspect(image_clip,
-                                             aspect_ratio=aspect_corr*16/9,
-                                             allow_slight_stretching=True)
+    def load_image(self, path):
+        """
+        Decode an image once, for the clips of every output (see
+        render()). In draft mode, JPEGs are decoded at a fraction of their
+        size, down to the video's size.
+        """
 
-            # scale image to same size as other images (plus correction factor)
-            image_clip = image_clip.resize((aspect_corr*w, h))
+        if path not in self.images:
+            image = Image.open(path)
+            if self.draft:
+                image.draft('RGB', (self.w, self.h))
+            self.images[path] = image if image.mode == 'RGB' else image.convert('RGB')
+        return self.images[path]
 
-        # resize image to prep for zoom animation
-        else:
+    def at_size(self, w, h, fps=None):
+        """
+        Get a view of the video at another size (and frame rate), to make
+        its clips with. The view shares the decoded images.
+        """
 
-            # crop image to 16:9 aspect ratio
-            image_clip = self.crop_to_aspect(image_clip,
-                                             aspect_ratio=16/9,
-                                             allow_slight_stretching=True)
-
-            # scale image to same size as other images (usually 16:9 aspect ratio)
-            image_clip = image_clip.resize((w, h))
-
-        # animate image
-        if animation == 'zoom-in':
-            image_clip = image_clip.resize(lambda t: 1+0.02*t)
-        elif animation == 'zoom-out':
-            # .resize() scales relative to the t=0 output, so t=0 case is included.
-            image_clip = image_clip.resize(lambda t: 1 if t == 0 else 1 + 0.02*(dur-t))
-        elif animation == 'pan-right':
-            # scroll() squishes the image horizontally, we previously cropped to an
-            # extra wide aspect ratio to offset this.
-            image_clip = mpy.vfx.scroll(image_clip, w=int((1-s)*w), x_speed=s*w/dur)
-            # .resize() is applied so the output can be correctly combined with the
-            # TextClip later.
-            image_clip = image_clip.resize((w, h))
-        elif animation == 'pan-left':
-            # scroll() only pans right, so image_clip is flipped before and after the
-            # scroll operation to get a left pan
-            image_clip = mpy.vfx.mirror_x(image_clip)
-            image_clip = mpy.vfx.scroll(image_clip, w=int((1-s)*w),
-                                        x_speed=s*w/dur, x_start=0)
-            image_clip = mpy.vfx.mirror_x(image_clip)
-            image_clip = image_clip.resize((w, h))
+        video = copy.copy(self)
+        video.w, video.h = w, h
+        video.fps = self.fps if fps is None else fps
+        return video
 
-        return image_clip
+    def subscribe_clip(self):
+        """
+        Make the masked subscribe animation overlaid on the last clip, starting
+        7 seconds into it.
+        """
 
-    def process_image(self, image_path, last_clip=False):
+        # make masked subscribe animation overlay
+        sub_clip = mpy.VideoFileClip(self.subscribe_path).set_duration(5).set_start(7)
+        sub_clip = sub_clip.fx(mpy.vfx.mask_color, color=[15, 209, 0], thr=125, s=30)
+
+        # crop off border
+        w, h = sub_clip.w, sub_clip.h
+        new_w, new_h = int(0.9 * w), int(0.9 * h)
+        x1 = int((w - new_w) / 2)
+        x2 = w - x1
+        y1 = int((h - new_h) / 2)
+        y2 = h - y1
+        sub_clip = sub_clip.crop(x1=x1, y1=y1, x2=x2, y2=y2)
+
+        # resize to same as (a 16:9 frame the width of) the video, then shrink
+        # and put in bottom right corner
+        sub_clip = sub_clip.resize((self.w, min(self.h, int(self.w * 9 / 16))))
+        sub_clip = sub_clip.resize(0.25).set_pos(('right', 'bottom'))
+
+        # add short fade in and out
+        sub_clip = sub_clip.crossfadein(0.25).crossfadeout(0.25)
+        return sub_clip
+
+    def process_image(self, image_path, last_clip=False, animation=None):
         """
         Generate an edited ImageClip based on an image file.
 
@@ -386,6 +512,9 @@ class Video():
             if ``True``, use custom edits intended for the last clip in the
             video. Specifically, use a longer clip duration and include an
             animated subscribe button.
+        animation : str
+            the animation to use (see add_animation()), or None for the
+            default: 'zoom-in' for the last clip, otherwise picked randomly.
         """
 
         # use custom edits for the last clip
@@ -393,44 +522,23 @@ class Video():
 
             # set clip duration and animation
             dur = self.last_clip_dur  # longer duration
-            animation = 'zoom-in'  # zoom-in animation
+            animation = 'zoom-in' if animation is None else animation
 
             # make masked subscribe animation overlay
-            subscribe_path = 'subscribe.mp4'
-            sub_clip = mpy.VideoFileClip(subscribe_path).set_duration(5).set_start(7)
-            sub_clip = sub_clip.fx(mpy.vfx.mask_color, color=[15, 209, 0], thr=125, s=30)
-
-            # crop off border
-            w, h = sub_clip.w, sub_clip.h
-            new_w, new_h = int(0.9 * w), int(0.9 * h)
-            x1 = int((w - new_w) / 2)
-            x2 = w - x1
-            y1 = int((h - new_h) / 2)
-            y2 = h - y1
-            sub_clip = sub_clip.crop(x1=x1, y1=y1, x2=x2, y2=y2)
-
-            # resize to same as video, then shrink and put in bottom right corner
-            sub_clip = sub_clip.resize((self.w, self.h))
-            sub_clip = sub_clip.resize(0.25).set_pos(('right', 'bottom'))
-
-            # add short fade in and out
-            sub_clip = sub_clip.crossfadein(0.25).crossfadeout(0.25)
+            sub_clip = self.subscribe_clip()
 
         # use default edits for all other clips
         else:
             # set clip duration and animation
             dur = self.dur
-            animation = 'random'
-
-        # Make clip from image
-        image_clip = mpy.ImageClip(image_path, duration=dur)
+            animation = 'random' if animation is None else animation
 
         # pick random animation (pick before crop since we crop less if panning)
         if animation == 'random':
-            animation = self.pick_animation(image_clip.w, image_clip.h)
+            animation = self.pick_animation(*self.image_size(image_path))
 
         # Animate image -- either zoom in, zoom out, pan right, or pan left
-        image_clip = self.add_animation(image_clip, animation=animation)
+        image_clip = self.add_animation(image_path, animation=animation, dur=dur)
 
         # Add crossfade transitions
         image_clip = image_clip.crossfadein(1).crossfadeout(1)
@@ -442,33 +550,36 @@ class Video():
 
     def process_text(self, text):
         """
-        Generate an edited TextClip based on a string of text.
+        Generate an animated caption overlay based on a string of text. The
+        caption bar is rendered once, then slides in from the right and off
+        the bottom of the screen (see slide_left()).
 
         Parameters
         -----------
         text : str
-            text to be used to generate the TextClip.
+            text to be used to generate the caption.
+
+        Returns
+        -------
+        TextOverlay
+            the caption, to apply() to a clip.
         """
 
         # get clip parameters
         w, h, dur, delay = self.w, self.h, self.dur, self.delay
 
-        # Make clip from text
-        text_clip = mpy.TextClip(txt=text, fontsize=0.067*h, font='Amiri-regular',
-                                 color='white')
-
-        # Add box around text
-        text_clip = text_clip.on_color(size=(w, int(1.2*text_clip.h)), color=(0, 0, 0),
-                                       pos=(0.025*w, 'center'), col_opacity=0.6)
+        # Render text on a translucent box the width of the video (sized for a
+        # 16:9 frame the same width, so it fits in tall videos)
+        sprite = caption_sprite(text, w, min(h, int(w * 9 / 16)), font='Amiri-regular',
+                                font_scale=0.067,
+                                color=(255, 255, 255), box_color=(0, 0, 0), box_opacity=0.6)
 
-        # Animate text clip
-        text_clip = text_clip.set_duration(dur-delay).set_start(delay)
-        text_clip = text_clip.set_position(lambda t: self.slide_left(t, h, w, h_pos=0.03,
-                                           v_pos=0.81, h_speed=2.0, v_speed=0.5,
-                                           v_time=dur-3))
-        return text_clip
+        # Animate text
+        position = lambda t: self.slide_left(t, h, w, h_pos=0.03, v_pos=0.81, h_speed=2.0,
+                                             v_speed=0.5, v_time=dur-3)
+        return TextOverlay(sprite, position, start=delay, end=dur, fps=self.fps)
 
-    def gen_clip(self, image_path, text, last_clip=False):
+    def gen_clip(self, image_path, text, last_clip=False, animation=None):
         """
         Make an animated clip out of an image and text.
 
@@ -477,48 +588,412 @@ class Video():
         image_path : str
             path to an image file to be used to generate the ImageClip.
         text : str
-            text to be used to generate the TextClip.
+            text to be used to generate the caption.
         last_clip : bool
             if ``True``, use custom edits intended for the last clip in the
             video. Specifically, use a longer clip duration and include an
             animated subscribe button.
+        animation : str
+            the animation to use, or None for the default (see
+            process_image()).
         """
 
         # Make & process ImageClip
-        image_clip = self.process_image(image_path, last_clip)
+        image_clip = self.process_image(image_path, last_clip, animation)
 
-        # Make & process TextClip
-        text_clip = self.process_text(text)
+        # Make caption overlay
+        text_overlay = self.process_text(text)
 
-        # Overlay the TextClip onto ImageClip
-        clip = mpy.CompositeVideoClip([image_clip, text_clip])
+        # Overlay the caption onto the ImageClip
+        clip = text_overlay.apply(image_clip)
         return clip
 
-    def gen_video(self):
-        """Generate a video from a list of image paths."""
+    def output_path(self, output):
+        """Get the path to save an output (see __init__()) to."""
+
+        if output['name'] is None:
+            return f"{self.output_dir}\\{self.location}.mp4"
+        return f"{self.output_dir}\\{self.location}_{output['name']}.mp4"
+
+    def captions(self):
+        """Get the caption of each image (e.g. "1. CN Tower"), from its file name."""
 
-        # generate clips
-        clips = []
-        for i, path in enumerate(self.image_paths):
-            attraction = '.'.join(Path(path).name.split('.')[:-1])
-            clip_text = f"{i+1}. {attraction}"
+        return [f"{i+1}. {'.'.join(Path(path).name.split('.')[:-1])}"
+                for i, path in enumerate(self.image_paths)]
+
+    def cache_key(self, output):
+        """
+        Get the cache key for a rendered output, from the bytes of every
+        input image, audio file, and the subscribe clip, the captions (which
+        come from the image file names), plus the render parameters.
+        """
+
+        audio_paths = sorted(f"{self.audio_dir}\\{f}" for f in os.listdir(f"{self.audio_dir}"))
+        return make_key('video', [hash_file(p) for p in self.image_paths], self.captions(),
+                        [hash_file(p) for p in audio_paths], hash_file(self.subscribe_path),
+                        self.location, output['w'], output['h'], output['fps'], self.dur,
+                        self.last_clip_dur, self.delay, self.seed, sorted(output['encoder'].items()))
+
+    def plan_clips(self, rng):
+        """
+        Decide every clip of the video up front: its image, caption,
+        animation, duration, and start time. The random animation choices
+        are made here, in order, so any part of the video can be rendered
+        separately (e.g. in another process) and match the rest.
+
+        Parameters
+        ----------
+        rng : random.Random
+            random number generator to pick animations with.
+
+        Returns
+        -------
+        plan : list
+            one dict per clip, in the order they play, with keys 'path',
+            'text', 'animation', 'dur', 'start', and 'last_clip'.
+        """
+
+        plan = []
+        for i, (path, text) in enumerate(zip(self.image_paths, self.captions())):
             last_clip = (i == 0)  # last clip (after the order is reversed)
-            clip = self.gen_clip(path, clip_text, last_clip)
-            clips.append(clip)
-        clips.reverse()
-
-        # combine clips and audio
-        video = mpy.concatenate_videoclips(clips, method='compose', padding=-1)
-        audio_path = self.get_audio()  # get random song
-        video_length = (self.dur - 1) * (len(clips) - 1) + (self.last_clip_dur - 1)
-        audio = mpy.AudioFileClip(audio_path).set_duration(video_length)
+            if last_clip:
+                dur, animation = self.last_clip_dur, 'zoom-in'
+            else:
+                dur, animation = self.dur, self.pick_animation(*self.image_size(path), rng=rng)
+            plan.append({'path': path, 'text': text, 'animation': animation,
+                         'dur': dur, 'last_clip': last_clip})
+        plan.reverse()
+
+        # each clip starts 1 second (a crossfade) before the previous one ends
+        start = 0
+        for clip in plan:
+            clip['start'] = start
+            start += clip['dur'] - 1
+        return plan
+
+    def gen_audio(self, plan, rng):
+        """
+        Make the video's soundtrack: a random song faded in and out over the
+        length of the video, plus the subscribe animation's sound.
+
+        Parameters
+        ----------
+        plan : list
+            the clip plan, from plan_clips().
+        rng : random.Random
+            random number generator to pick the song with.
+        """
+
+        audio_path = self.get_audio(rng)  # get random song
+        # the song ends as the last clip starts fading out to black
+        audio_length = plan[-1]['start'] + plan[-1]['dur'] - 1
+        audio = mpy.AudioFileClip(audio_path).set_duration(audio_length)
         audio = audio.audio_fadein(1).audio_fadeout(2)
-        combined_audio = mpy.CompositeAudioClip([video.audio, audio])
-        video = video.set_audio(combined_audio)
+        sub_audio = self.subscribe_clip().audio
+        if sub_audio is None:
+            return audio
+        last_start = [clip['start'] for clip in plan if clip['last_clip']][0]
+        return mpy.CompositeAudioClip([sub_audio.set_start(last_start + sub_audio.start), audio])
 
-        # render video
-        output_path = f"{self.output_dir}\\{self.location}.mp4"
-        video.write_videofile(output_path, fps=self.fps, threads=6, codec='mpeg4')
+    def plan_video(self):
+        """
+        Decide the clips (see plan_clips()) and soundtrack (see gen_audio())
+        of the video. The random choices are made with their own generator,
+        seeded with self.seed, so every call (e.g. for a preview and then the
+        final render) makes the same ones.
+
+        Returns
+        -------
+        plan : list
+            the clip plan.
+        audio : AudioClip
+            the soundtrack.
+        """
+
+        rng = random.Random(self.seed)
+        plan = self.plan_clips(rng)
+        return plan, self.gen_audio(plan, rng)
+
+    def segment_times(self, plan, k):
+        """
+        Get the part of the video rendered as segment k: from the start of
+        clip k (including its crossfade from the previous clip) to the start
+        of the next clip, or for the last clip, to its end (including its
+        fade out to black).
+        """
+
+        t0 = plan[k]['start']
+        if k + 1 < len(plan):
+            t1 = plan[k + 1]['start']
+        else:
+            t1 = t0 + plan[k]['dur']
+        return t0, t1
+
+    def timeline_clip(self, plan, t0, t1):
+        """
+        Make the part of the video from t0 to t1 seconds, without audio.
+        Clips playing then are composited over black in order, through their
+        masks, the same way concatenate_videoclips() does for the whole
+        video, so crossfades with clips outside the part are exact. Unlike
+        CompositeVideoClip, frames are only blended while a clip's mask
+        isn't opaque (i.e. during crossfades).
+
+        Parameters
+        ----------
+        plan : list
+            the clip plan, from plan_clips().
+        t0 : float
+            start time, in seconds.
+        t1 : float
+            end time, in seconds.
+        """
+
+        clips = [(c['start'] - t0, self.gen_clip(c['path'], c['text'], c['last_clip'], c['animation']))
+                 for c in plan if c['start'] < t1 and c['start'] + c['dur'] > t0]
+
+        def make_frame(t):
+            frame = np.zeros((self.h, self.w, 3), np.uint8)
+            for start, clip in clips:
+                if not start <= t < start + clip.duration:
+                    continue
+                clip_frame = clip.get_frame(t - start)
+                mask = None if clip.mask is None else clip.mask.get_frame(t - start)
+                if mask is None or mask.min() == 1:
+                    frame = clip_frame
+                else:
+                    mask = mask[..., None].astype(np.float32)
+                    frame = (mask * clip_frame + (1 - mask) * frame).astype(np.uint8)
+            return frame
+
+        return mpy.VideoClip(make_frame=make_frame, duration=t1 - t0)
+
+    def render(self, plan, t0, t1, outputs, output_paths, audio_path=None, threads=None,
+               progress=True, frame_step=1):
+        """
+        Render part of the video (see timeline_clip()) to several outputs in
+        one pass. Each image is decoded once for all outputs, outputs the
+        same size share their clips (and so their frames), and every output
+        is encoded by its own ffmpeg process.
+
+        Parameters
+        ----------
+        plan : list
+            the clip plan, from plan_clips().
+        t0 : float
+            start time, in seconds.
+        t1 : float
+            end time, in seconds.
+        outputs : list
+            the outputs to render (see __init__()).
+        output_paths : list
+            path to save each output to.
+        audio_path : str
+            path to audio to add to every output, or None for no audio.
+        threads : int
+            threads for each encoder, or None for ffmpeg's default.
+        progress : bool
+            whether to show a progress bar.
+        frame_step : int
+            render every frame_step-th frame, holding it in place of the
+            frames skipped.
+        """
+
+        clips = {}  # by size
+        for output in outputs:
+            size = (output['w'], output['h'])
+            if size not in clips:
+                fps = max(o['fps'] for o in outputs if (o['w'], o['h']) == size)
+                clips[size] = self.at_size(*size, fps).timeline_clip(plan, t0, t1)
+        self.images.clear()  # the clips hold their own scaled copies
+        encode_clips([clips[(o['w'], o['h'])] for o in outputs], output_paths,
+                     [o['fps'] for o in outputs], [o['encoder'] for o in outputs],
+                     audio_path=audio_path, threads=threads, progress=progress,
+                     frame_step=frame_step)
+
+    def render_segment(self, plan, k, outputs, output_paths, threads=1):
+        """
+        Render segment k of the video (see segment_times()) to each output's
+        segment file.
+
+        Parameters
+        ----------
+        plan : list
+            the clip plan, from plan_clips().
+        k : int
+            index of the segment's clip in the plan.
+        outputs : list
+            the outputs to render (see __init__()).
+        output_paths : list
+            path to save each output's segment to.
+        threads : int
+            threads for each encoder.
+        """
+
+        t0, t1 = self.segment_times(plan, k)
+        self.render(plan, t0, t1, outputs, output_paths, threads=threads, progress=False)
+
+    def render_segmented(self, plan, audio, outputs, output_paths, workers=None):
+        """
+        Render the video's segments in parallel processes, then join each
+        output's segments (without re-encoding) and add the audio.
+
+        Parameters
+        ----------
+        plan : list
+            the clip plan, from plan_clips().
+        audio : AudioClip
+            the soundtrack, from gen_audio().
+        outputs : list
+            the outputs to render (see __init__()).
+        output_paths : list
+            path to save each output to.
+        workers : int
+            number of processes, or None for one per core.
+        """
+
+        segments_dir = f"{self.output_dir}\\segments"
+        if not os.path.exists(segments_dir):
+            os.makedirs(segments_dir)
+        segment_paths = [[f"{segments_dir}\\{k:03d}_{i}.mp4" for i in range(len(outputs))]
+                         for k in range(len(plan))]
+
+        # render segments
+        workers = os.cpu_count() if workers is None else workers
+        print(f"rendering {len(plan)} segments with {workers} processes")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(tqdm(executor.map(self.render_segment, [plan] * len(plan), range(len(plan)),
+                                   [outputs] * len(plan), segment_paths), total=len(plan)))
+
+        # render audio once
+        audio_path = f"{segments_dir}\\audio.mp3"
+        audio.write_audiofile(audio_path, fps=44100, logger=None)
+
+        # join each output's segments and add audio
+        for i, output_path in enumerate(output_paths):
+            list_path = f"{segments_dir}\\segments_{i}.txt"
+            with open(list_path, 'w') as f:
+                for paths in segment_paths:
+                    path = os.path.abspath(paths[i]).replace("'", "'\\''")
+                    f.write(f"file '{path}'\n")
+            subprocess.run([get_setting("FFMPEG_BINARY"), '-y', '-loglevel', 'error',
+                            '-f', 'concat', '-safe', '0', '-i', list_path, '-i', audio_path,
+                            '-map', '0:v', '-map', '1:a', '-c', 'copy', output_path], check=True)
+        shutil.rmtree(segments_dir)
+
+    def gen_video(self, segmented=False, workers=None):
+        """
+        Generate the videos (see outputs in __init__()) from a list of image
+        paths.
+
+        Parameters
+        ----------
+        segmented : bool
+            if ``True``, render each clip's segment of the video in a separate
+            process (see render_segmented()), otherwise render the whole
+            video in one pass.
+        workers : int
+            number of processes for a segmented render, or None for one per
+            core.
+        """
+
+        # reuse previous renders of the same inputs if there are any
+        outputs, output_paths = [], []
+        for output in self.outputs:
+            output_path = self.output_path(output)
+            if self.cache is not None and \
+                    self.cache.restore(self.cache_key(output), output_path) is not None:
+                print(f"restored {output_path} from cache")
+                continue
+            outputs.append(output)
+            output_paths.append(output_path)
+        if not outputs:
+            return
+
+        # decide clips and audio
+        plan, audio = self.plan_video()
+
+        # render videos
+        if segmented:
+            self.render_segmented(plan, audio, outputs, output_paths, workers)
+        else:
+            audio_path = f"{self.output_dir}\\{self.location}_audio.mp3"
+            audio.write_audiofile(audio_path, fps=44100, logger=None)
+            self.render(plan, 0, self.segment_times(plan, len(plan) - 1)[1], outputs,
+                        output_paths, audio_path=audio_path)
+            os.remove(audio_path)
+        if self.cache is not None:
+            for output, output_path in zip(outputs, output_paths):
+                self.cache.store(self.cache_key(output), output_path)
+
+    def gen_preview(self, resolution=(640, 360), fps=10, encoder='draft', frame_step=1,
+                    audio=True):
+        """
+        Quickly render a draft of the video, to check its images, order,
+        captions, and animations before the full render. The draft is made
+        from the same clip plan (see plan_video()) as gen_video(), at a low
+        resolution and frame rate, with a fast encoder preset.
+
+        Parameters
+        ----------
+        resolution : str or tuple
+            resolution of the draft (see get_resolution()).
+        fps : int
+            frames per second of the draft.
+        encoder : str or dict
+            encoder settings (see encoder.PROFILES).
+        frame_step : int
+            render only every frame_step-th frame, holding it in place of the
+            frames skipped (e.g. 5 at 10 fps renders 2 frames a second).
+        audio : bool
+            whether to add the soundtrack.
+
+        Returns
+        -------
+        output_path : str
+            path to the draft video.
+        """
+
+        w, h = self.get_resolution(resolution)
+        output = {'name': 'preview', 'w': w, 'h': h, 'fps': fps, 'encoder': get_profile(encoder)}
+        output_path = self.output_path(output)
+        plan, soundtrack = self.plan_video()
+
+        # decode images for the draft only, at reduced size
+        video = self.at_size(w, h, fps)
+        video.images, video.draft = {}, True
+
+        audio_path = None
+        if audio:
+            audio_path = f"{self.output_dir}\\{self.location}_preview_audio.mp3"
+            soundtrack.write_audiofile(audio_path, fps=44100, logger=None)
+        video.render(plan, 0, self.segment_times(plan, len(plan) - 1)[1], [output], [output_path],
+                     audio_path=audio_path, frame_step=frame_step)
+        if audio:
+            os.remove(audio_path)
+        return output_path
+
+    def prepare_assets(self, thumbnail_resolutions=()):
+        """
+        Decode each image once and crop and scale it for every target it's
+        needed for: its clip's source at the size of every output (see
+        __init__()), and the thumbnails. The results go in the asset cache,
+        where the clips and thumbnails read them from.
+
+        Parameters
+        ----------
+        thumbnail_resolutions : list
+            resolutions of the thumbnails to prepare (see get_resolution()).
+        """
+
+        assert self.assets is not None, "no asset cache to prepare assets in"
+        plan = self.plan_clips(random.Random(self.seed))  # same animations as plan_video()
+        sizes = sorted({(output['w'], output['h']) for output in self.outputs})
+        thumbnail_sizes = [self.get_resolution(r) for r in thumbnail_resolutions]
+        print(f"preparing images for {self.location}")
+        for clip in tqdm(plan):
+            targets = [video_target(clip['animation'], w, h) for w, h in sizes]
+            targets += [thumbnail_target(w, h) for w, h in thumbnail_sizes]
+            self.assets.prepare(clip['path'], targets)
 
     def gen_thumbnail(self, input_path=None, output_path=None, title=None,
                       resolution=None):
@@ -541,95 +1016,83 @@ class Video():
         if input_path is None:
             input_path = random.choice(self.image_paths)
 
-        # open image
-        img = Image.open(input_path)
-
-        # crop to 16:9 aspect ratio
-        w, h = img.size
-        new_w = min(w, int(h * 16 / 9))
-        new_h = min(h, int(w * 9 / 16))
-        x1 = int((w - new_w) / 2)
-        x2 = w - x1
-        y1 = int((h - new_h) / 2)
-        y2 = h - y1
-        img = img.crop((x1, y1, x2, y2))
-
         # set sizes (so text is more clearly visible)
         if resolution is None:
             resolution = self.resolution
         new_w, new_h = self.get_resolution(resolution)
-        img = img.resize((new_w, new_h))
-
-        # make image editable
-        draw = ImageDraw.Draw(img)
-
-        # set up font
-        font_size = int(0.25 * new_h)
-        stroke_width = max(2, int(font_size / 100))
-        font_type = 'arialbd.ttf'
-        font = ImageFont.truetype(font_type, font_size)
-
-        # add text line 1 (e.g. "TOP 10") to image (centered horizontally, above middle)
-        txt = f"TOP {len(self.image_paths)}"
-        w, h = draw.textsize(txt, font=font)  # size of text
-        x = int((new_w - w) / 2)
-        y = int(0.45 * new_h - h)
-        draw.text((x, y), txt, (237, 230, 211), font=font, stroke_width=stroke_width,
-                  stroke_fill="black")
-
-        # add text line 2 (e.g. "TORONTO") to image (centered horizontally, below middle)
-        txt = f"{self.location.split(',')[0].upper()}" if title is None else title
-        w, h = draw.textsize(txt, font=font)
-        while w > 0.975 * new_w:  # reduce font until it fits on the picture
-            font_size -= 1
-            font = ImageFont.truetype(font_type, font_size)
-            w, h = draw.textsize(txt, font=font)
-        # stroke_width = max(1, int(font_size / 100))  # reset stroke size for possibly new font size
-        x = int((new_w - w) / 2)
-        y = int(0.52 * new_h)
-        draw.text((x, y), txt, (237, 230, 211), font=font, stroke_width=stroke_width,
-                  stroke_fill="black")
 
         # save image
         if output_path is None:
             attraction = '.'.join(Path(input_path).name.split('.')[:-1])
             output_path = f"{self.output_dir}\\{self.thumbnails_dir}\\{attraction}.png"
-        img.save(output_path, "PNG")
+        render_thumbnails(input_path, [((new_w, new_h), output_path)], *self.thumbnail_text(title),
+                          assets=self.assets)
         # print(f"saved thumbnail to {output_path}")
 
-    def gen_thumbnails(self, title=None, resolution=None, sub_dir=None):
+    def thumbnail_text(self, title=None):
         """
-        Generate thumbnails for all images in the image directory.
+        Get the two lines of text on the thumbnails (e.g. "TOP 10" and
+        "TORONTO").
+        """
+
+        top_text = f"TOP {len(self.image_paths)}"
+        title = f"{self.location.split(',')[0].upper()}" if title is None else title
+        return top_text, title
+
+    def gen_thumbnails(self, title=None, resolution=None, sub_dir=None, workers=None):
+        """
+        Generate thumbnails for all images in the image directory, at one or
+        more resolutions. Each image is decoded once for all its thumbnails
+        (or read from the asset cache), and the images are processed in
+        parallel.
 
         Parameters
         -----------
         title : str
             title to be used in the thumbnail.
-        resolution : tuple
-            resolution of the thumbnail image.
-        sub_dir : str
-            subdirectory to save the thumbnails in.
+        resolution : tuple, str, or list
+            resolution of the thumbnail image, or a list of resolutions.
+        sub_dir : str or list
+            subdirectory to save the thumbnails in, or one per resolution.
+        workers : int
+            number of processes to use, or None for one per CPU.
         """
 
-        # create output directory
-        output_dir = f"{self.output_dir}\\{self.thumbnails_dir}"
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        if sub_dir is not None:
-            output_dir = f"{self.output_dir}\\{self.thumbnails_dir}\\{sub_dir}"
+        # resolutions and the subdirectory of each
+        if resolution is None:
+            resolution = self.resolution
+        resolutions = resolution if isinstance(resolution, list) else [resolution]
+        sub_dirs = sub_dir if isinstance(sub_dir, list) else [sub_dir] * len(resolutions)
+        assert len(sub_dirs) == len(resolutions), "need one sub_dir per resolution"
+
+        # create output directories
+        output_dirs = []
+        for sub_dir in sub_dirs:
+            output_dir = f"{self.output_dir}\\{self.thumbnails_dir}"
+            if sub_dir is not None:
+                output_dir = f"{output_dir}\\{sub_dir}"
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
+            output_dirs.append(output_dir)
 
-        # generate thumbnails
-        if resolution is None:
-            resolution = self.resolution
-        print(f"generating {resolution} thumbnails for {self.location}")
-        for input_path in tqdm(self.image_paths):
+        # thumbnails of each image
+        sizes = [self.get_resolution(r) for r in resolutions]
+        targets = []
+        for input_path in self.image_paths:
             # remove file extension from image name
             attraction = '.'.join(Path(input_path).name.split('.')[:-1])
-            output_path = f"{output_dir}\\{attraction}.png"
-            self.gen_thumbnail(input_path=input_path, output_path=output_path,
-                               title=title, resolution=resolution)
+            targets.append([(size, f"{output_dir}\\{attraction}.png")
+                            for size, output_dir in zip(sizes, output_dirs)])
+
+        # generate thumbnails
+        top_text, title = self.thumbnail_text(title)
+        n = len(self.image_paths)
+        print(f"generating {', '.join(map(str, resolutions))} thumbnails for {self.location}")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            jobs = executor.map(render_thumbnails, self.image_paths, targets, [top_text] * n,
+                                [title] * n, [self.assets] * n)
+            for _ in tqdm(jobs, total=n):
+                pass
 
     def document(self):
         """Generate a txt file with the video title and description."""
@@ -0,0 +1,434 @@
+import os
+import time
+import sqlite3
+from contextlib import closing
+from PIL import Image
+from cache import hash_file, link_or_copy
+from image_probe import probe_file
+
+
+def dhash(path, hash_size=8):
+    """
+    Get an image's difference hash, a perceptual hash that's the same (or
+    nearly the same) for resized, re-encoded, or slightly edited copies of
+    the image.
+
+    Parameters
+    ----------
+    path : str
+        path to the image.
+    hash_size : int
+        width and height of the grid of brightness gradients hashed, giving
+        a hash_size**2 bit hash.
+
+    Returns
+    -------
+    hash : int
+    """
+
+    with Image.open(path) as img:
+        img.draft('L', (hash_size * 8, hash_size * 8))  # decode JPEGs at a fraction of full size
+        img = img.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(img.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def hamming(a, b):
+    """Get the number of bits that differ between two hashes."""
+
+    return bin(a ^ b).count('1')
+
+
+def related_locations(a, b, cities=()):
+    """
+    Whether two locations are the same or one contains the other (e.g.
+    'Canada' and 'Ontario, Canada', or 'Toronto, Ontario' and
+    'Ontario, Canada').
+
+    Parameters
+    ----------
+    a, b : str
+        the locations, as in locations.csv's 'Location' column.
+    cities : set of str
+        the locations that are cities (i.e. have a 'City' in locations.csv).
+        A city is in a region if its last part is the region's first part
+        (e.g. 'Toronto, Ontario' is in 'Ontario, Canada'), but not if the
+        "region" is a city of the same name (e.g. 'Ontario, California').
+    """
+
+    if a == b or a.endswith(', ' + b) or b.endswith(', ' + a):
+        return True
+    for city, region in [(a, b), (b, a)]:
+        if city in cities and region not in cities \
+                and city.split(', ')[-1] == region.split(', ')[0]:
+            return True
+    return False
+
+
+def read_info(path):
+    """
+    Get an image file's metadata, reading only its header for the format and
+    dimensions (see image_probe.probe_file()), and falling back to Pillow
+    (which also only reads the header) for formats it doesn't know.
+
+    Returns
+    -------
+    info : dict
+        'format', 'width', 'height', 'file_size', 'mtime', and 'sha256'
+        (None, since it takes reading the whole file; see
+        ImageIndex.content_hash()).
+    """
+
+    try:
+        fmt, (width, height) = probe_file(path)
+    except ValueError:
+        with Image.open(path) as img:
+            fmt, (width, height) = (img.format or '').lower(), img.size
+    stat = os.stat(path)
+    return {'format': fmt, 'width': width, 'height': height, 'file_size': stat.st_size,
+            'mtime': stat.st_mtime, 'sha256': None}
+
+
+class ImageIndex():
+    """
+    Global index of downloaded images and their enhanced versions, across all
+    locations, keyed by content hash (exact copies) and perceptual hash (the
+    same picture of the same attraction at a different size or encoding).
+    Duplicates found in the index are linked to rather than downloaded,
+    stored, and enhanced again.
+
+    Safe to use from several threads and processes at once.
+    """
+
+    def __init__(self, db_path='images.db', max_distance=4, max_aspect_diff=0.05, cities=()):
+        """
+        Parameters
+        ----------
+        db_path : str
+            path to the SQLite database file. Created if it doesn't exist.
+        max_distance : int
+            maximum number of bits that perceptual hashes of the same picture
+            can differ by.
+        max_aspect_diff : float
+            maximum relative difference in aspect ratio between images of the
+            same picture (perceptual hashes ignore aspect ratio).
+        cities : set of str
+            the locations that are cities, for matching them to their regions
+            (see related_locations()).
+        """
+
+        self.db_path = db_path
+        self.max_distance = max_distance
+        self.max_aspect_diff = max_aspect_diff
+        self.cities = set(cities)
+        with closing(self._connect()) as conn, conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS images (
+                    path TEXT PRIMARY KEY,
+                    sha256 TEXT NOT NULL,
+                    dhash TEXT NOT NULL,
+                    width INTEGER NOT NULL,
+                    height INTEGER NOT NULL,
+                    file_size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    picture TEXT NOT NULL,
+                    location TEXT,
+                    attraction TEXT,
+                    added REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS images_sha256 ON images (sha256);
+                CREATE INDEX IF NOT EXISTS images_picture ON images (picture);
+                CREATE INDEX IF NOT EXISTS images_attraction ON images (attraction);
+                CREATE TABLE IF NOT EXISTS enhanced (
+                    source TEXT NOT NULL,
+                    settings TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    file_size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    PRIMARY KEY (source, settings)
+                );
+                CREATE TABLE IF NOT EXISTS image_info (
+                    path TEXT PRIMARY KEY,
+                    format TEXT NOT NULL,
+                    width INTEGER NOT NULL,
+                    height INTEGER NOT NULL,
+                    file_size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    sha256 TEXT
+                );
+            """)
+
+    def _connect(self):
+        # use as `with closing(self._connect()) as conn, conn:`, to commit, then close
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _row(self, conn, path):
+        """Get an image's row if it's indexed and unchanged since, else None."""
+
+        row = conn.execute("""
+            SELECT sha256, dhash, width, height, file_size, mtime, picture
+            FROM images WHERE path = ?""", (path,)).fetchone()
+        if row is None:
+            return None
+        stat = os.stat(path)
+        if (row[4], row[5]) != (stat.st_size, stat.st_mtime):
+            return None
+        return row
+
+    def info(self, paths):
+        """
+        Get the metadata of images (see read_info()) without decoding them,
+        from the index if they're unchanged since they were last read (same
+        size and mtime), otherwise reading and indexing it.
+
+        Parameters
+        ----------
+        paths : str or list
+            path to an image, or a list of paths.
+
+        Returns
+        -------
+        info : dict or list
+            the metadata of the image, or a list of the metadata of each.
+        """
+
+        single = isinstance(paths, str)
+        paths = [os.path.abspath(p) for p in ([paths] if single else paths)]
+        columns = ['format', 'width', 'height', 'file_size', 'mtime', 'sha256']
+        with closing(self._connect()) as conn, conn:
+            rows = {}
+            for i in range(0, len(paths), 500):  # stay under SQLite's limit on parameters
+                batch = paths[i:i + 500]
+                rows.update((row[0], dict(zip(columns, row[1:]))) for row in conn.execute(f"""
+                    SELECT path, {', '.join(columns)} FROM image_info
+                    WHERE path IN ({', '.join('?' * len(batch))})""", batch))
+        infos, stale = [], []
+        for path in paths:
+            info = rows.get(path)
+            stat = os.stat(path)
+            if info is None or (info['file_size'], info['mtime']) != (stat.st_size, stat.st_mtime):
+                info = read_info(path)
+                rows[path] = info
+                stale.append(path)
+            infos.append(info)
+        if stale:
+            with closing(self._connect()) as conn, conn:
+                conn.executemany(f"""
+                    INSERT OR REPLACE INTO image_info (path, {', '.join(columns)})
+                    VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    [(path, *(rows[path][c] for c in columns)) for path in set(stale)])
+        return infos[0] if single else infos
+
+    def content_hash(self, path):
+        """
+        Get an image's SHA-256 hash, from the index if it's unchanged since
+        it was hashed, otherwise hashing it and recording the hash with the
+        image's metadata (see info()). Only computed where an image's exact
+        content matters, since it reads the whole file.
+        """
+
+        path = os.path.abspath(path)
+        info = self.info(path)
+        if info['sha256'] is None:
+            info['sha256'] = hash_file(path)
+            with closing(self._connect()) as conn, conn:
+                conn.execute("""
+                    UPDATE image_info SET sha256 = ?
+                    WHERE path = ? AND file_size = ? AND mtime = ?""",
+                    (info['sha256'], path, info['file_size'], info['mtime']))
+        return info['sha256']
+
+    def find_picture(self, conn, sha256, hash_, width, height, attraction=None):
+        """
+        Find the picture id of an image already indexed with the same content,
+        or of the same attraction with a close enough perceptual hash and
+        aspect ratio. Perceptual hashes aren't compared across attractions,
+        since similar pictures of different attractions (e.g. skylines or
+        beaches) can hash alike.
+
+        Returns
+        -------
+        picture : str or None
+            the picture id, or None if the picture isn't indexed.
+        """
+
+        row = conn.execute("SELECT picture FROM images WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone()
+        if row is not None or attraction is None:
+            return None if row is None else row[0]
+        aspect = width / height
+        best, best_distance = None, self.max_distance + 1
+        for other_hash, other_w, other_h, picture in conn.execute(
+                "SELECT dhash, width, height, picture FROM images WHERE attraction = ?", (attraction,)):
+            if abs(other_w / other_h / aspect - 1) > self.max_aspect_diff:
+                continue
+            distance = hamming(hash_, int(other_hash, 16))
+            if distance < best_distance:
+                best, best_distance = picture, distance
+        return best
+
+    def add(self, path, location=None, attraction=None):
+        """
+        Add an image to the index, if it isn't already.
+
+        Parameters
+        ----------
+        path : str
+            path to the image.
+        location : str
+            the location the image was downloaded for.
+        attraction : str
+            the attraction the image was downloaded for.
+
+        Returns
+        -------
+        duplicate : str or None
+            path to an existing, indexed, byte-for-byte copy of the image, or
+            None if there isn't one.
+        """
+
+        path = os.path.abspath(path)
+        with closing(self._connect()) as conn, conn:
+            if self._row(conn, path) is not None:
+                return self.find_copy(path)
+        sha256 = self.content_hash(path)
+        hash_ = dhash(path)
+        info = self.info(path)
+        width, height = info['width'], info['height']
+        stat = os.stat(path)
+        with closing(self._connect()) as conn, conn:
+            old = conn.execute("SELECT location, attraction FROM images WHERE path = ?", (path,)).fetchone()
+            if old is not None:  # re-indexing a changed file
+                location = old[0] if location is None else location
+                attraction = old[1] if attraction is None else attraction
+            picture = self.find_picture(conn, sha256, hash_, width, height, attraction) or sha256
+            conn.execute("""
+                INSERT OR REPLACE INTO images (path, sha256, dhash, width, height, file_size,
+                                               mtime, picture, location, attraction, added)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (path, sha256, f"{hash_:016x}", width, height, stat.st_size, stat.st_mtime,
+                 picture, location, attraction, time.time()))
+        return self.find_copy(path)
+
+    def find_copy(self, path):
+        """Get the path to another existing, indexed, byte-for-byte copy of an image, or None."""
+
+        path = os.path.abspath(path)
+        with closing(self._connect()) as conn, conn:
+            rows = conn.execute("""
+                SELECT path FROM images
+                WHERE sha256 = (SELECT sha256 FROM images WHERE path = ?) AND path != ?
+                ORDER BY added""", (path, path)).fetchall()
+        for other, in rows:
+            if os.path.isfile(other):
+                return other
+        return None
+
+    def link_copy(self, path):
+        """
+        Replace an image with a hard link to an indexed byte-for-byte copy of
+        it (see find_copy()), so the copies only take up disk space once.
+
+        Returns
+        -------
+        copy : str or None
+            path to the copy linked to, or None if there isn't one.
+        """
+
+        path = os.path.abspath(path)
+        copy = self.find_copy(path)
+        if copy is None:
+            return None
+        link_or_copy(copy, path)
+        stat = os.stat(path)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE images SET file_size = ?, mtime = ? WHERE path = ?",
+                         (stat.st_size, stat.st_mtime, path))
+        return copy
+
+    def find_attraction(self, attraction, location):
+        """
+        Find an image already downloaded for the same attraction in the same
+        or a related location (see related_locations()), e.g. for 'CN Tower'
+        in 'Toronto, Ontario' after 'Ontario, Canada' was done.
+
+        Returns
+        -------
+        path : str or None
+            path to the image, or None if there isn't one.
+        """
+
+        with closing(self._connect()) as conn, conn:
+            rows = conn.execute("""
+                SELECT path, location FROM images WHERE attraction = ? ORDER BY added""",
+                (attraction,)).fetchall()
+        for path, other_location in rows:
+            if other_location is not None and related_locations(location, other_location, self.cities) \
+                    and os.path.isfile(path):
+                return path
+        return None
+
+    def add_enhanced(self, source_path, settings, output_path):
+        """
+        Record an image's enhanced version.
+
+        Parameters
+        ----------
+        source_path : str
+            path to the original image.
+        settings : str
+            key of the enhance settings used (see Enhance.settings_key()).
+        output_path : str
+            path to the enhanced image.
+        """
+
+        source_path = os.path.abspath(source_path)
+        self.add(source_path)
+        stat = os.stat(output_path)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO enhanced (source, settings, path, file_size, mtime)
+                VALUES (?, ?, ?, ?, ?)""",
+                (source_path, settings, os.path.abspath(output_path), stat.st_size, stat.st_mtime))
+
+    def find_enhanced(self, source_path, settings):
+        """
+        Find an enhanced version of an image, or of another image of the same
+        picture that's at least as big, made with the same settings.
+
+        Parameters
+        ----------
+        source_path : str
+            path to the original image.
+        settings : str
+            key of the enhance settings (see Enhance.settings_key()).
+
+        Returns
+        -------
+        path : str or None
+            path to the enhanced image, or None if there isn't one.
+        """
+
+        source_path = os.path.abspath(source_path)
+        self.add(source_path)
+        with closing(self._connect()) as conn, conn:
+            width, height, picture = conn.execute(
+                "SELECT width, height, picture FROM images WHERE path = ?", (source_path,)).fetchone()
+            rows = conn.execute("""
+                SELECT enhanced.path, enhanced.file_size, enhanced.mtime FROM enhanced JOIN images ON enhanced.source = images.path
+                WHERE images.picture = ? AND enhanced.settings = ?
+                    AND images.width >= ? AND images.height >= ?
+                ORDER BY images.width * images.height DESC""",
+                (picture, settings, width, height)).fetchall()
+        for path, file_size, mtime in rows:
+            # skip outputs that have since been deleted or replaced
+            if os.path.isfile(path) and (os.path.getsize(path), os.path.getmtime(path)) == (file_size, mtime):
+                return path
+        return None
@@ -0,0 +1,195 @@
+import struct
+
+
+# JPEG start-of-frame markers, which hold the image dimensions
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                    0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# JPEG markers that aren't followed by a segment length
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8, 0xD9}
+
+
+def image_format(data):
+    """
+    Get an image's format from its first few bytes.
+
+    Parameters
+    ----------
+    data : bytes
+        the start of the image file (at least 12 bytes).
+
+    Returns
+    -------
+    format : str or None
+        'jpeg', 'png', 'gif', 'bmp', 'webp', or 'tiff', or None if the data
+        isn't the start of an image in one of these formats.
+    """
+
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if data[:2] == b'BM':
+        return 'bmp'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if data[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'tiff'
+    return None
+
+
+def _jpeg_size(data):
+    i = 2  # skip the start-of-image marker
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            raise ValueError("invalid JPEG marker")
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            i += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            if i + 9 > len(data):
+                return None
+            h, w = struct.unpack('>HH', data[i + 5:i + 9])
+            return w, h
+        length, = struct.unpack('>H', data[i + 2:i + 4])
+        i += 2 + length
+    return None
+
+
+def _webp_size(data):
+    if len(data) < 30:
+        return None
+    chunk = data[12:16]
+    if chunk == b'VP8 ':
+        w, h = struct.unpack('<HH', data[26:30])
+        return w & 0x3FFF, h & 0x3FFF
+    if chunk == b'VP8L':
+        b = data[21:25]
+        w = 1 + (((b[1] & 0x3F) << 8) | b[0])
+        h = 1 + (((b[3] & 0xF) << 10) | (b[2] << 2) | ((b[1] & 0xC0) >> 6))
+        return w, h
+    if chunk == b'VP8X':
+        w = 1 + int.from_bytes(data[24:27], 'little')
+        h = 1 + int.from_bytes(data[27:30], 'little')
+        return w, h
+    raise ValueError("unknown WebP chunk")
+
+
+def _tiff_size(data):
+    endian = '<' if data[:2] == b'II' else '>'
+    if len(data) < 8:
+        return None
+    offset, = struct.unpack(endian + 'I', data[4:8])
+    if offset + 2 > len(data):
+        return None
+    count, = struct.unpack(endian + 'H', data[offset:offset + 2])
+    if offset + 2 + 12 * count > len(data):
+        return None
+    size = {}
+    for k in range(count):
+        entry = data[offset + 2 + 12 * k:offset + 14 + 12 * k]
+        tag, typ = struct.unpack(endian + 'HH', entry[:4])
+        if tag in (256, 257):  # ImageWidth, ImageLength
+            fmt = endian + ('H' if typ == 3 else 'I')
+            size[tag] = struct.unpack(fmt, entry[8:8 + struct.calcsize(fmt)])[0]
+    if 256 not in size or 257 not in size:
+        raise ValueError("TIFF has no dimensions")
+    return size[256], size[257]
+
+
+def image_size(data):
+    """
+    Get an image's pixel dimensions from the start of its file, without
+    decoding it.
+
+    Parameters
+    ----------
+    data : bytes
+        the start of the image file.
+
+    Returns
+    -------
+    size : tuple or None
+        (width, height), or None if more data is needed to find them.
+
+    Raises
+    ------
+    ValueError
+        if the data isn't a valid image header.
+    """
+
+    fmt = image_format(data)
+    if fmt is None:
+        if len(data) < 12:
+            return None
+        raise ValueError("not a supported image format")
+    try:
+        if fmt == 'jpeg':
+            return _jpeg_size(data)
+        if fmt == 'png':
+            if len(data) < 24:
+                return None
+            if data[12:16] != b'IHDR':
+                raise ValueError("PNG has no IHDR chunk")
+            return struct.unpack('>II', data[16:24])
+        if fmt == 'gif':
+            if len(data) < 10:
+                return None
+            return struct.unpack('<HH', data[6:10])
+        if fmt == 'bmp':
+            if len(data) < 26:
+                return None
+            w, h = struct.unpack('<ii', data[18:26])
+            return w, abs(h)  # height is negative for top-down bitmaps
+        if fmt == 'webp':
+            return _webp_size(data)
+        return _tiff_size(data)
+    except struct.error:
+        raise ValueError(f"invalid {fmt} header")
+
+
+def probe_file(path, max_bytes=2**20, chunk_size=2**14):
+    """
+    Get an image file's format and pixel dimensions by reading only as much
+    of its header as needed.
+
+    Parameters
+    ----------
+    path : str
+        path to the image file.
+    max_bytes : int
+        maximum number of bytes to read before giving up.
+    chunk_size : int
+        number of bytes to read at a time.
+
+    Returns
+    -------
+    format : str
+        the image format (see image_format()).
+    size : tuple
+        (width, height).
+
+    Raises
+    ------
+    ValueError
+        if the file isn't a supported image, or its dimensions aren't within
+        the first max_bytes bytes.
+    """
+
+    data = b''
+    with open(path, 'rb') as f:
+        while len(data) < max_bytes:
+            chunk = f.read(chunk_size)
+            data += chunk
+            size = image_size(data)
+            if size is not None:
+                return image_format(data), size
+            if not chunk:
+                break
+    raise ValueError(f"couldn't find image dimensions in {path}")
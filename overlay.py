@@ -0,0 +1,230 @@
+import functools
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+
+@functools.lru_cache(maxsize=64)
+def load_font(font, size):
+    """
+    Load a TrueType font once per process and size.
+
+    Parameters
+    ----------
+    font : str
+        font name or file (e.g. 'Amiri-regular' or 'arialbd.ttf'). The name,
+        then the name with '.ttf' (with and without a capitalized style) are
+        tried, falling back to Pillow's default font.
+    size : int
+        font size in pixels.
+
+    Returns
+    -------
+    font : PIL.ImageFont.FreeTypeFont
+    """
+
+    candidates = [font]
+    if not font.lower().endswith(('.ttf', '.otf')):
+        family, _, style = font.partition('-')
+        candidates += [f"{font}.ttf", f"{family}-{style.capitalize()}.ttf"]
+    for candidate in candidates:
+        try:
+            return ImageFont.truetype(candidate, size)
+        except OSError:
+            continue
+    print(f"font {font} not found, using the default font")
+    return ImageFont.load_default(size)
+
+
+def caption_sprite(text, w, h, font='Amiri-regular', font_scale=0.067,
+                   color=(255, 255, 255), box_color=(0, 0, 0), box_opacity=0.6,
+                   text_x=0.025):
+    """
+    Render a caption bar once, as an RGBA image: text on a translucent box
+    that spans the width of the video.
+
+    Parameters
+    ----------
+    text : str
+        the caption.
+    w : int
+        width of the video.
+    h : int
+        height of the video.
+    font : str
+        font name or file (see load_font()).
+    font_scale : float
+        font size relative to h.
+    color : tuple
+        RGB text color.
+    box_color : tuple
+        RGB box color.
+    box_opacity : float
+        opacity of the box, from 0 to 1.
+    text_x : float
+        left edge of the text in the box, relative to w.
+
+    Returns
+    -------
+    sprite : numpy.ndarray
+        uint8 array of shape (box height, w, 4).
+    """
+
+    font = load_font(font, int(font_scale * h))
+    ascent, descent = font.getmetrics()
+    text_h = ascent + descent
+    box_h = int(1.2 * text_h)
+    sprite = Image.new('RGBA', (w, box_h), (*box_color, int(round(255 * box_opacity))))
+    draw = ImageDraw.Draw(sprite)
+    draw.text((int(text_x * w), (box_h - text_h) // 2), text, fill=(*color, 255), font=font)
+    return np.asarray(sprite)
+
+
+class TextOverlay():
+    """
+    Blend a pre-rendered sprite (e.g. a caption from caption_sprite()) onto a
+    clip's frames as it moves along a path, touching only the pixels it
+    overlaps. Same result as a CompositeVideoClip of the clip and an
+    ImageClip of the sprite, without compositing whole frames.
+    """
+
+    def __init__(self, sprite, position, start=0, end=None, fps=None):
+        """
+        Parameters
+        ----------
+        sprite : numpy.ndarray
+            uint8 RGBA array of shape (height, width, 4).
+        position : function
+            t -> (x, y), the sprite's top left corner in the frame, in pixels,
+            with t from the start of the overlay.
+        start : float
+            time, in seconds from the start of the clip, the overlay starts.
+        end : float
+            time the overlay ends, or None to last until the end of the clip.
+        fps : int
+            frame rate to precompute the overlay's positions at, or None to
+            compute them as needed.
+        """
+
+        self.rgb = sprite[..., :3].astype(np.uint16)
+        alpha = sprite[..., 3:].astype(np.uint16)
+        self.alpha = alpha / 255  # for masks
+        self.inv_alpha = 255 - alpha
+        self.rgb *= alpha  # premultiplied, scaled by 255
+        self.sprite_h, self.sprite_w = sprite.shape[:2]
+        self.position = position
+        self.start = start
+        self.end = end
+        self.fps = fps
+        self.positions = None
+        if fps is not None and end is not None:
+            n = int(np.ceil((end - start) * fps))
+            self.positions = [self._position(start + i / fps) for i in range(n)]
+
+    def _position(self, t):
+        x, y = self.position(t - self.start)
+        return int(x), int(y)
+
+    def region(self, t, w, h):
+        """
+        Get where the sprite overlaps a w x h frame at time t.
+
+        Returns
+        -------
+        region : tuple or None
+            (frame slices, sprite slices), or None if the sprite isn't
+            showing.
+        """
+
+        if t < self.start or (self.end is not None and t >= self.end):
+            return None
+        i = None if self.positions is None else int(round((t - self.start) * self.fps))
+        if i is not None and i < len(self.positions) and abs(self.start + i / self.fps - t) < 1e-6:
+            x, y = self.positions[i]
+        else:
+            x, y = self._position(t)
+        x1, y1 = max(x, 0), max(y, 0)
+        x2, y2 = min(x + self.sprite_w, w), min(y + self.sprite_h, h)
+        if x1 >= x2 or y1 >= y2:
+            return None
+        return ((slice(y1, y2), slice(x1, x2)),
+                (slice(y1 - y, y2 - y), slice(x1 - x, x2 - x)))
+
+    def blend(self, frame, t, in_place=False):
+        """
+        Blend the sprite onto a frame at time t.
+
+        Parameters
+        ----------
+        frame : numpy.ndarray
+            uint8 array of shape (height, width, 3).
+        t : float
+            time, in seconds from the start of the clip.
+        in_place : bool
+            whether frame can be changed, rather than copied (only if nothing
+            else holds on to it).
+
+        Returns
+        -------
+        frame : numpy.ndarray
+            the blended frame (the same frame, if the sprite isn't showing).
+        """
+
+        region = self.region(t, frame.shape[1], frame.shape[0])
+        if region is None:
+            return frame
+        (fy, fx), (sy, sx) = region
+        if not in_place or not frame.flags.writeable:
+            frame = frame.copy()
+        part = frame[fy, fx].astype(np.uint16)
+        part *= self.inv_alpha[sy, sx]
+        part += self.rgb[sy, sx]
+        part //= 255
+        frame[fy, fx] = part
+        return frame
+
+    def blend_mask(self, mask, t):
+        """
+        Blend the sprite's alpha onto a clip's mask frame at time t, like a
+        composite clip's mask.
+        """
+
+        region = self.region(t, mask.shape[1], mask.shape[0])
+        if region is None:
+            return mask
+        (fy, fx), (sy, sx) = region
+        mask = mask.copy()
+        alpha = self.alpha[sy, sx, 0]
+        mask[fy, fx] = alpha + (1 - alpha) * mask[fy, fx]
+        return mask
+
+    def apply(self, clip):
+        """
+        Overlay the sprite onto a clip.
+
+        Parameters
+        ----------
+        clip : VideoClip
+            the clip to overlay (e.g. an animated image).
+
+        Returns
+        -------
+        VideoClip
+            the clip with the overlay. If clip has a mask (e.g. from a
+            crossfade), its frames are premultiplied by it, as in a
+            CompositeVideoClip, and the sprite is added to the mask.
+        """
+
+        def frame(get_frame, t):
+            f = get_frame(t)
+            premultiplied = False
+            if clip.mask is not None:
+                m = clip.mask.get_frame(t)
+                if m.min() < 1:
+                    f = (f * m[..., None].astype(np.float32)).astype(np.uint8)
+                    premultiplied = True
+            return self.blend(f, t, in_place=premultiplied)
+
+        new_clip = clip.fl(frame)
+        if clip.mask is not None:
+            new_clip = new_clip.set_mask(clip.mask.fl(lambda get_frame, t: self.blend_mask(get_frame(t), t)))
+        return new_clip
@@ -0,0 +1,190 @@
+import time
+import threading
+import email.utils
+
+
+# status codes that mean a host wants us to slow down
+BACKOFF_STATUSES = {429, 500, 502, 503, 504}
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header into a number of seconds to wait.
+
+    Parameters
+    ----------
+    value : str or None
+        the header value, either a number of seconds or an HTTP date.
+
+    Returns
+    -------
+    seconds : float or None
+        seconds to wait, or None if the header is missing or invalid.
+    """
+
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class TokenBucket():
+    """
+    Thread-safe token bucket that allows bursts of up to `burst` requests,
+    refilled at `rate` requests per second. The rate backs off when the host
+    pushes back and recovers gradually once requests succeed again.
+    """
+
+    def __init__(self, rate, burst=1, min_rate=None, backoff_factor=2.0,
+                 base_backoff=1.0, max_backoff=120.0, recovery=0.1):
+        """
+        Parameters
+        ----------
+        rate : float
+            requests per second allowed when the host isn't pushing back.
+        burst : int
+            maximum number of requests that can be made at once.
+        min_rate : float
+            lowest rate to back off to. Defaults to rate / 16.
+        backoff_factor : float
+            factor the rate is divided by each time the host pushes back.
+        base_backoff : float
+            seconds to pause after the first push back without a Retry-After
+            header, doubled for each push back in a row.
+        max_backoff : float
+            maximum seconds to pause after a push back.
+        recovery : float
+            fraction of the full rate added back after each success.
+        """
+
+        assert rate > 0, "rate must be positive"
+        assert burst >= 1, "burst must be at least 1"
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = rate / 16 if min_rate is None else min_rate
+        self.backoff_factor = backoff_factor
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.recovery = recovery
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.failures = 0  # push backs in a row
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Wait until a request is allowed, then use up a token for it."""
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def success(self):
+        """Record a successful request, recovering some of the rate."""
+
+        with self.lock:
+            self.failures = 0
+            self.rate = min(self.max_rate, self.rate + self.recovery * self.max_rate)
+
+    def backoff(self, retry_after=None):
+        """
+        Record that the host pushed back, slowing the rate and pausing
+        requests.
+
+        Parameters
+        ----------
+        retry_after : float
+            seconds the host asked us to wait (from a Retry-After header).
+            If None, pause for an exponentially increasing time.
+        """
+
+        with self.lock:
+            self.failures += 1
+            self.rate = max(self.min_rate, self.rate / self.backoff_factor)
+            if retry_after is None:
+                retry_after = self.base_backoff * 2 ** (self.failures - 1)
+            pause = min(self.max_backoff, retry_after)
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + pause)
+            self.tokens = 0.0
+            self.updated = now
+
+
+class RateLimiter():
+    """
+    Per-host rate limiter, shared by every client that talks to the same
+    hosts (e.g. the scraper and the image downloader), with one TokenBucket
+    per host.
+    """
+
+    def __init__(self, rates=None, default_rate=4.0, default_burst=8, **bucket_kwargs):
+        """
+        Parameters
+        ----------
+        rates : dict
+            maps host name -> (rate, burst) for hosts with their own limits,
+            e.g. {'www.tripadvisor.com': (0.2, 1)}.
+        default_rate : float
+            requests per second for hosts not in rates.
+        default_burst : int
+            burst size for hosts not in rates.
+        **bucket_kwargs
+            extra arguments for each host's TokenBucket (e.g. max_backoff).
+        """
+
+        self.rates = {} if rates is None else dict(rates)
+        self.default_rate = default_rate
+        self.default_burst = default_burst
+        self.bucket_kwargs = bucket_kwargs
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, host):
+        """Get a host's token bucket, making it if needed."""
+
+        with self.lock:
+            if host not in self.buckets:
+                rate, burst = self.rates.get(host, (self.default_rate, self.default_burst))
+                self.buckets[host] = TokenBucket(rate, burst, **self.bucket_kwargs)
+            return self.buckets[host]
+
+    def wait(self, host):
+        """Wait until a request to a host is allowed."""
+
+        self.bucket(host).acquire()
+
+    def feedback(self, host, status, retry_after=None):
+        """
+        Adapt a host's rate to a response.
+
+        Parameters
+        ----------
+        host : str
+            the host that responded.
+        status : int
+            the response's HTTP status code.
+        retry_after : str
+            the response's Retry-After header, if any.
+        """
+
+        if status in BACKOFF_STATUSES:
+            self.bucket(host).backoff(parse_retry_after(retry_after))
+        else:
+            self.bucket(host).success()
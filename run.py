@@ -3,17 +3,106 @@ import pandas as pd
 from pathlib import Path
 from scrape import TripAdvisorScrape
 from bing_image_downloader import downloader
-from enhance_image import Enhance
-from gen_video import Video
+from scheduler import PipelineScheduler, Stage
+from state import StateStore
+from cache import ArtifactCache, make_key, link_or_copy
+from image_index import ImageIndex
+from ratelimit import RateLimiter
+from transport import ConnectionPool, RecordingTransport, ReplayTransport, RewriteTransport
 
 
-# set directories and image size
+# set directories and image sizes
 attractions_dir = 'attractions'
 image_dir = 'images'
 enhanced_subdir = 'enhance'
 video_dir = 'videos'
 audio_dir = 'audio'
-image_size = 'wallpaper'  # 'small', 'medium', 'large', or 'wallpaper'
+video_resolution = (3840, 2160)  # 4K; images are enhanced to exactly fit this
+image_target_size = video_resolution  # images at least this big are in the top size tier
+# smaller images can't be enhanced (4x) to the video resolution
+image_min_size = (video_resolution[0] // 4, video_resolution[1] // 4)
+image_max_aspect_error = 0.7  # max |log(aspect ratio / (16/9))|, roughly 8:9 to 32:9
+image_max_bytes = 50 * 2**20  # max image file size
+
+# locations manager, and the state store that records progress through it
+locations_csv = 'locations.csv'
+state_db = 'locations.db'
+
+# index of every location's images, to reuse images and enhanced images of
+# the same attraction or picture across locations
+image_index_db = 'images.db'
+
+# image download concurrency and politeness budget: at most
+# max_requests_per_host requests in flight per host, and per-host token
+# bucket rate limits of (requests per second, burst size), shared by the
+# scraper and the image downloader. Rates back off when a host responds
+# with 429 or 5xx, and recover as requests succeed.
+download_workers = 8
+max_requests_per_host = 4
+host_rates = {
+    'www.tripadvisor.com': (0.2, 1),
+    'www.tripadvisor.ca': (0.2, 1),
+    'www.bing.com': (2.0, 2),
+}
+default_host_rate = (4.0, 8)  # for image hosts
+
+# ESRGAN model for image enhancement: a local SavedModel directory, or None
+# for the TF Hub model (or the ESRGAN_MODEL_PATH environment variable)
+esrgan_model_path = None
+
+# largest tile (in input pixels) to enhance at once, and the overlap between
+# tiles; smaller tiles use less memory. None enhances whole images at once
+esrgan_tile_size = 512
+esrgan_tile_overlap = 32
+
+# queue directory of a running enhancement worker (python enhance_worker.py
+# <dir>) to send images to, so parallel runs share one warm copy of the
+# model, or None to load the model in this process
+enhance_worker_dir = None
+
+# videos rendered for each location, from the same clips in one pass: dicts
+# with a 'name' (appended to the file name, None for none) and optionally a
+# 'resolution', 'fps', and 'encoder' (see encoder.py's PROFILES), e.g.
+#   {'name': 'short', 'resolution': (1080, 1920), 'fps': 30, 'encoder': 'x264-fast'}
+video_outputs = [{'name': None, 'resolution': video_resolution, 'fps': 60}]
+
+# render a quick, low resolution draft of each video (<location>_preview.mp4)
+# from the same clip plan, to check its images, captions, and animations:
+# None for no draft, 'before' the full render, or 'only' (no full render)
+video_preview = None
+
+# processes to render each video in, one segment per clip, or None for one
+# per core; 1 renders the whole video in one pass
+video_render_workers = None
+
+# HTTP mode for scraping and image downloads:
+#   'live' makes real requests,
+#   'record' makes real requests and records every response to http_archive_dir,
+#   'replay' serves recorded responses from http_archive_dir, without the network.
+# If http_stub_url is set (e.g. 'http://127.0.0.1:8000', see transport.py's
+# ArchiveServer), live and record requests go to that server instead.
+http_mode = 'live'
+http_archive_dir = 'http_archive'
+http_stub_url = None
+
+# content-addressed cache of stage outputs, bounded in size (bytes)
+cache_dir = 'cache'
+cache_max_size = 100 * 2**30
+# age (in seconds) after which cached attractions are scraped again, so
+# clearing 'Scraped' picks up trip advisor's changes. None to never expire
+scrape_max_age = 24 * 3600
+
+# cache of images cropped and scaled for the video clips and thumbnails,
+# kept apart from the artifact cache (with its own size budget) since the
+# uncompressed arrays are big and cheap to remake, and shouldn't evict
+# enhanced images or rendered videos
+asset_cache_dir = 'cache_assets'
+asset_cache_max_size = 20 * 2**30
+
+# number of locations each worker pool processes at once
+scrape_workers = 2  # trip advisor scraping (network-bound)
+image_workers = 4  # image downloads (network-bound)
+cpu_workers = 1  # image enhancement and video rendering (CPU-bound)
 
 
 def make_dir(dir):
@@ -30,9 +119,40 @@ def make_dir(dir):
         os.makedirs(dir)
 
 
-def image_download(query, extra_query, output_dir, image_size='medium'):
+def make_transport(**kwargs):
     """
-    Download an image from Bing for a query.
+    Make an HTTP client for the configured http_mode.
+
+    Parameters
+    ----------
+    **kwargs
+        arguments for the ConnectionPool that makes live requests.
+    """
+
+    assert http_mode in ['live', 'record', 'replay'], \
+        "http_mode must be 'live', 'record', or 'replay'"
+    if http_mode == 'replay':
+        return ReplayTransport(http_archive_dir)
+    transport = ConnectionPool(**kwargs)
+    if http_stub_url is not None:
+        transport = RewriteTransport(http_stub_url, transport)
+    if http_mode == 'record':
+        transport = RecordingTransport(http_archive_dir, transport)
+    return transport
+
+
+# HTTP clients shared by all scrapes and all image downloads, which keep
+# connections alive and share one per-host rate limiter
+rate_limiter = RateLimiter(host_rates, default_rate=default_host_rate[0],
+                           default_burst=default_host_rate[1])
+scrape_transport = make_transport(max_per_host=1, rate_limiter=rate_limiter)
+http_pool = make_transport(max_per_host=max_requests_per_host, rate_limiter=rate_limiter)
+
+
+def best_image_job(query, extra_query, output_dir):
+    """
+    Get the downloader arguments to download the best image from Bing for a
+    query, picked from all size tiers at once.
 
     Parameters
     ----------
@@ -43,21 +163,13 @@ def image_download(query, extra_query, output_dir, image_size='medium'):
         the output file name.
     output_dir : str
         the directory to save the image to.
-    image_size : str
-        the size of the image to download.
-        'small', 'medium', 'large', or 'wallpaper'.
     """
 
-    # check image size
-    assert image_size in ['small', 'medium', 'large', 'wallpaper'], \
-        "image_size is must be 'small', 'medium', 'large', or 'wallpaper'"
-
-    # download image
-    filters = f"+filterui:aspect-wide+filterui:license-L1+filterui:imagesize-{image_size}"
-    downloader.download(query, extra_query=extra_query, limit=1,
-                        output_dir=output_dir, adult_filter_off=False,
-                        force_replace=False, timeout=60, filters=filters,
-                        query_folder=False)
+    filters = "+filterui:aspect-wide+filterui:license-L1"
+    return dict(query=query, extra_query=extra_query, output_dir=output_dir,
+                adult_filter_off=False, timeout=60, filters=filters,
+                target_size=image_target_size, min_size=image_min_size,
+                max_aspect_error=image_max_aspect_error, max_bytes=image_max_bytes)
 
 
 def sort_attractions(path, attractions):
@@ -79,11 +191,262 @@ def sort_attractions(path, attractions):
     return all_attractions.index(attr)
 
 
+def get_cache():
+    """Get the artifact cache shared by all stages."""
+
+    return ArtifactCache(cache_dir, max_size=cache_max_size)
+
+
+def get_asset_cache():
+    """Get the cache of images prepared for videos and thumbnails."""
+
+    from asset_cache import AssetCache
+    return AssetCache(ArtifactCache(asset_cache_dir, max_size=asset_cache_max_size))
+
+
+def get_index():
+    """Get the image index shared by all stages."""
+
+    locations = pd.read_csv(locations_csv, encoding='cp1252')
+    cities = locations.loc[locations['City'].notna(), 'Location']
+    return ImageIndex(image_index_db, cities=cities)
+
+
+def readable_image(index, path):
+    """Whether a file is an image whose dimensions can be read (see ImageIndex.info())."""
+
+    try:
+        index.info(path)
+        return True
+    except (ValueError, OSError):
+        print(f"skipping {path}, not a readable image")
+        return False
+
+
+def find_image(output_dir, query):
+    """
+    Find the image downloaded for a query, whatever its file extension.
+
+    Parameters
+    ----------
+    output_dir : str
+        the directory the image was downloaded to.
+    query : str
+        the query the image was downloaded for.
+
+    Returns
+    -------
+    path : str or None
+        path to the image, or None if there isn't one.
+    """
+
+    if not os.path.isdir(output_dir):
+        return None
+    for file in os.listdir(output_dir):
+        path = f"{output_dir}\\{file}"
+        if '.'.join(file.split('.')[:-1]) == query and os.path.isfile(path):
+            return path
+    return None
+
+
+def scrape_location(loc, helper_url=None):
+    """
+    Scrape trip advisor for a location's attractions and save them to a csv.
+
+    Parameters
+    ----------
+    loc : str
+        the location to scrape (e.g. 'Toronto, Ontario').
+    helper_url : str
+        a URL to use instead of searching trip advisor for the location.
+    """
+
+    print(f"getting attractions for {loc}")
+    scraper = TripAdvisorScrape(transport=scrape_transport)
+    output_path = f"{attractions_dir}\\{loc}.csv"
+    cache = get_cache()
+    key = make_key('scrape', loc, helper_url, scraper.n)
+    if cache.restore(key, output_path, max_age=scrape_max_age) is not None:
+        print(f"restored attractions for {loc} from cache")
+        return
+    df = scraper.scrape(loc, verbose=True, helper_url=helper_url)
+    df.to_csv(output_path, index=False, encoding='cp1252')
+    cache.store(key, output_path)
+
+
+def image_location(loc):
+    """
+    Download an image for each of a location's attractions.
+
+    Parameters
+    ----------
+    loc : str
+        the location to download images for.
+    """
+
+    print(f"getting images for {loc}")
+    errors = []
+    output_dir = f"{image_dir}\\{loc}"
+    cache = get_cache()
+    attractions = pd.read_csv(f"{attractions_dir}\\{loc}.csv", encoding='cp1252')
+
+    # restore previously downloaded images from the cache, or reuse the image
+    # of the same attraction in a related location (e.g. the province a city
+    # is in)
+    index = get_index()
+    keys, to_download = {}, []
+    for attr in attractions['Attraction']:
+        keys[attr] = make_key('image', attr, loc, 'best', image_target_size)
+        restored = cache.restore(keys[attr], output_dir=output_dir)
+        if restored is not None:
+            index.add(restored, loc, attr)
+            continue
+        reuse = index.find_attraction(attr, loc)
+        if reuse is not None:
+            os.makedirs(output_dir, exist_ok=True)
+            path = f"{output_dir}\\{attr}{os.path.splitext(reuse)[1]}"
+            link_or_copy(reuse, path)
+            index.add(path, loc, attr)
+            print(f"reused image for {attr} from {reuse}")
+            continue
+        to_download.append(attr)
+
+    # download the best image for each attraction, all in parallel
+    jobs = [best_image_job(attr, loc, output_dir) for attr in to_download]
+    results = downloader.download_many(jobs, workers=download_workers,
+                                       transport=http_pool, func=downloader.download_best)
+    for attr, e in zip(to_download, results):
+        if e is not None:
+            print(e)
+            errors.append(attr)
+            continue
+        path = find_image(output_dir, attr)
+        if path is not None:
+            # index the image, linking it to any identical image downloaded before
+            index.add(path, loc, attr)
+            index.link_copy(path)
+            cache.store(keys[attr], path)
+    if errors:
+        raise Exception(f"failed to get images for {len(errors)} attractions in {loc}")
+
+
+def enhance_location(loc):
+    """
+    Enhance a location's images.
+
+    Parameters
+    ----------
+    loc : str
+        the location to enhance images for.
+    """
+
+    print(f"enhancing images for {loc}")
+    input_dir = f"{image_dir}\\{loc}"
+    output_dir = f"{image_dir}\\{loc}\\{enhanced_subdir}"
+    if enhance_worker_dir is not None:
+        from enhance_worker import EnhanceClient
+        EnhanceClient(enhance_worker_dir).enhance(
+            input_dir, output_dir, cache=get_cache(), index=get_index(), target_size=video_resolution,
+            tile_size=esrgan_tile_size, tile_overlap=esrgan_tile_overlap)
+        return
+
+    from enhance_image import Enhance  # imported here so other stages don't load TensorFlow
+
+    enhance = Enhance(input_dir, output_dir, target_size=video_resolution,
+                      cache=get_cache(), index=get_index(), model_path=esrgan_model_path,
+                      tile_size=esrgan_tile_size, tile_overlap=esrgan_tile_overlap)
+    enhance.enhance_images()
+
+
+def video_location(loc):
+    """
+    Generate a video, thumbnails, and description for a location.
+
+    Parameters
+    ----------
+    loc : str
+        the location to generate a video for.
+    """
+
+    from gen_video import Video  # imported here so other stages don't load moviepy
+
+    print(f"generating video for {loc}")
+    # get all attractions to sort image_paths by attraction rank
+    attractions = pd.read_csv(f"{attractions_dir}\\{loc}.csv", encoding='cp1252')
+    # find attractions that we have images for
+    # (sometimes use enhanced_dir = f"{image_dir}\\{loc}")
+    enhanced_dir = f"{image_dir}\\{loc}\\{enhanced_subdir}"
+    image_paths = [f"{enhanced_dir}\\{file}" for file in os.listdir(enhanced_dir)
+                   if os.path.isfile(f"{enhanced_dir}\\{file}")]
+    # skip files that aren't readable images (e.g. left by an interrupted enhancement),
+    # reading just their headers into the image index, which the video reuses
+    index = get_index()
+    image_paths = [path for path in image_paths if readable_image(index, path)]
+    # sort image_paths
+    image_paths.sort(key=lambda path: sort_attractions(path, attractions))
+    # take top x paths where x is rounded to the nearest 5
+    image_paths = image_paths[: (len(image_paths) - len(image_paths) % 5)]
+    # generate video
+    cache = get_cache()
+    video = Video(image_paths=image_paths, output_dir=f"{video_dir}\\{loc}",
+                  audio_dir=audio_dir, resolution=video_resolution, fps=60, cache=cache,
+                  outputs=video_outputs, assets=get_asset_cache(), index=index)
+    video.prepare_assets(thumbnail_resolutions=['4K', 'QHD', 'FHD', 'HD'])
+    video.gen_thumbnails(resolution=['4K', 'QHD', 'FHD', 'HD'],
+                         sub_dir=['4K', 'QHD', 'FHD', 'HD'])  # title='DENVER')
+    video.document()
+    if video_preview is not None:
+        video.gen_preview()
+    if video_preview != 'only':
+        video.gen_video(segmented=(video_render_workers != 1), workers=video_render_workers)
+
+
+# pipeline stages, in order, with the locations.csv columns that track them
+# (stage name, function, worker pool, to-do column, done column, error column)
+stages = [
+    ('scrape', scrape_location, 'scrape', 'To Scrape', 'Scraped', 'Scrape Error'),
+    ('image', image_location, 'image', 'To Image', 'Imaged', 'Image Error'),
+    ('enhance', enhance_location, 'cpu', 'To Enhance', 'Enhanced', 'Enhance Error'),
+    ('video', video_location, 'cpu', 'To Video', 'Videod', 'Video Error'),
+]
+
+
+def location_steps(locations, i):
+    """
+    Get the stages to run for a location, with the arguments to run them with.
+
+    Parameters
+    ----------
+    locations : pd.DataFrame
+        the locations manager dataframe (from locations.csv).
+    i : int
+        the index of the location in locations.
+
+    Returns
+    -------
+    steps : list
+        list of (stage_name, args) tuples, in pipeline order.
+    """
+
+    loc = locations.loc[i, 'Location']
+    steps = []
+    for name, _, _, to_col, done_col, _ in stages:
+        if locations.loc[i, to_col] == 'yes' and locations.loc[i, done_col] != 'yes':
+            if name == 'scrape':
+                # get helper url to pass into scraping process if available
+                helper_url = None
+                if pd.notna(locations.loc[i, 'Helper URL']):
+                    helper_url = locations.loc[i, 'Helper URL']
+                steps.append((name, (loc, helper_url)))
+            else:
+                steps.append((name, (loc,)))
+    return steps
+
+
 if __name__ == '__main__':
 
     # Web scraping prep
     make_dir(attractions_dir)
-    scraper = TripAdvisorScrape()
 
     # image scrape prep
     make_dir(image_dir)
@@ -91,90 +454,35 @@ if __name__ == '__main__':
     # video generation prep
     make_dir(video_dir)
 
-    # get locations to scrape and required actions
-    locations = pd.read_csv("locations.csv", encoding='cp1252')
+    # get locations to scrape and required actions. Progress is recorded in
+    # the state store as soon as each stage finishes, so a restart resumes
+    # where the last run stopped. Hand edits to locations.csv are picked up
+    # by re-importing it.
+    store = StateStore(state_db)
+    if store.is_stale(locations_csv):
+        store.import_csv(locations_csv)
+    locations = store.to_frame()
+    columns = {name: (done_col, error_col) for name, _, _, _, done_col, error_col in stages}
 
-    for i in range(len(locations)):
+    def on_done(i, name, result):
+        store.record_done(i, name, columns[name][0])
 
-        loc = locations.loc[i, 'Location']
+    def on_error(i, name, e):
+        print(e)
+        store.record_error(i, name, columns[name][1], str(e))
 
-        # scrape trip advisor for attractions
-        if locations.loc[i, 'To Scrape'] == 'yes' and locations.loc[i, 'Scraped'] != 'yes':
-            print(f"getting attractions for {loc}")
-            try:
-                # get helper url to pass into scraping process if available
-                helper_url = None
-                if pd.notna(locations.loc[i, 'Helper URL']):
-                    helper_url = locations.loc[i, 'Helper URL']
-                # scrape
-                df = scraper.scrape(loc, verbose=True, helper_url=helper_url)
-                df.to_csv(f"{attractions_dir}\\{loc}.csv", index=False, encoding='cp1252')
-                locations.loc[i, 'Scraped'] = 'yes'
-            except Exception as e:
-                print(e)
-                locations.loc[i, 'Scrape Error'] = 'yes'
-
-        # download an image for each attraction
-        if locations.loc[i, 'To Image'] == 'yes' and locations.loc[i, 'Imaged'] != 'yes':
-            print(f"getting images for {loc}")
-            errors = False
-            attractions = pd.read_csv(f"{attractions_dir}\\{loc}.csv", encoding='cp1252')
-            for j in range(len(attractions)):
-                attr = attractions.loc[j, 'Attraction']
-                try:
-                    # overwrite images with higher quality ones if they exist
-                    image_download(attr, loc, f"{image_dir}\\{loc}", image_size='medium')
-                    image_download(attr, loc, f"{image_dir}\\{loc}", image_size='large')
-                    image_download(attr, loc, f"{image_dir}\\{loc}", image_size='wallpaper')
-                except Exception as e:
-                    print(e)
-                    errors = True
-            if errors:
-                locations.loc[i, 'Image Error'] = 'yes'
-            else:
-                locations.loc[i, 'Imaged'] = 'yes'
-
-        # enhance images
-        if locations.loc[i, 'To Enhance'] == 'yes' and locations.loc[i, 'Enhanced'] != 'yes':
-            print(f"enhancing images for {loc}")
-            input_dir = f"{image_dir}\\{loc}"
-            output_dir = f"{image_dir}\\{loc}\\{enhanced_subdir}"
-            try:
-                enhance = Enhance(input_dir, output_dir, max_size_to_enhance=(1920, 1080))
-                enhance.enhance_images()
-                locations.loc[i, 'Enhanced'] = 'yes'
-            except Exception as e:
-                print(e)
-                locations.loc[i, 'Enhance Error'] = 'yes'
-
-        # generate video for location
-        if locations.loc[i, 'To Video'] == 'yes' and locations.loc[i, 'Videod'] != 'yes':
-            print(f"generating video for {loc}")
-            try:
-                # get all attractions to sort image_paths by attraction rank
-                attractions = pd.read_csv(f"{attractions_dir}\\{loc}.csv", encoding='cp1252')
-                # find attractions that we have images for
-                # (sometimes use enhanced_dir = f"{image_dir}\\{loc}")
-                enhanced_dir = f"{image_dir}\\{loc}\\{enhanced_subdir}"
-                image_paths = [f"{enhanced_dir}\\{file}" for file in os.listdir(enhanced_dir)
-                               if os.path.isfile(f"{enhanced_dir}\\{file}")]
-                # sort image_paths
-                image_paths.sort(key=lambda path: sort_attractions(path, attractions))
-                # take top x paths where x is rounded to the nearest 5
-                image_paths = image_paths[: (len(image_paths) - len(image_paths) % 5)]
-                # generate video
-                video = Video(image_paths=image_paths, output_dir=f"{video_dir}\\{loc}",
-                              audio_dir=audio_dir, resolution='4K', fps=60)
-                video.gen_thumbnails(resolution='4K', sub_dir='4K')  # title='DENVER')
-                video.gen_thumbnails(resolution='QHD', sub_dir='QHD')
-                video.gen_thumbnails(resolution='FHD', sub_dir='FHD')
-                video.gen_thumbnails(resolution='HD', sub_dir='HD')
-                video.document()
-                video.gen_video()
-                locations.loc[i, 'Videod'] = 'yes'
-            except Exception as e:
-                print(e)
-                locations.loc[i, 'Video Error'] = 'yes'
-
-    # Update locations manager
-    locations.to_csv("locations.csv", index=False, encoding='cp1252')
+    # run locations through the pipeline concurrently, with each stage in
+    # its own worker pool
+    scheduler = PipelineScheduler(
+        stages=[Stage(name, func, pool) for name, func, pool, _, _, _ in stages],
+        pools={'scrape': ('thread', scrape_workers),
+               'image': ('thread', image_workers),
+               'cpu': ('process', cpu_workers)},
+        on_done=on_done, on_error=on_error)
+    jobs = {i: location_steps(locations, i) for i in range(len(locations))}
+    try:
+        scheduler.run(jobs)
+    finally:
+        # Update locations manager
+        store.export_csv(locations_csv)
+        store.close()
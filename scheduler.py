@@ -0,0 +1,164 @@
+import concurrent.futures as cf
+
+
+class Stage():
+    """A pipeline stage and the worker pool it runs in."""
+
+    def __init__(self, name, func, pool, skip_on_error=False):
+        """
+        Parameters
+        ----------
+        name : str
+            the name of the stage (e.g. 'scrape').
+        func : callable
+            the function that runs the stage for one job. It is called with
+            the job's arguments for this stage. Must be a module-level
+            function if the stage runs in a process pool.
+        pool : str
+            the name of the worker pool the stage runs in. Several stages can
+            share a pool (e.g. all CPU-heavy stages).
+        skip_on_error : bool
+            whether a job's later stages are skipped if this stage fails for
+            it. By default they still run (e.g. a video is still made from
+            the images that did download).
+        """
+
+        self.name = name
+        self.func = func
+        self.pool = pool
+        self.skip_on_error = skip_on_error
+
+
+class PipelineScheduler():
+    """
+    Run jobs through a sequence of stages, where each stage runs in its own
+    worker pool. Jobs flow through the pipeline independently, so e.g. one
+    location can be downloading images while another is rendering a video.
+    """
+
+    def __init__(self, stages, pools, on_done=None, on_error=None):
+        """
+        Parameters
+        ----------
+        stages : list
+            list of Stage objects, in pipeline order.
+        pools : dict
+            maps pool name -> (kind, workers), where kind is 'thread' (for
+            I/O-bound stages) or 'process' (for CPU-bound stages), and workers
+            is the number of jobs the pool runs at once.
+        on_done : callable
+            called as on_done(key, stage_name, result) in the main thread
+            when a stage finishes for a job.
+        on_error : callable
+            called as on_error(key, stage_name, exception) in the main thread
+            when a stage fails for a job. The job's later stages still run,
+            unless the stage skips them (see Stage).
+        """
+
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            assert stage.pool in pools, f"no pool named {stage.pool}"
+        for name, (kind, workers) in pools.items():
+            assert kind in ['thread', 'process'], \
+                f"pool kind must be 'thread' or 'process', not {kind}"
+            assert type(workers) == int and workers >= 1, \
+                f"pool {name} must have a positive integer number of workers"
+        self.pools = pools
+        self.on_done = on_done
+        self.on_error = on_error
+        self.executors = {}
+
+    def start(self):
+        """Create the worker pools."""
+
+        for name, (kind, workers) in self.pools.items():
+            if kind == 'thread':
+                executor = cf.ThreadPoolExecutor(max_workers=workers,
+                                                 thread_name_prefix=name)
+            else:
+                executor = cf.ProcessPoolExecutor(max_workers=workers)
+            self.executors[name] = executor
+
+    def shutdown(self, cancel=False):
+        """
+        Shut down the worker pools.
+
+        Parameters
+        ----------
+        cancel : bool
+            whether to cancel jobs that haven't started yet.
+        """
+
+        for executor in self.executors.values():
+            executor.shutdown(wait=True, cancel_futures=cancel)
+        self.executors = {}
+
+    def submit(self, key, steps, index):
+        """
+        Submit a job's stage to the stage's worker pool.
+
+        Parameters
+        ----------
+        key : hashable
+            the job's key (e.g. the location name).
+        steps : list
+            list of (stage_name, args) tuples to run for the job, in order.
+        index : int
+            index of the step in steps to submit.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            the future for the submitted stage.
+        """
+
+        name, args = steps[index]
+        stage = self.stages[name]
+        return self.executors[stage.pool].submit(stage.func, *args)
+
+    def run(self, jobs):
+        """
+        Run all jobs through their stages, returning once every job has
+        either finished or failed.
+
+        Parameters
+        ----------
+        jobs : dict
+            maps job key -> list of (stage_name, args) tuples, where args is
+            a tuple of arguments to pass to the stage's function. Stages are
+            run in the given order, and should follow the pipeline order.
+        """
+
+        if not self.executors:
+            self.start()
+        pending = {}  # future -> (key, steps, index)
+        completed = True
+        try:
+            for key, steps in jobs.items():
+                if steps:
+                    pending[self.submit(key, steps, 0)] = (key, steps, 0)
+
+            while pending:
+                done, _ = cf.wait(pending, return_when=cf.FIRST_COMPLETED)
+                for future in done:
+                    key, steps, index = pending.pop(future)
+                    name = steps[index][0]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        if self.on_error is not None:
+                            self.on_error(key, name, e)
+                        if self.stages[name].skip_on_error:
+                            continue
+                    else:
+                        if self.on_done is not None:
+                            self.on_done(key, name, result)
+
+                    # pass the job on to its next stage
+                    if index + 1 < len(steps):
+                        pending[self.submit(key, steps, index + 1)] = (key, steps, index + 1)
+        except BaseException:
+            completed = False
+            raise
+        finally:
+            self.shutdown(cancel=not completed)
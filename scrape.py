@@ -1,26 +1,55 @@
 import re
-import time
 import html
-import urllib
-import urllib.request
 import pandas as pd
 from bs4 import BeautifulSoup
+from transport import ConnectionPool
+from ratelimit import RateLimiter
+
+
+# an attraction's rank and name (e.g. '>1.</span> <!-- -->CN Tower</div>'),
+# all of which are found in one pass over the page
+RANK_PATTERN = re.compile(r'>(\d+)\.</span> <!-- -->(.*?)</div>')
+
+# extra fields, searched for only within each attraction's card: a link to
+# the attraction's page (just before or after its name), its bubble rating
+# and number of reviews, and its category (the first short line of text
+# after its reviews)
+URL_PATTERN = re.compile(r'href="(/Attraction_Review-[^"#]*)"')
+REVIEWS_PATTERN = re.compile(r'aria-label="([\d.]+) of 5 bubbles\. ([\d,]+) reviews?"')
+CATEGORY_PATTERN = re.compile(r'<div[^>]*>([^<>]{2,80})</div>')
+
+# maximum number of characters before an attraction's name to look for its
+# link in, and after its name to look for its other fields in
+CARD_LOOKBEHIND = 2000
+CARD_LOOKAHEAD = 20000
+
+# number of attractions listed per page
+PAGE_SIZE = 30
 
 
 class TripAdvisorScrape():
     """
-    Scrape trip advisor for the top n=30 attractions in a location.
+    Scrape trip advisor for the top n attractions in a location.
     """
 
-    def __init__(self, n=30):
+    def __init__(self, n=30, transport=None):
         """
         n : int
-            number of attractions to scrape (1-30)
+            number of attractions to scrape. More than 30 are scraped from
+            several pages.
+        transport : ConnectionPool
+            the HTTP client to make requests with (e.g. a ReplayTransport to
+            scrape from recorded pages). If None, a new ConnectionPool is made
+            that allows one request every 5 seconds per host, backing off if
+            the host pushes back.
         """
 
-        assert type(n) == int and 1 <= n <= 30, \
-            'n is not an integer in {1, 2, ...,30}'
-        self.n = n  # number of attractions to scrape (1-30)
+        assert type(n) == int and n >= 1, 'n is not a positive integer'
+        self.n = n  # number of attractions to scrape
+        if transport is None:
+            rate_limiter = RateLimiter(default_rate=0.2, default_burst=1)
+            transport = ConnectionPool(max_per_host=1, rate_limiter=rate_limiter)
+        self.transport = transport
 
     def get_html(self, url):
         """
@@ -32,18 +61,115 @@ class TripAdvisorScrape():
             the URL to get the HTML code for.
         """
 
-        time.sleep(5)  # wait 5 seconds
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:87.0) Gecko/20100101 Firefox/87.0'
         }
-        request = urllib.request.Request(url, None, headers=headers)
-        response = urllib.request.urlopen(request)
+        response = self.transport.request(url, headers=headers)
         html_str = response.read().decode('utf8')
         return html_str
 
+    def extract_attractions(self, html_str, base_url='https://www.tripadvisor.com'):
+        """
+        Extract all ranked attractions from a page of trip advisor's
+        attractions list, in a single pass over the page plus short searches
+        within each attraction's card. Missing ranks are skipped rather than
+        failing the whole page.
+
+        Parameters
+        ----------
+        html_str : str
+            the HTML code of the page.
+        base_url : str
+            the site to make attraction URLs absolute with.
+
+        Returns
+        -------
+        attractions : list
+            list of dicts, in rank order, with keys 'Rank', 'Attraction',
+            'URL', 'Rating', 'Reviews', and 'Category'. Fields that aren't on
+            the page are None.
+        """
+
+        # find every attraction's rank and name in one pass
+        markers = []
+        seen = set()
+        for m in RANK_PATTERN.finditer(html_str):
+            rank = int(m.group(1))
+            if rank not in seen:  # skip e.g. the same list repeated elsewhere on the page
+                seen.add(rank)
+                markers.append(m)
+
+        # the attraction's link is usually just before its name
+        links = []
+        for i, m in enumerate(markers):
+            prev_end = markers[i - 1].end() if i > 0 else 0
+            card_start = max(prev_end, m.start() - CARD_LOOKBEHIND)
+            urls = list(URL_PATTERN.finditer(html_str, card_start, m.start()))
+            links.append(urls[-1] if urls else None)
+
+        # pull the extra fields from each attraction's card
+        attractions = []
+        for i, m in enumerate(markers):
+            next_start = markers[i + 1].start() if i + 1 < len(markers) else len(html_str)
+            card_end = min(next_start, m.end() + CARD_LOOKAHEAD)
+
+            # otherwise look just after its name, but not at the next attraction's link
+            url_match = links[i]
+            if url_match is None:
+                url_match = URL_PATTERN.search(html_str, m.end(), card_end)
+                next_link = links[i + 1] if i + 1 < len(markers) else None
+                if url_match is not None and next_link is not None \
+                        and url_match.start() == next_link.start():
+                    url_match = None
+            url = url_match.group(1) if url_match else None
+
+            rating, reviews, category = None, None, None
+            reviews_match = REVIEWS_PATTERN.search(html_str, m.end(), card_end)
+            if reviews_match is not None:
+                rating = float(reviews_match.group(1))
+                reviews = int(reviews_match.group(2).replace(',', ''))
+                category_match = CATEGORY_PATTERN.search(html_str, reviews_match.end(), card_end)
+                if category_match is not None:
+                    category = html.unescape(category_match.group(1)).strip()
+
+            attractions.append({
+                'Rank': int(m.group(1)),
+                'Attraction': html.unescape(m.group(2)),
+                'URL': None if url is None else base_url + url,
+                'Rating': rating,
+                'Reviews': reviews,
+                'Category': category,
+            })
+        attractions.sort(key=lambda d: d['Rank'])
+        return attractions
+
+    def page_url(self, url, offset):
+        """
+        Get the URL of the page of an attractions list starting at an offset.
+
+        Parameters
+        ----------
+        url : str
+            the URL of the first page of the list (e.g.
+            'https://www.tripadvisor.com/Attractions-g155019-Activities-a_allAttractions.true').
+        offset : int
+            the number of attractions before the page (a multiple of 30).
+
+        Returns
+        -------
+        url : str
+            the page's URL (e.g.
+            'https://www.tripadvisor.com/Attractions-g155019-Activities-oa30-a_allAttractions.true').
+        """
+
+        if offset == 0:
+            return url
+        url = re.sub(r'-oa\d+-', '-', url)
+        return url.replace('-Activities-', f'-Activities-oa{offset}-', 1)
+
     def scrape(self, location, verbose=True, helper_url=None):
         """
-        Scrape trip advisor for the top n=30 attractions in a location.
+        Scrape trip advisor for the top n attractions in a location.
 
         Parameters
         ----------
@@ -58,7 +184,9 @@ class TripAdvisorScrape():
         Returns
         -------
         df : pandas.DataFrame
-            a DataFrame of the top n=30 attractions in the location.
+            a DataFrame of the top n attractions in the location, with
+            'Rank' and 'Attraction' columns, plus 'URL', 'Rating', 'Reviews',
+            and 'Category' where they were found.
         """
 
         if helper_url is not None:
@@ -81,33 +209,29 @@ class TripAdvisorScrape():
             pattern = r'https://www\.tripadvisor\.com/Attractions-.*-Activities-'
             new_url = re.match(pattern, url).group(0)
             new_url = new_url + 'a_allAttractions.true'
-
-        # pull html from the new URL
-        new_html = self.get_html(new_url)
-
-        # extract attractions from HTML
-        df = []
-        for i in range(1, self.n + 1):
-
-            # find attraction in HTML code
-            pattern = rf'>{i}\.</span> <!-- -->.*?</div>'
-            s = re.search(pattern, new_html).group(0)
-
-            # trim off extra text
-            s = s.replace(f'>{i}.</span> <!-- -->', '')
-            s = s.replace('</div>', '')
-
-            # convert character references to unicode
-            s = html.unescape(s)
-
-            # append to df
-            d = {
-                'Rank': i,
-                'Attraction': s
-            }
-            df.append(d)
-            if verbose:
-                print(f"{i}. {s}")
+        base_url = re.match(r'https?://[^/]+', new_url).group(0)
+
+        # pull html from the new URL, and following pages if more than one
+        # page of attractions is needed, and extract attractions from it
+        attractions = {}
+        for offset in range(0, self.n, PAGE_SIZE):
+            new_html = self.get_html(self.page_url(new_url, offset))
+            page = self.extract_attractions(new_html, base_url)
+            for d in page:
+                attractions.setdefault(d['Rank'], d)
+            if not page:  # no more attractions in the list
+                break
+
+        # keep the top n, noting any ranks missing from the pages
+        df = [attractions[rank] for rank in sorted(attractions) if rank <= self.n]
+        missing = [i for i in range(1, self.n + 1) if i not in attractions]
+        if not df:
+            raise Exception(f"no attractions found for {location}")
+        if missing:
+            print(f"ranks not found for {location}: {missing}")
+        if verbose:
+            for d in df:
+                print(f"{d['Rank']}. {d['Attraction']}")
 
         # return scraped results
         df = pd.DataFrame(df)
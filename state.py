@@ -0,0 +1,278 @@
+import os
+import time
+import sqlite3
+import pandas as pd
+
+
+class StateStore():
+    """
+    Crash-safe store of each location's pipeline progress, backed by SQLite.
+
+    Holds the same table as locations.csv (one row per location, with the
+    'To Scrape'/'Scraped'/'Scrape Error'-style columns), but every change is
+    committed as soon as it happens, so a crash mid-batch loses nothing. Each
+    stage completion or error is also logged, with the error message, and
+    the progress recorded since the store was last synced with the csv is
+    kept when a hand-edited csv is imported.
+    """
+
+    def __init__(self, db_path='locations.db'):
+        """
+        Parameters
+        ----------
+        db_path : str
+            path to the SQLite database file. Created if it doesn't exist.
+        """
+
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        with self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS columns (
+                    position INTEGER PRIMARY KEY,
+                    name TEXT UNIQUE NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS cells (
+                    row INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (row, name)
+                );
+                CREATE TABLE IF NOT EXISTS events (
+                    time REAL NOT NULL,
+                    location TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    message TEXT
+                );
+                CREATE TABLE IF NOT EXISTS progress (
+                    location TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    time REAL NOT NULL,
+                    PRIMARY KEY (location, name)
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+            """)
+
+    def close(self):
+        """Close the database connection."""
+
+        self.conn.close()
+
+    def _set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                          (key, value))
+
+    def _get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def is_stale(self, csv_path):
+        """
+        Check whether a csv has changed since it was last imported to or
+        exported from the store (e.g. because it was edited by hand), so the
+        store should be refreshed from it.
+
+        Parameters
+        ----------
+        csv_path : str
+            path to the csv file (e.g. 'locations.csv').
+        """
+
+        if not os.path.exists(csv_path):
+            return False
+        synced_mtime = self._get_meta(f"mtime:{os.path.abspath(csv_path)}")
+        return synced_mtime is None or float(synced_mtime) != os.path.getmtime(csv_path)
+
+    def import_csv(self, csv_path, encoding='cp1252'):
+        """
+        Load a locations.csv-style file into the store. The csv's rows
+        replace the store's, except for stage progress (done and error
+        flags) recorded since the store was last synced with a csv, which the
+        csv can't have yet (e.g. if the csv was edited by hand after a crash).
+        That progress is kept, matching rows by 'Location'.
+
+        Parameters
+        ----------
+        csv_path : str
+            path to the csv file to import.
+        encoding : str
+            encoding of the csv file.
+        """
+
+        df = pd.read_csv(csv_path, encoding=encoding, dtype=str, keep_default_na=False)
+        assert 'Location' in df.columns, f"{csv_path} has no 'Location' column"
+        with self.conn:
+            # progress recorded since the last sync, by location
+            recent = self.conn.execute(
+                "SELECT location, name, value FROM progress WHERE time > ?",
+                (float(self._get_meta('synced') or 0),)).fetchall()
+            self.conn.execute("DELETE FROM columns")
+            self.conn.execute("DELETE FROM cells")
+            self.conn.executemany("INSERT INTO columns (position, name) VALUES (?, ?)",
+                                  enumerate(df.columns))
+            self.conn.executemany(
+                "INSERT INTO cells (row, name, value) VALUES (?, ?, ?)",
+                [(i, name, value) for i, row in df.iterrows()
+                 for name, value in row.items() if value != ''])
+            rows = {}
+            for i, location in enumerate(df['Location']):
+                rows.setdefault(location, []).append(i)
+            for location, name, value in recent:
+                if name in df.columns:
+                    for i in rows.get(location, []):
+                        self._set_cell(i, name, value)
+            self._set_meta('rows', str(len(df)))
+            self._set_synced(csv_path)
+
+    def to_frame(self):
+        """
+        Get the store's contents as a DataFrame, in the same form as reading
+        locations.csv with pandas (i.e. blank cells are NaN).
+
+        Returns
+        -------
+        df : pandas.DataFrame
+            one row per location, one column per csv column.
+        """
+
+        columns = [name for name, in
+                   self.conn.execute("SELECT name FROM columns ORDER BY position")]
+        rows = int(self._get_meta('rows') or 0)
+        df = pd.DataFrame(index=range(rows), columns=columns, dtype=object)
+        for row, name, value in self.conn.execute("SELECT row, name, value FROM cells"):
+            df.at[row, name] = value
+        return df
+
+    def export_csv(self, csv_path, encoding='cp1252'):
+        """
+        Write the store's contents to a locations.csv-style file.
+
+        Parameters
+        ----------
+        csv_path : str
+            path to the csv file to write.
+        encoding : str
+            encoding of the csv file.
+        """
+
+        self.to_frame().to_csv(csv_path, index=False, encoding=encoding)
+        with self.conn:
+            self._set_synced(csv_path)
+
+    def _set_synced(self, csv_path):
+        """Record that the store and a csv match, as of now."""
+
+        self._set_meta(f"mtime:{os.path.abspath(csv_path)}", repr(os.path.getmtime(csv_path)))
+        self._set_meta('synced', repr(time.time()))
+
+    def set(self, row, name, value):
+        """
+        Set one cell (e.g. a location's 'Scraped' column), committing
+        immediately.
+
+        Parameters
+        ----------
+        row : int
+            the index of the location's row (as in to_frame()).
+        name : str
+            the column to update.
+        value : str
+            the new value. None or '' blanks the cell.
+        """
+
+        with self.conn:
+            self._set_cell(row, name, value)
+
+    def _set_cell(self, row, name, value):
+        if value is None or value == '':
+            self.conn.execute("DELETE FROM cells WHERE row = ? AND name = ?", (row, name))
+        else:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cells (row, name, value) VALUES (?, ?, ?)",
+                (row, name, value))
+
+    def _location(self, row):
+        result = self.conn.execute(
+            "SELECT value FROM cells WHERE row = ? AND name = 'Location'", (row,)).fetchone()
+        return None if result is None else result[0]
+
+    def _record_progress(self, row, name):
+        """Set a stage's done or error flag, remembering when (see import_csv())."""
+
+        self._set_cell(row, name, 'yes')
+        self.conn.execute(
+            "INSERT OR REPLACE INTO progress (location, name, value, time) VALUES (?, ?, ?, ?)",
+            (self._location(row), name, 'yes', time.time()))
+
+    def record_done(self, row, stage, done_col):
+        """
+        Record that a stage finished for a location.
+
+        Parameters
+        ----------
+        row : int
+            the index of the location's row (as in to_frame()).
+        stage : str
+            the stage name (e.g. 'scrape').
+        done_col : str
+            the column flagging the stage as done (e.g. 'Scraped').
+        """
+
+        with self.conn:
+            self._record_progress(row, done_col)
+            self.conn.execute(
+                "INSERT INTO events (time, location, stage, status) VALUES (?, ?, ?, ?)",
+                (time.time(), self._location(row), stage, 'done'))
+
+    def record_error(self, row, stage, error_col, message):
+        """
+        Record that a stage failed for a location.
+
+        Parameters
+        ----------
+        row : int
+            the index of the location's row (as in to_frame()).
+        stage : str
+            the stage name (e.g. 'scrape').
+        error_col : str
+            the column flagging the stage's error (e.g. 'Scrape Error').
+        message : str
+            the error message.
+        """
+
+        with self.conn:
+            self._record_progress(row, error_col)
+            self.conn.execute(
+                "INSERT INTO events (time, location, stage, status, message) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (time.time(), self._location(row), stage, 'error', message))
+
+    def errors(self, location=None):
+        """
+        Get logged stage errors, oldest first.
+
+        Parameters
+        ----------
+        location : str
+            only get errors for this location. If None, get all errors.
+
+        Returns
+        -------
+        df : pandas.DataFrame
+            one row per error, with time, location, stage, and message columns.
+        """
+
+        query = "SELECT time, location, stage, message FROM events WHERE status = 'error'"
+        params = ()
+        if location is not None:
+            query += " AND location = ?"
+            params = (location,)
+        rows = self.conn.execute(query + " ORDER BY time", params).fetchall()
+        return pd.DataFrame(rows, columns=['time', 'location', 'stage', 'message'])
@@ -0,0 +1,102 @@
+import os
+import time
+
+import pytest
+
+from cache import ArtifactCache, hash_file, link_or_copy, make_key
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ArtifactCache(str(tmp_path / 'cache'), max_size=100)
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_make_key():
+    assert make_key('video', 'a', 1) == make_key('video', 'a', 1)
+    assert make_key('ab', 'c') != make_key('a', 'bc')
+    assert make_key('a', 1) != make_key('a', '1')
+    assert make_key('a', ['b', 'c']) != make_key('a', 'b', 'c')
+    assert make_key('a', ('b', 'c')) == make_key('a', ['b', 'c'])
+    assert make_key(b'a') != make_key('a')
+
+
+def test_hash_file(tmp_path):
+    path = write(tmp_path / 'a.txt', b'x' * 10)
+    assert hash_file(path) == hash_file(path, chunk_size=3)
+    assert hash_file(path) != hash_file(write(tmp_path / 'b.txt', b'x' * 11))
+
+
+def test_store_and_restore(cache, tmp_path):
+    key = make_key('scrape', 'Toronto, Ontario')
+    assert cache.get(key) == (None, None)
+    assert cache.restore(key, output_dir=str(tmp_path / 'out')) is None
+    cache.store(key, write(tmp_path / 'Toronto, Ontario.csv', b'CN Tower'))
+    path, name = cache.get(key)
+    assert name == 'Toronto, Ontario.csv' and read(path) == b'CN Tower'
+    restored = cache.restore(key, output_dir=str(tmp_path / 'out'))
+    assert restored == str(tmp_path / 'out' / 'Toronto, Ontario.csv')
+    assert read(restored) == b'CN Tower'
+    assert read(cache.restore(key, output_path=str(tmp_path / 'x.csv'))) == b'CN Tower'
+
+
+def test_restore_replaces_links(cache, tmp_path):
+    key = make_key('image')
+    cache.store(key, write(tmp_path / 'a.jpg', b'cached'))
+    linked = str(tmp_path / 'linked.jpg')
+    link_or_copy(cache.get(key)[0], linked)
+    cache.restore(key, output_path=linked)
+    write(linked, b'edited')  # in place, so it'd edit the cached copy through a link
+    assert read(cache.get(key)[0]) == b'cached'
+
+
+def test_max_age(cache, tmp_path):
+    key = make_key('scrape')
+    cache.store(key, write(tmp_path / 'a.csv', b'a'))
+    assert cache.get(key, max_age=60)[0] is not None
+    old = time.time() - 120
+    os.utime(cache.get(key)[0], (old, old))
+    assert cache.get(key, max_age=60) == (None, None)
+    assert cache.restore(key, output_dir=str(tmp_path / 'out'), max_age=60) is None
+    assert cache.get(key)[0] is not None  # still there without a limit
+
+
+def test_removed_by_hand(cache, tmp_path):
+    key = make_key('video')
+    cache.store(key, write(tmp_path / 'a.mp4', b'a'))
+    os.remove(cache.get(key)[0])
+    assert cache.get(key) == (None, None)
+    assert cache.size() == 0
+
+
+def test_evicts_least_recently_used(cache, tmp_path):
+    keys = [make_key('image', i) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.store(key, write(tmp_path / f'{i}.jpg', bytes(40)))
+        time.sleep(0.01)
+    # 120 bytes don't fit in 100, so the oldest was evicted
+    assert cache.get(keys[0]) == (None, None)
+    assert cache.size() == 80
+    cache.get(keys[1])  # now more recently used than keys[2]
+    time.sleep(0.01)
+    cache.store(make_key('image', 3), write(tmp_path / '3.jpg', bytes(40)))
+    assert cache.get(keys[2]) == (None, None)
+    assert cache.get(keys[1])[0] is not None
+    assert cache.size() == 80
+
+
+def test_shared_between_instances(cache, tmp_path):
+    key = make_key('enhance')
+    cache.store(key, write(tmp_path / 'a.png', b'a'))
+    other = ArtifactCache(cache.cache_dir, max_size=100)
+    assert read(other.get(key)[0]) == b'a'
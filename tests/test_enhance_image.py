@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+tf = pytest.importorskip('tensorflow')
+import enhance_image  # noqa: E402 (needs tensorflow)
+from enhance_image import Enhance, RowResizer  # noqa: E402
+
+
+def model(x):
+    """A stand-in for ESRGAN: a 4x upscale that only depends on each pixel, so tiles agree."""
+
+    x = np.asarray(x, np.float32)
+    return tf.constant(np.repeat(np.repeat(x, 4, 1), 4, 2) * 0.9 + 10)
+
+
+@pytest.fixture
+def enhancer(tmp_path, monkeypatch):
+    monkeypatch.setattr(enhance_image, 'get_model', lambda model_path=None: model)
+    (tmp_path / 'in').mkdir()
+    return Enhance(str(tmp_path / 'in'), str(tmp_path / 'out'), tile_size=64, tile_overlap=8)
+
+
+def whole(image):
+    return np.round(np.clip(np.asarray(model(image))[0], 0, 255)).astype(np.uint8)
+
+
+@pytest.mark.parametrize('h, w', [(150, 230), (64, 300), (200, 64), (130, 130), (40, 50)])
+def test_tiled_matches_whole_image(enhancer, h, w):
+    image = np.random.default_rng(0).integers(0, 256, (1, h, w, 3)).astype(np.uint8)
+    out = np.asarray(enhancer.enhance_tiled(image)).astype(int)
+    assert out.shape == (h * 4, w * 4, 3)
+    assert np.abs(out - whole(image)).max() <= 1
+
+
+@pytest.mark.parametrize('size', [(467, 297), (920, 600), (1150, 750), (230, 150)])
+def test_tiled_resized_matches_whole_image(enhancer, size):
+    image = np.random.default_rng(1).integers(0, 256, (1, 150, 230, 3)).astype(np.uint8)
+    out = enhancer.enhance_tiled(image, size=size)
+    assert out.size == size
+    expected = Image.fromarray(whole(image)).resize(size, Image.LANCZOS)
+    assert np.abs(np.asarray(out).astype(int) - np.asarray(expected)).max() <= 1
+
+
+@pytest.mark.parametrize('length, tile, overlap', [(150, 64, 8), (64, 64, 8), (300, 64, 0)])
+def test_blend_weights_sum_to_one(length, tile, overlap):
+    starts = Enhance.tile_starts(length, tile, overlap)
+    assert starts[0] == 0 and starts[-1] + min(tile, length) == length
+    total = np.zeros(length, np.float32)
+    for i, start in enumerate(starts):
+        # each tile's leading ramp starts where the previous tile's trailing ramp does
+        lead = starts[i - 1] + tile - overlap if i > 0 else 0
+        end = min(start + tile, length)
+        total[lead:end] += Enhance.blend_ramp(end - lead, overlap, i > 0, i < len(starts) - 1)
+    assert np.allclose(total, 1)
+
+
+@pytest.mark.parametrize('size', [(467, 297), (1000, 700), (200, 100), (920, 600)])
+@pytest.mark.parametrize('step', [37, 128, 600])
+def test_row_resizer(size, step):
+    src = np.random.default_rng(2).integers(0, 256, (600, 920, 3)).astype(np.uint8)
+    resizer = RowResizer((920, 600), size)
+    for i in range(0, 600, step):
+        resizer.add(src[i:i + step])
+    expected = Image.fromarray(src).resize(size, Image.LANCZOS)
+    diff = np.abs(np.asarray(resizer.image()).astype(int) - np.asarray(expected))
+    assert diff.max() <= 1 and (diff > 0).mean() < 0.001
@@ -0,0 +1,58 @@
+import os
+
+import pandas as pd
+import pytest
+from PIL import Image
+
+from image_index import ImageIndex, related_locations
+
+LOCATIONS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'locations.csv')
+
+
+@pytest.fixture(scope='module')
+def locations():
+    return pd.read_csv(LOCATIONS_CSV, encoding='cp1252')
+
+
+@pytest.fixture(scope='module')
+def cities(locations):
+    return set(locations.loc[locations['City'].notna(), 'Location'])
+
+
+def test_cities_match_their_regions(locations, cities):
+    regions = locations.loc[locations['City'].isna(), 'Location']
+    region_by_name = {region.split(', ')[0]: region for region in regions}
+    pairs = [(city, region_by_name[name])
+             for city, name in locations.loc[locations['City'].notna(), ['Location', 'Region']].values
+             if name in region_by_name]
+    assert len(pairs) > 100
+    for city, region in pairs:
+        assert related_locations(city, region, cities), (city, region)
+        assert related_locations(region, city, cities), (city, region)
+
+
+def test_real_rows(cities):
+    assert related_locations('Toronto, Ontario', 'Ontario, Canada', cities)
+    assert related_locations('Los Angeles, California', 'California', cities)
+    assert related_locations('Ontario, Canada', 'Canada', cities)
+    assert related_locations('Toronto, Ontario', 'Toronto, Ontario', cities)
+
+
+def test_unrelated_locations(cities):
+    assert 'Ontario, California' in cities
+    assert not related_locations('Toronto, Ontario', 'Ontario, California', cities)
+    assert not related_locations('Ontario, California', 'Toronto, Ontario', cities)
+    assert not related_locations('Toronto, Ontario', 'Ottawa, Ontario', cities)
+    assert not related_locations('Toronto, Ontario', 'Quebec, Canada', cities)
+    assert not related_locations('Ontario, California', 'Ontario, Canada', cities)
+
+
+def test_find_attraction(tmp_path, cities):
+    path = str(tmp_path / 'cn_tower.jpg')
+    Image.new('RGB', (64, 48), (200, 30, 30)).save(path)
+    index = ImageIndex(str(tmp_path / 'images.db'), cities=cities)
+    index.add(path, location='Ontario, Canada', attraction='CN Tower')
+    assert index.find_attraction('CN Tower', 'Toronto, Ontario') == os.path.abspath(path)
+    assert index.find_attraction('CN Tower', 'Ontario, California') is None
+    assert index.find_attraction('Hollywood Sign', 'Toronto, Ontario') is None
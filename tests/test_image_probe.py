@@ -0,0 +1,69 @@
+import io
+
+import pytest
+from PIL import Image
+
+from image_probe import image_format, image_size, probe_file
+
+FORMATS = [('jpeg', 'JPEG', {}), ('jpeg', 'JPEG', {'progressive': True}),
+           ('png', 'PNG', {}), ('gif', 'GIF', {}), ('bmp', 'BMP', {}),
+           ('webp', 'WEBP', {'lossless': False}), ('webp', 'WEBP', {'lossless': True}),
+           ('tiff', 'TIFF', {})]
+
+
+def encode(pil_format, size=(301, 167), mode='RGB', **params):
+    f = io.BytesIO()
+    Image.new(mode, size, (10, 120, 200)).save(f, pil_format, **params)
+    return f.getvalue()
+
+
+@pytest.mark.parametrize('fmt, pil_format, params', FORMATS)
+def test_image_size(fmt, pil_format, params):
+    data = encode(pil_format, **params)
+    assert image_format(data) == fmt
+    assert tuple(image_size(data)) == (301, 167)
+
+
+def test_webp_with_alpha():
+    data = encode('WEBP', mode='RGBA')
+    assert tuple(image_size(data)) == (301, 167)
+
+
+def test_jpeg_with_exif():
+    # the size comes after the (large) EXIF segment
+    exif = Image.Exif()
+    exif[0x010E] = 'x' * 5000  # ImageDescription
+    data = encode('JPEG', exif=exif.tobytes())
+    assert image_size(data[:1000]) is None
+    assert tuple(image_size(data)) == (301, 167)
+
+
+@pytest.mark.parametrize('fmt, pil_format, params', FORMATS)
+def test_incomplete_header(fmt, pil_format, params):
+    data = encode(pil_format, **params)
+    assert image_size(data[:8]) is None
+
+
+@pytest.mark.parametrize('data', [
+    b'<!DOCTYPE html><html></html>',  # e.g. an error page instead of an image
+    b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00' + b'\x00' * 16,  # JPEG without a marker
+    b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIEND' + b'\x00' * 8,  # PNG without IHDR
+])
+def test_invalid_header(data):
+    with pytest.raises(ValueError):
+        image_size(data)
+
+
+def test_probe_file(tmp_path):
+    path = str(tmp_path / 'a.png')
+    with open(path, 'wb') as f:
+        f.write(encode('PNG', size=(4000, 3000)))
+    assert probe_file(path, chunk_size=16) == ('png', (4000, 3000))
+
+
+def test_probe_file_truncated(tmp_path):
+    path = str(tmp_path / 'a.jpg')
+    with open(path, 'wb') as f:
+        f.write(encode('JPEG')[:10])
+    with pytest.raises(ValueError):
+        probe_file(path)
@@ -0,0 +1,110 @@
+import threading
+from scheduler import PipelineScheduler, Stage
+
+
+def run(stages, jobs, pools=None):
+    """Run jobs through a scheduler, returning its (event, key, stage) log."""
+
+    log = []
+    lock = threading.Lock()
+
+    def on_done(key, name, result):
+        with lock:
+            log.append(('done', key, name))
+
+    def on_error(key, name, e):
+        with lock:
+            log.append(('error', key, name))
+
+    if pools is None:
+        pools = {'io': ('thread', 4), 'cpu': ('thread', 2)}
+    PipelineScheduler(stages, pools, on_done=on_done, on_error=on_error).run(jobs)
+    return log
+
+
+def record(calls, name):
+    """Make a stage function that records its calls."""
+
+    def func(key):
+        calls.append((name, key))
+        if key == 'bad' and name == 'first':
+            raise ValueError(f"{name} failed for {key}")
+        return key
+    return func
+
+
+def test_stages_run_in_order_for_each_job():
+    calls = []
+    stages = [Stage('first', record(calls, 'first'), 'io'),
+              Stage('second', record(calls, 'second'), 'cpu'),
+              Stage('third', record(calls, 'third'), 'io')]
+    jobs = {k: [('first', (k,)), ('second', (k,)), ('third', (k,))] for k in range(5)}
+    log = run(stages, jobs)
+
+    assert len(log) == 15
+    for k in range(5):
+        assert [name for event, key, name in log if key == k] == ['first', 'second', 'third']
+        assert [name for name, key in calls if key == k] == ['first', 'second', 'third']
+
+
+def test_jobs_can_skip_stages():
+    calls = []
+    stages = [Stage('first', record(calls, 'first'), 'io'),
+              Stage('second', record(calls, 'second'), 'cpu')]
+    log = run(stages, {'a': [('second', ('a',))], 'b': []})
+
+    assert log == [('done', 'a', 'second')]
+    assert calls == [('second', 'a')]
+
+
+def test_later_stages_run_after_a_failure():
+    calls = []
+    stages = [Stage('first', record(calls, 'first'), 'io'),
+              Stage('second', record(calls, 'second'), 'cpu')]
+    jobs = {k: [('first', (k,)), ('second', (k,))] for k in ['bad', 'good']}
+    log = run(stages, jobs)
+
+    assert ('error', 'bad', 'first') in log
+    assert ('done', 'bad', 'second') in log
+    assert ('done', 'good', 'first') in log and ('done', 'good', 'second') in log
+
+
+def test_skip_on_error_skips_later_stages():
+    calls = []
+    stages = [Stage('first', record(calls, 'first'), 'io', skip_on_error=True),
+              Stage('second', record(calls, 'second'), 'cpu')]
+    jobs = {k: [('first', (k,)), ('second', (k,))] for k in ['bad', 'good']}
+    log = run(stages, jobs)
+
+    assert ('error', 'bad', 'first') in log
+    assert ('second', 'bad') not in calls
+    assert ('done', 'good', 'second') in log
+
+
+def test_pools_limit_concurrency():
+    running, peak = [0], [0]
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def stage(key):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            if running[0] == 2:
+                release.set()
+        release.wait(timeout=1)
+        with lock:
+            running[0] -= 1
+
+    run([Stage('only', stage, 'cpu')], {k: [('only', (k,))] for k in range(6)},
+        pools={'cpu': ('thread', 2)})
+    assert peak[0] == 2
+
+
+def test_invalid_pools_are_rejected():
+    for pools in [{'cpu': ('fiber', 1)}, {'cpu': ('thread', 0)}, {}]:
+        try:
+            PipelineScheduler([Stage('only', print, 'cpu')], pools)
+        except AssertionError:
+            continue
+        raise AssertionError(f"accepted {pools}")
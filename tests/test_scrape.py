@@ -0,0 +1,116 @@
+import pytest
+
+from scrape import TripAdvisorScrape
+from transport import Response
+
+LIST_URL = 'https://www.tripadvisor.com/Attractions-g155019-Activities-a_allAttractions.true'
+
+
+def card(rank, name, rating=4.5, reviews=1234, category='Points of Interest', link_after=False):
+    link = f'<a href="/Attraction_Review-g155019-d{rank}-Reviews-{rank}.html">'
+    title = f'<div class="title"><span>{rank}.</span> <!-- -->{name}</div>'
+    return ((title + link if link_after else link + title) + '</a>'
+            f'<svg aria-label="{rating} of 5 bubbles. {reviews:,} reviews"></svg>'
+            f'<div class="cat">{category}</div><div>{"x" * 50}</div>')
+
+
+def page(ranks):
+    return '<html><body>' + ''.join(card(i, f'Place {i}') for i in ranks) + '</body></html>'
+
+
+class FakeTransport():
+    """Serves pages by URL, recording the URLs requested."""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.urls = []
+
+    def request(self, url, headers=None, timeout=None):
+        self.urls.append(url)
+        return Response(url, 200, None, self.pages[url].encode('utf8'))
+
+
+def test_extract_fields():
+    html_str = '<html>' + card(2, 'Casa Loma &amp; Gardens', link_after=True) + \
+        card(1, 'CN Tower', 4.5, 31500, 'Observation Decks &amp; Towers') + '</html>'
+    attractions = TripAdvisorScrape().extract_attractions(html_str)
+    assert attractions == [
+        {'Rank': 1, 'Attraction': 'CN Tower',
+         'URL': 'https://www.tripadvisor.com/Attraction_Review-g155019-d1-Reviews-1.html',
+         'Rating': 4.5, 'Reviews': 31500, 'Category': 'Observation Decks & Towers'},
+        {'Rank': 2, 'Attraction': 'Casa Loma & Gardens',
+         'URL': 'https://www.tripadvisor.com/Attraction_Review-g155019-d2-Reviews-2.html',
+         'Rating': 4.5, 'Reviews': 1234, 'Category': 'Points of Interest'},
+    ]
+
+
+def test_extract_missing_fields_and_ranks():
+    html_str = ('<div><span>1.</span> <!-- -->Bare</div>' + card(3, 'Place 3')
+                + card(3, 'Repeated elsewhere'))
+    attractions = TripAdvisorScrape().extract_attractions(html_str)
+    assert [(d['Rank'], d['Attraction']) for d in attractions] == [(1, 'Bare'), (3, 'Place 3')]
+    assert attractions[0]['URL'] is None
+    assert attractions[0]['Rating'] is None and attractions[0]['Reviews'] is None
+    assert attractions[0]['Category'] is None
+
+
+def test_extract_matches_legacy():
+    bench_scrape = pytest.importorskip('bench_scrape')
+    html_str = bench_scrape.synthetic_page(n=30, filler_bytes=5000)
+    extracted = TripAdvisorScrape().extract_attractions(html_str)
+    legacy = bench_scrape.legacy_extract(html_str)
+    assert [(d['Rank'], d['Attraction']) for d in extracted] == \
+        [(d['Rank'], d['Attraction']) for d in legacy]
+
+
+def test_page_url():
+    scraper = TripAdvisorScrape()
+    assert scraper.page_url(LIST_URL, 0) == LIST_URL
+    second = scraper.page_url(LIST_URL, 30)
+    assert second == ('https://www.tripadvisor.com/'
+                      'Attractions-g155019-Activities-oa30-a_allAttractions.true')
+    assert scraper.page_url(second, 60) == second.replace('oa30', 'oa60')
+
+
+def test_scrape_pages():
+    transport = FakeTransport({LIST_URL: page(range(1, 31)),
+                               TripAdvisorScrape().page_url(LIST_URL, 30): page(range(31, 61))})
+    df = TripAdvisorScrape(n=45, transport=transport).scrape(
+        'Toronto, Ontario', verbose=False, helper_url=LIST_URL)
+    assert len(transport.urls) == 2
+    assert list(df['Rank']) == list(range(1, 46))
+    assert list(df.columns) == ['Rank', 'Attraction', 'URL', 'Rating', 'Reviews', 'Category']
+
+
+def test_scrape_one_page():
+    transport = FakeTransport({LIST_URL: page(range(1, 31))})
+    df = TripAdvisorScrape(n=10, transport=transport).scrape(
+        'Toronto, Ontario', verbose=False, helper_url=LIST_URL)
+    assert transport.urls == [LIST_URL]
+    assert list(df['Attraction']) == [f'Place {i}' for i in range(1, 11)]
+
+
+def test_scrape_stops_at_end_of_list(capsys):
+    transport = FakeTransport({LIST_URL: page([1, 2, 4]),
+                               TripAdvisorScrape().page_url(LIST_URL, 30): page([])})
+    df = TripAdvisorScrape(n=90, transport=transport).scrape(
+        'Toronto, Ontario', verbose=False, helper_url=LIST_URL)
+    assert len(transport.urls) == 2
+    assert list(df['Rank']) == [1, 2, 4]
+    assert 'ranks not found for Toronto, Ontario: [3, 5,' in capsys.readouterr().out
+
+
+def test_scrape_no_attractions():
+    transport = FakeTransport({LIST_URL: '<html></html>'})
+    with pytest.raises(Exception, match='no attractions found'):
+        TripAdvisorScrape(transport=transport).scrape('Nowhere', verbose=False, helper_url=LIST_URL)
+
+
+def test_scrape_search():
+    search_url = 'https://www.tripadvisor.com/Search?q=Toronto,%20Ontario%20things%20to%20do'
+    search_page = ('<html><head><meta property="og:url" content="https://www.tripadvisor.com/'
+                   'Attractions-g155019-Activities-Toronto_Ontario.html"></head></html>')
+    transport = FakeTransport({search_url: search_page, LIST_URL: page(range(1, 31))})
+    df = TripAdvisorScrape(n=5, transport=transport).scrape('Toronto, Ontario', verbose=False)
+    assert transport.urls == [search_url, LIST_URL]
+    assert len(df) == 5
@@ -0,0 +1,99 @@
+import os
+
+import pandas as pd
+import pytest
+
+from state import StateStore
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = str(tmp_path / 'locations.csv')
+    pd.DataFrame({
+        'City': ['', 'Toronto', 'Montréal'],
+        'Region': ['', 'Ontario', 'Quebec'],
+        'Location': ['Ontario, Canada', 'Toronto, Ontario', 'Montréal, Quebec'],
+        'Scraped': ['yes', '', ''],
+        'Scrape Error': ['', '', ''],
+    }).to_csv(path, index=False, encoding='cp1252')
+    return path
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = StateStore(str(tmp_path / 'locations.db'))
+    yield store
+    store.close()
+
+
+def read(path):
+    return pd.read_csv(path, encoding='cp1252')
+
+
+def touch_later(path):
+    # make sure a hand edit changes the mtime, even on coarse clocks
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+
+
+def test_round_trip(store, csv_path, tmp_path):
+    assert store.is_stale(csv_path)
+    store.import_csv(csv_path)
+    assert not store.is_stale(csv_path)
+    pd.testing.assert_frame_equal(store.to_frame().astype(object), read(csv_path).astype(object),
+                                  check_dtype=False)
+    out_path = str(tmp_path / 'out.csv')
+    store.export_csv(out_path)
+    pd.testing.assert_frame_equal(read(out_path), read(csv_path))
+    assert not store.is_stale(out_path)
+
+
+def test_progress_is_committed(store, csv_path, tmp_path):
+    store.import_csv(csv_path)
+    store.record_done(1, 'scrape', 'Scraped')
+    store.record_error(2, 'scrape', 'Scrape Error', 'timed out')
+    store.close()
+    reopened = StateStore(str(tmp_path / 'locations.db'))
+    try:
+        df = reopened.to_frame()
+        assert df.at[1, 'Scraped'] == 'yes'
+        assert df.at[2, 'Scrape Error'] == 'yes'
+        errors = reopened.errors()
+        assert errors[['location', 'stage', 'message']].values.tolist() == [
+            ['Montréal, Quebec', 'scrape', 'timed out']]
+    finally:
+        reopened.close()
+
+
+def test_hand_edit_keeps_progress(store, csv_path):
+    store.import_csv(csv_path)
+    store.record_done(1, 'scrape', 'Scraped')  # then the run crashes before exporting
+    # the csv is edited by hand: rows reordered, a row added, and a cell edited
+    df = read(csv_path).fillna('')
+    df = pd.concat([df.iloc[[2, 1, 0]], pd.DataFrame({
+        'City': ['Ottawa'], 'Region': ['Ontario'], 'Location': ['Ottawa, Ontario'],
+        'Scraped': [''], 'Scrape Error': ['']})])
+    df.loc[df['Location'] == 'Ontario, Canada', 'Scraped'] = ''
+    df.to_csv(csv_path, index=False, encoding='cp1252')
+    touch_later(csv_path)
+    assert store.is_stale(csv_path)
+    store.import_csv(csv_path)
+    result = store.to_frame().set_index('Location')
+    assert list(result.index) == [
+        'Montréal, Quebec', 'Toronto, Ontario', 'Ontario, Canada', 'Ottawa, Ontario']
+    assert result.at['Toronto, Ontario', 'Scraped'] == 'yes'  # kept from the store
+    assert pd.isna(result.at['Ontario, Canada', 'Scraped'])  # cleared by hand
+    assert pd.isna(result.at['Ottawa, Ontario', 'Scraped'])
+
+
+def test_synced_progress_follows_csv(store, csv_path):
+    store.import_csv(csv_path)
+    store.record_done(1, 'scrape', 'Scraped')
+    store.export_csv(csv_path)
+    # progress already in the csv can be cleared by hand (e.g. to redo a stage)
+    df = read(csv_path)
+    df.loc[df['Location'] == 'Toronto, Ontario', 'Scraped'] = None
+    df.to_csv(csv_path, index=False, encoding='cp1252')
+    touch_later(csv_path)
+    store.import_csv(csv_path)
+    assert pd.isna(store.to_frame().set_index('Location').at['Toronto, Ontario', 'Scraped'])
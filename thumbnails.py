@@ -0,0 +1,131 @@
+import functools
+from PIL import Image, ImageDraw
+from overlay import load_font
+from asset_cache import crop_thumbnail, thumbnail_target
+
+
+# thumbnail text style
+TEXT_COLOR = (237, 230, 211)
+STROKE_COLOR = 'black'
+
+
+def text_size(text, font):
+    """
+    Get the (width, height) of text drawn at (0, 0), including the offset
+    from the origin (like ImageDraw.textsize() did).
+    """
+
+    left, top, right, bottom = font.getbbox(text)
+    return right, bottom
+
+
+@functools.lru_cache(maxsize=256)
+def fit_font_size(text, font, max_size, max_width):
+    """
+    Find the largest font size (up to max_size) that text fits in max_width
+    pixels at, by binary search. Cached, since the same title is fitted for
+    every image.
+
+    Parameters
+    ----------
+    text : str
+        the text.
+    font : str
+        font name or file (see overlay.load_font()).
+    max_size : int
+        the largest font size to use.
+    max_width : float
+        the widest the text can be, in pixels.
+
+    Returns
+    -------
+    size : int
+    """
+
+    if text_size(text, load_font(font, max_size))[0] <= max_width:
+        return max_size
+    lo, hi = 1, max_size - 1  # the answer is in [lo, hi]
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if text_size(text, load_font(font, mid))[0] <= max_width:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def draw_title(img, top_text, title, font='arialbd.ttf'):
+    """
+    Draw a thumbnail's two lines of text (e.g. "TOP 10" and "TORONTO") on an
+    image, centered horizontally, above and below the middle. The title is
+    shrunk to fit the width of the image.
+
+    Parameters
+    ----------
+    img : PIL.Image.Image
+        the image, drawn on in place.
+    top_text : str
+        the first line.
+    title : str
+        the second line.
+    font : str
+        font name or file (see overlay.load_font()).
+    """
+
+    new_w, new_h = img.size
+    draw = ImageDraw.Draw(img)
+
+    # set up font
+    font_size = int(0.25 * new_h)
+    stroke_width = max(2, int(font_size / 100))
+
+    # add text line 1 (e.g. "TOP 10") to image (centered horizontally, above middle)
+    line_font = load_font(font, font_size)
+    w, h = text_size(top_text, line_font)
+    x = int((new_w - w) / 2)
+    y = int(0.45 * new_h - h)
+    draw.text((x, y), top_text, TEXT_COLOR, font=line_font, stroke_width=stroke_width,
+              stroke_fill=STROKE_COLOR)
+
+    # add text line 2 (e.g. "TORONTO") to image (centered horizontally, below middle),
+    # shrinking the font until it fits on the picture
+    line_font = load_font(font, fit_font_size(title, font, font_size, 0.975 * new_w))
+    w, h = text_size(title, line_font)
+    x = int((new_w - w) / 2)
+    y = int(0.52 * new_h)
+    draw.text((x, y), title, TEXT_COLOR, font=line_font, stroke_width=stroke_width,
+              stroke_fill=STROKE_COLOR)
+
+
+def render_thumbnails(input_path, targets, top_text, title, assets=None, font='arialbd.ttf'):
+    """
+    Render an image's thumbnails at several resolutions, decoding the image
+    at most once.
+
+    Parameters
+    ----------
+    input_path : str
+        path to the image.
+    targets : list
+        ((width, height), output_path) of each thumbnail.
+    top_text : str
+        the first line of text (see draw_title()).
+    title : str
+        the second line of text.
+    assets : AssetCache
+        cache to read the cropped and scaled images from, or None to crop and
+        scale them here.
+    font : str
+        font name or file.
+    """
+
+    image = None
+    for (w, h), output_path in targets:
+        if assets is not None:
+            img = Image.fromarray(assets.get(input_path, thumbnail_target(w, h)))
+        else:
+            if image is None:
+                image = Image.open(input_path)
+            img = crop_thumbnail(image, w, h)
+        draw_title(img, top_text, title, font=font)
+        img.save(output_path, "PNG")
@@ -0,0 +1,639 @@
+import os
+import sys
+import json
+import hashlib
+import threading
+import http.client
+import http.server
+import urllib.parse
+import urllib.error
+from ratelimit import BACKOFF_STATUSES
+
+
+# errors that mean a kept-alive connection was closed by the server
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                           ConnectionResetError, BrokenPipeError, ConnectionAbortedError)
+
+
+class Response():
+    """
+    An HTTP response with its body fully read. Can be read like a
+    StreamResponse.
+    """
+
+    def __init__(self, url, status, headers, body):
+        """
+        Parameters
+        ----------
+        url : str
+            the URL the response came from (after any redirects).
+        status : int
+            the HTTP status code.
+        headers : email.message.Message
+            the response headers.
+        body : bytes
+            the response body.
+        """
+
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.position = 0
+
+    def read(self, size=-1):
+        """
+        Read up to size bytes of the body, or the rest of it if size is -1,
+        like urllib's response.read().
+        """
+
+        if size is None or size < 0:
+            size = len(self.body) - self.position
+        data = self.body[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StreamResponse():
+    """
+    An HTTP response whose body is read on demand. Closing it returns the
+    connection to its pool if the body was fully read, otherwise the
+    connection is closed (e.g. when a download is aborted early).
+    """
+
+    def __init__(self, pool, url, host_key, conn, response, slot):
+        """
+        Parameters
+        ----------
+        pool : ConnectionPool
+            the pool the connection came from.
+        url : str
+            the URL the response came from.
+        host_key : tuple
+            (scheme, host, port) of the connection.
+        conn : http.client.HTTPConnection
+            the connection the response is read from.
+        response : http.client.HTTPResponse
+            the response.
+        slot : threading.Semaphore
+            the host slot held while the response is open.
+        """
+
+        self.pool = pool
+        self.url = url
+        self.host_key = host_key
+        self.conn = conn
+        self.response = response
+        self.slot = slot
+        self.status = response.status
+        self.headers = response.msg
+        self.closed = False
+
+    def read(self, size=-1):
+        """
+        Read up to size bytes of the body, or the rest of it if size is -1.
+        Returns b'' once the body is fully read.
+        """
+
+        try:
+            if size is None or size < 0:
+                return self.response.read()
+            return self.response.read(size)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        """Release the connection and the host slot."""
+
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            reusable = self.response.isclosed() and not self.response.will_close
+            self.pool._release(self.host_key, self.conn, reusable)
+        finally:
+            self.slot.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ConnectionPool():
+    """
+    Thread-safe HTTP(S) client that keeps connections alive and reuses them
+    per host, with a politeness budget limiting how hard each host is hit:
+    a cap on requests in flight per host, and an optional per-host rate
+    limiter that backs off when a host responds with 429 or 5xx.
+    """
+
+    def __init__(self, max_per_host=4, rate_limiter=None, timeout=60, headers=None,
+                 max_redirects=5, retries=3):
+        """
+        Parameters
+        ----------
+        max_per_host : int
+            maximum number of requests in flight to one host at once.
+        rate_limiter : RateLimiter
+            per-host rate limiter to wait on before each request, and to
+            report each response's status to. Share one between pools to
+            apply one budget across them. None for no rate limit.
+        timeout : int
+            default timeout for a request, in seconds.
+        headers : dict
+            headers sent with every request (e.g. a User-Agent).
+        max_redirects : int
+            maximum number of redirects to follow for one request.
+        retries : int
+            number of times to retry a request that gets a 429 or 5xx
+            response, after the rate limiter's backoff. Requests are only
+            retried if there is a rate limiter.
+        """
+
+        assert type(max_per_host) == int and max_per_host >= 1, \
+            "max_per_host must be a positive integer"
+        self.max_per_host = max_per_host
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout
+        self.headers = {} if headers is None else dict(headers)
+        self.max_redirects = max_redirects
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.idle = {}  # (scheme, host, port) -> list of idle connections
+        self.slots = {}  # (scheme, host, port) -> semaphore limiting requests in flight
+
+    def _host_key(self, url):
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        assert scheme in ['http', 'https'], f"unsupported URL scheme: {url}"
+        port = parts.port or (443 if scheme == 'https' else 80)
+        return scheme, parts.hostname, port
+
+    def _acquire(self, host_key):
+        """Wait for a free slot and the host's rate limit."""
+
+        with self.lock:
+            if host_key not in self.slots:
+                self.slots[host_key] = threading.Semaphore(self.max_per_host)
+            slot = self.slots[host_key]
+        slot.acquire()
+        if self.rate_limiter is not None:
+            try:
+                self.rate_limiter.wait(host_key[1])
+            except BaseException:
+                slot.release()
+                raise
+        return slot
+
+    def _connection(self, host_key, timeout):
+        """Get an idle connection to a host, or open a new one."""
+
+        with self.lock:
+            idle = self.idle.get(host_key, [])
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        return self._new_connection(host_key, timeout), False
+
+    def _new_connection(self, host_key, timeout):
+        scheme, host, port = host_key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=timeout)
+        return http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _release(self, host_key, conn, reusable):
+        if not reusable:
+            conn.close()
+            return
+        with self.lock:
+            self.idle.setdefault(host_key, []).append(conn)
+
+    def _open(self, url, headers, timeout):
+        """
+        Send one request (without following redirects), leaving the body
+        unread.
+
+        Returns
+        -------
+        response : StreamResponse
+            the response, which holds the connection and one of the host's
+            slots until it's closed.
+        """
+
+        host_key = self._host_key(url)
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        # escape any characters that can't go in a request line as-is (e.g.
+        # spaces or non-ASCII characters in image links), keeping existing escapes
+        path = urllib.parse.quote(path, safe="/%?=&:+;,@!$'()*~")
+        slot = self._acquire(host_key)
+        try:
+            conn, reused = self._connection(host_key, timeout)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+            except STALE_CONNECTION_ERRORS:
+                conn.close()
+                if not reused:
+                    raise
+                # the server closed the idle connection, so retry on a new one
+                conn = self._new_connection(host_key, timeout)
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+        except BaseException:
+            slot.release()
+            raise
+        if self.rate_limiter is not None:
+            self.rate_limiter.feedback(host_key[1], response.status,
+                                       response.msg.get('Retry-After'))
+        return StreamResponse(self, url, host_key, conn, response, slot)
+
+    def open(self, url, headers=None, timeout=None):
+        """
+        GET a URL, following redirects, without reading the response body,
+        so it can be streamed. The response must be closed (or used in a with
+        statement) to release its connection.
+
+        Parameters
+        ----------
+        url : str
+            the URL to get.
+        headers : dict
+            extra headers for this request.
+        timeout : int
+            timeout for the request, in seconds. Uses the pool's default if
+            None.
+
+        Returns
+        -------
+        response : StreamResponse
+            the response, with its body unread.
+
+        Raises
+        ------
+        urllib.error.HTTPError
+            if the final response has a 4xx or 5xx status code, like urllib.
+        """
+
+        all_headers = dict(self.headers)
+        if headers is not None:
+            all_headers.update(headers)
+        timeout = self.timeout if timeout is None else timeout
+        redirects, retries = 0, 0
+        while redirects <= self.max_redirects:
+            response = self._open(url, all_headers, timeout)
+            location = response.headers.get('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                response.close()
+                url = urllib.parse.urljoin(url, location)
+                redirects += 1
+                continue
+            if self.rate_limiter is not None and response.status in BACKOFF_STATUSES \
+                    and retries < self.retries:
+                # the rate limiter has backed off, so wait on it and retry
+                response.read()
+                response.close()
+                retries += 1
+                continue
+            if response.status >= 400:
+                response.read()
+                response.close()
+                raise urllib.error.HTTPError(
+                    url, response.status, http.client.responses.get(response.status, ''),
+                    response.headers, None)
+            return response
+        raise urllib.error.HTTPError(url, response.status, 'too many redirects',
+                                     response.headers, None)
+
+    def request(self, url, headers=None, timeout=None):
+        """
+        GET a URL, following redirects, and read the whole response.
+
+        Parameters
+        ----------
+        url : str
+            the URL to get.
+        headers : dict
+            extra headers for this request.
+        timeout : int
+            timeout for the request, in seconds. Uses the pool's default if
+            None.
+
+        Returns
+        -------
+        response : Response
+            the response, with its body fully read.
+
+        Raises
+        ------
+        urllib.error.HTTPError
+            if the final response has a 4xx or 5xx status code, like urllib.
+        """
+
+        with self.open(url, headers=headers, timeout=timeout) as response:
+            body = response.read()
+        return Response(response.url, response.status, response.headers, body)
+
+    def close(self):
+        """Close all idle connections."""
+
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+
+def archive_key(url):
+    """
+    Get the key a URL's response is archived under. The scheme is dropped
+    and escapes are undone, so a URL matches whether it's requested directly
+    or through an ArchiveServer.
+
+    Parameters
+    ----------
+    url : str
+        the URL.
+    """
+
+    parts = urllib.parse.urlsplit(url)
+    key = parts.netloc + (parts.path or '/')
+    if parts.query:
+        key += '?' + parts.query
+    return urllib.parse.unquote(key)
+
+
+class ResponseArchive():
+    """A directory of recorded HTTP responses, keyed by URL."""
+
+    def __init__(self, archive_dir):
+        """
+        Parameters
+        ----------
+        archive_dir : str
+            directory to store the responses in. Created if it doesn't exist.
+        """
+
+        self.archive_dir = archive_dir
+        os.makedirs(archive_dir, exist_ok=True)
+
+    def _path(self, url):
+        name = hashlib.sha256(archive_key(url).encode('utf8')).hexdigest()
+        return os.path.join(self.archive_dir, name)
+
+    def save(self, url, status, headers, body):
+        """
+        Record a response.
+
+        Parameters
+        ----------
+        url : str
+            the URL that was requested.
+        status : int
+            the HTTP status code.
+        headers : email.message.Message or dict
+            the response headers.
+        body : bytes
+            the response body.
+        """
+
+        path = self._path(url)
+        meta = {'url': url, 'status': status,
+                'headers': [[k, v] for k, v in headers.items()
+                            if k.lower() not in ('transfer-encoding', 'connection')]}
+        with open(f"{path}.body.tmp", 'wb') as f:
+            f.write(body)
+        with open(f"{path}.json.tmp", 'w', encoding='utf8') as f:
+            json.dump(meta, f)
+        os.replace(f"{path}.body.tmp", f"{path}.body")
+        os.replace(f"{path}.json.tmp", f"{path}.json")
+
+    def load(self, url):
+        """
+        Look up a recorded response.
+
+        Parameters
+        ----------
+        url : str
+            the URL that was requested.
+
+        Returns
+        -------
+        response : Response or None
+            the recorded response, or None if the URL wasn't recorded.
+        """
+
+        path = self._path(url)
+        if not os.path.exists(f"{path}.json"):
+            return None
+        with open(f"{path}.json", encoding='utf8') as f:
+            meta = json.load(f)
+        with open(f"{path}.body", 'rb') as f:
+            body = f.read()
+        headers = http.client.HTTPMessage()
+        for k, v in meta['headers']:
+            headers[k] = v
+        return Response(url, meta['status'], headers, body)
+
+
+class RecordingTransport():
+    """
+    Transport that makes requests through another transport and records
+    every response (including HTTP errors) to a ResponseArchive, so they can
+    be replayed offline with ReplayTransport. Streamed responses are read in
+    full so they can be recorded.
+    """
+
+    def __init__(self, archive_dir, transport=None):
+        """
+        Parameters
+        ----------
+        archive_dir : str
+            directory to record responses to.
+        transport : ConnectionPool
+            the transport to make requests with. If None, a new
+            ConnectionPool is made.
+        """
+
+        self.archive = ResponseArchive(archive_dir)
+        self.transport = ConnectionPool() if transport is None else transport
+
+    def request(self, url, headers=None, timeout=None):
+        """GET a URL and record the response. See ConnectionPool.request()."""
+
+        try:
+            response = self.transport.request(url, headers=headers, timeout=timeout)
+        except urllib.error.HTTPError as e:
+            self.archive.save(url, e.code, e.headers, b'')
+            raise
+        self.archive.save(url, response.status, response.headers, response.body)
+        return response
+
+    def open(self, url, headers=None, timeout=None):
+        """GET a URL and record the response. See ConnectionPool.open()."""
+
+        return self.request(url, headers=headers, timeout=timeout)
+
+
+class ReplayTransport():
+    """
+    Transport that serves responses from a ResponseArchive instead of the
+    network, e.g. to benchmark or test scraping and downloading offline.
+    """
+
+    def __init__(self, archive_dir):
+        """
+        Parameters
+        ----------
+        archive_dir : str
+            directory of recorded responses (from RecordingTransport).
+        """
+
+        self.archive = ResponseArchive(archive_dir)
+
+    def request(self, url, headers=None, timeout=None):
+        """
+        Get the recorded response for a URL. See ConnectionPool.request().
+
+        Raises
+        ------
+        urllib.error.URLError
+            if no response was recorded for the URL.
+        urllib.error.HTTPError
+            if the recorded response has a 4xx or 5xx status code.
+        """
+
+        response = self.archive.load(url)
+        if response is None:
+            raise urllib.error.URLError(f"no recorded response for {url}")
+        if response.status >= 400:
+            raise urllib.error.HTTPError(
+                url, response.status, http.client.responses.get(response.status, ''),
+                response.headers, None)
+        return response
+
+    def open(self, url, headers=None, timeout=None):
+        """Get the recorded response for a URL. See ConnectionPool.open()."""
+
+        return self.request(url, headers=headers, timeout=timeout)
+
+
+class RewriteTransport():
+    """
+    Transport that sends every request to a stand-in server (e.g. an
+    ArchiveServer) instead of the real host, by rewriting
+    'https://host/path' to 'base_url/host/path'.
+    """
+
+    def __init__(self, base_url, transport=None):
+        """
+        Parameters
+        ----------
+        base_url : str
+            URL of the stand-in server (e.g. 'http://127.0.0.1:8000').
+        transport : ConnectionPool
+            the transport to make the rewritten requests with. If None, a new
+            ConnectionPool is made.
+        """
+
+        self.base_url = base_url.rstrip('/')
+        self.transport = ConnectionPool() if transport is None else transport
+
+    def rewrite(self, url):
+        """Get the stand-in server's URL for a URL."""
+
+        parts = urllib.parse.urlsplit(url)
+        rewritten = f"{self.base_url}/{parts.netloc}{parts.path or '/'}"
+        if parts.query:
+            rewritten += '?' + parts.query
+        return rewritten
+
+    def request(self, url, headers=None, timeout=None):
+        """GET a URL from the stand-in server. See ConnectionPool.request()."""
+
+        return self.transport.request(self.rewrite(url), headers=headers, timeout=timeout)
+
+    def open(self, url, headers=None, timeout=None):
+        """GET a URL from the stand-in server. See ConnectionPool.open()."""
+
+        return self.transport.open(self.rewrite(url), headers=headers, timeout=timeout)
+
+
+class ArchiveServer(http.server.ThreadingHTTPServer):
+    """
+    Local HTTP server that serves recorded responses, as a stand-in for the
+    real hosts (see RewriteTransport). A request for '/host/path?query' gets
+    the response recorded for 'https://host/path?query'.
+    """
+
+    def __init__(self, archive_dir, host='127.0.0.1', port=8000):
+        """
+        Parameters
+        ----------
+        archive_dir : str
+            directory of recorded responses (from RecordingTransport).
+        host : str
+            the address to serve on.
+        port : int
+            the port to serve on. 0 picks a free port.
+        """
+
+        self.archive = ResponseArchive(archive_dir)
+        super().__init__((host, port), ArchiveRequestHandler)
+
+    @property
+    def url(self):
+        """The server's base URL."""
+
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class ArchiveRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serve one request from an ArchiveServer's archive."""
+
+    protocol_version = 'HTTP/1.1'  # keep connections alive
+
+    def do_GET(self):
+        response = self.server.archive.load(f"https:/{self.path}")
+        if response is None:
+            status, headers, body = 404, [], b''
+        else:
+            status, body = response.status, response.body
+            headers = [(k, v) for k, v in response.headers.items()
+                       if k.lower() != 'content-length']
+        self.send_response(status)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    # serve an archive of recorded responses, e.g.
+    # python transport.py http_archive 8000
+    server = ArchiveServer(sys.argv[1], port=int(sys.argv[2]) if len(sys.argv) > 2 else 8000)
+    print(f"serving {sys.argv[1]} at {server.url}")
+    server.serve_forever()